@@ -0,0 +1,247 @@
+"""
+Benchmark of the wrapper hot paths on synthetic pcigale-like model blocks and ini files. Needs no pcigale install.
+Timed are the ini editing, the creation of the band list, the loading of model blocks, the flux rescaling and the
+cached path of quick_access_sim_cigale_model_params for several grid sizes.
+Every run is appended to a json history file and compared with the previous run of the same benchmark and size.
+
+usage: python benchmarks/bench_hot_paths.py --n-models 1000 10000 100000 --history benchmarks/bench_history.json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+from pathlib import Path
+
+import numpy as np
+import astropy.units as u
+from astropy.table import Table
+
+# the benchmark runs from a checkout without installing the package
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from cigale_wrapper import cigale_cache  # noqa: E402
+from cigale_wrapper import cigale_helper  # noqa: E402
+from cigale_wrapper import cigale_molde_wrapper  # noqa: E402
+
+
+bench_output_band_dict = {'hst': {'acs': ['F435W', 'F814W'], 'uvis': ['F275W', 'F336W', 'F555W']},
+                          'jwst': {'nircam': ['F200W', 'F300M', 'F335M', 'F360M'], 'miri': ['F770W']}}
+bench_sed_param_list = ['sfh.age', 'attenuation.E_BV', 'stellar.metallicity', 'stellar.m_star',
+                        'universe.luminosity_distance']
+bench_sed_module_conf_dict = {
+    'sfh2exp': {'age': [1, 10, 100, 1000, 10000]},
+    'bc03': {'imf': [1], 'metallicity': [0.004, 0.02]},
+    'dustext': {'E_BV': [0.0, 0.5, 1.0]},
+    'redshifting': {'redshift': [0.0]},
+}
+
+
+def write_model_blocks(out_path, n_models, n_blocks=4, n_extra_columns=50, seed=0):
+    """
+    Function to write synthetic model blocks with the band and parameter columns the wrapper reads and additional
+    columns like a real pcigale output
+    Parameters
+    ----------
+    out_path : ``pathlib.Path``
+    n_models : int
+    n_blocks : int
+    n_extra_columns : int
+    seed : int
+    """
+    rng = np.random.default_rng(seed)
+    band_list = cigale_helper.CigaleHelper.create_output_band_list_str(output_band_dict=bench_output_band_dict)
+    os.makedirs(out_path, exist_ok=True)
+    for block_index, block_rows in enumerate(np.array_split(np.arange(n_models), n_blocks)):
+        n_rows = len(block_rows)
+        block_table = Table()
+        block_table['id'] = block_rows
+        for band in band_list:
+            block_table[band] = rng.lognormal(size=n_rows)
+            block_table[band].unit = u.mJy
+        block_table['sfh.age'] = rng.choice(bench_sed_module_conf_dict['sfh2exp']['age'], size=n_rows)
+        block_table['attenuation.E_BV'] = rng.choice(bench_sed_module_conf_dict['dustext']['E_BV'], size=n_rows)
+        block_table['stellar.metallicity'] = rng.choice(bench_sed_module_conf_dict['bc03']['metallicity'],
+                                                        size=n_rows)
+        block_table['stellar.m_star'] = rng.uniform(0.5, 1, size=n_rows)
+        block_table['stellar.m_star'].unit = u.M_sun
+        block_table['universe.luminosity_distance'] = np.full(n_rows, 3.085677581e17)
+        block_table['universe.luminosity_distance'].unit = u.m
+        for column_index in range(n_extra_columns):
+            block_table['param.extra_%i' % column_index] = rng.normal(size=n_rows)
+        block_table.write(out_path / ('models-block-%i.fits' % block_index), overwrite=True)
+
+
+def write_ini_file(file_name, n_modules=8, n_params_per_module=12):
+    """
+    Function to write a synthetic pcigale.ini with the layout written by pcigale genconf
+    Parameters
+    ----------
+    file_name : ``pathlib.Path``
+    n_modules : int
+    n_params_per_module : int
+    """
+    line_list = ['# File containing the input data.', 'data_file = ', '', 'parameters_file = ', '',
+                 'sed_modules = ' + ', '.join('module_%i' % index for index in range(n_modules)), '',
+                 'analysis_method = savefluxes', '', 'cores = 1', '', '[sed_modules_params]', '']
+    for module_index in range(n_modules):
+        line_list.append('  [[module_%i]]' % module_index)
+        for param_index in range(n_params_per_module):
+            line_list += ['    # Parameter %i of module %i.' % (param_index, module_index),
+                          '    param_%i_%i = 0.0' % (module_index, param_index)]
+        line_list.append('')
+    line_list += ['[analysis_params]', '  variables = ', '  bands = ', '  save_sed = False', '  blocks = 1', '']
+    with open(file_name, 'w', encoding='utf-8') as file:
+        file.write('\n'.join(line_list))
+
+
+def time_function(function, n_repeat):
+    """
+    Parameters
+    ----------
+    function : callable
+    n_repeat : int
+
+    Returns
+    -------
+    time_list : list
+    """
+    time_list = []
+    for _ in range(n_repeat):
+        start = time.perf_counter()
+        function()
+        time_list.append(time.perf_counter() - start)
+    return time_list
+
+
+def run_benchmarks(work_path, n_models_list, n_repeat, n_extra_columns):
+    """
+    Parameters
+    ----------
+    work_path : ``pathlib.Path``
+    n_models_list : list
+    n_repeat : int
+    n_extra_columns : int
+
+    Returns
+    -------
+    result_list : list
+    """
+    wrapper = cigale_molde_wrapper.CigaleModelWrapper
+    helper = cigale_helper.CigaleHelper
+    result_list = []
+
+    def add_result(name, n_models, time_list):
+        result_list.append({'benchmark': name, 'n_models': n_models, 'n_repeat': len(time_list),
+                            'min': float(np.min(time_list)), 'median': float(np.median(time_list))})
+        print('%-32s n_models %9i  min %.5f s  median %.5f s' % (name, n_models, np.min(time_list),
+                                                                  np.median(time_list)))
+
+    # the ini editing and the band list do not depend on the grid size
+    ini_file_name = work_path / 'pcigale.ini'
+    write_ini_file(file_name=ini_file_name)
+    param_dict = {'param_3_%i' % param_index: [1, 2, 3] for param_index in range(12)}
+    add_result('replace_params_in_file', 0, time_function(
+        lambda: helper.replace_params_in_file(param_dict=param_dict, file_name=ini_file_name), n_repeat))
+    add_result('create_output_band_list_str', 0, time_function(
+        lambda: helper.create_output_band_list_str(output_band_dict=bench_output_band_dict), n_repeat))
+
+    band_list = helper.create_output_band_list_str(output_band_dict=bench_output_band_dict)
+    for n_models in n_models_list:
+        out_path = work_path / ('out_%i' % n_models)
+        write_model_blocks(out_path=out_path, n_models=n_models, n_extra_columns=n_extra_columns)
+        add_result('load_cigale_model_params', n_models, time_function(
+            lambda: wrapper.load_cigale_model_params(sed_param_list=bench_sed_param_list,
+                                                     output_band_dict=bench_output_band_dict, out_path=out_path),
+            n_repeat))
+        model_table = wrapper.load_cigale_model_params(sed_param_list=bench_sed_param_list,
+                                                       output_band_dict=bench_output_band_dict, out_path=out_path)
+        add_result('compute_sim_band_flux_rescaled', n_models, time_function(
+            lambda: [helper.compute_sim_band_flux_rescaled(model_table=model_table, mstar_scale=1e5, dist_scale=10,
+                                                           band=band) for band in band_list], n_repeat))
+
+        # fill the cache directly, so that only the cached lookup is timed
+        cache_path = work_path / ('cache_%i' % n_models)
+        config_hash = cigale_cache.CigaleModelCache.compute_config_hash(
+            sed_module_conf_dict=bench_sed_module_conf_dict, output_band_dict=bench_output_band_dict,
+            sed_param_list=bench_sed_param_list)
+        cigale_cache.CigaleModelCache(cache_path=cache_path).put(config_hash=config_hash, model_table=model_table)
+        for memmap in [False, True]:
+            add_result('quick_access_cached' + ('_memmap' if memmap else ''), n_models, time_function(
+                lambda: wrapper.quick_access_sim_cigale_model_params(
+                    sed_module_conf_dict=bench_sed_module_conf_dict, sed_param_list=bench_sed_param_list,
+                    output_band_dict=bench_output_band_dict, cache_path=cache_path, memmap=memmap), n_repeat))
+        shutil.rmtree(out_path, ignore_errors=True)
+    return result_list
+
+
+def get_run_info():
+    """
+    Returns
+    -------
+    run_info : dict
+    """
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=Path(__file__).parent, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = 'unknown'
+    return {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'commit': commit, 'python': platform.python_version(),
+            'numpy': np.__version__, 'machine': platform.machine(), 'node': platform.node(),
+            'n_cpus': os.cpu_count()}
+
+
+def append_history(history_file, run):
+    """
+    Function to append a run to the history file and print the change to the last run of each benchmark
+    Parameters
+    ----------
+    history_file : ``pathlib.Path``
+    run : dict
+    """
+    history = []
+    if os.path.isfile(history_file):
+        with open(history_file, 'r', encoding='utf-8') as file:
+            history = json.load(file)
+    last_result_dict = {}
+    for old_run in history:
+        for result in old_run['result_list']:
+            last_result_dict[(result['benchmark'], result['n_models'])] = result
+    for result in run['result_list']:
+        last_result = last_result_dict.get((result['benchmark'], result['n_models']))
+        if last_result is not None:
+            print('%-32s n_models %9i  median %.2fx of the previous run'
+                  % (result['benchmark'], result['n_models'], result['median'] / max(last_result['median'], 1e-12)))
+    history.append(run)
+    tmp_file = Path(str(history_file) + '.tmp')
+    with open(tmp_file, 'w', encoding='utf-8') as file:
+        json.dump(history, file, indent=1)
+    os.replace(tmp_file, history_file)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--n-models', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--n-repeat', type=int, default=5)
+    parser.add_argument('--n-extra-columns', type=int, default=50,
+                        help='number of additional columns in the model blocks')
+    parser.add_argument('--history', default=str(Path(__file__).parent / 'bench_history.json'))
+    args = parser.parse_args()
+
+    work_path = Path(tempfile.mkdtemp(prefix='cigale_bench_'))
+    try:
+        result_list = run_benchmarks(work_path=work_path, n_models_list=args.n_models, n_repeat=args.n_repeat,
+                                     n_extra_columns=args.n_extra_columns)
+    finally:
+        shutil.rmtree(work_path, ignore_errors=True)
+    run = get_run_info()
+    run['argv'] = sys.argv[1:]
+    run['result_list'] = result_list
+    append_history(history_file=Path(args.history), run=run)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""
+Benchmark of the cold import time of the package and its submodules.
+Every import is timed in a fresh python process, so that nothing is cached in sys.modules. Also reported is which
+heavy third party packages each import pulls in.
+
+usage: python benchmarks/bench_import_time.py --n-runs 5
+"""
+import sys
+import json
+import argparse
+import subprocess
+from pathlib import Path
+
+import numpy as np
+
+
+default_module_list = ['cigale_wrapper', 'cigale_wrapper.cigale_helper', 'cigale_wrapper.cigale_ini',
+                       'cigale_wrapper.cigale_backend', 'cigale_wrapper.cigale_grid',
+                       'cigale_wrapper.cigale_molde_wrapper']
+# the imports run from the root of the checkout, so that the package is found without installing it
+repo_path = Path(__file__).resolve().parent.parent
+heavy_module_list = ['matplotlib', 'scipy', 'astropy.units', 'astropy.io.fits', 'astropy.table',
+                     'astropy.constants', 'phangs_data_access', 'pcigale']
+
+time_import_code = """
+import sys, time, json
+start = time.perf_counter()
+import %s
+import_time = time.perf_counter() - start
+print(json.dumps({'import_time': import_time,
+                  'heavy_module_list': [name for name in %r if name in sys.modules]}))
+"""
+
+
+def time_import(module_name, n_runs):
+    """
+    Parameters
+    ----------
+    module_name : str
+    n_runs : int
+
+    Returns
+    -------
+    time_list : list
+    loaded_heavy_module_list : list
+    """
+    time_list = []
+    loaded_heavy_module_list = []
+    for _ in range(n_runs):
+        completed = subprocess.run([sys.executable, '-c', time_import_code % (module_name, heavy_module_list)],
+                                   capture_output=True, text=True, check=True, cwd=repo_path)
+        result = json.loads(completed.stdout.strip().splitlines()[-1])
+        time_list.append(result['import_time'])
+        loaded_heavy_module_list = result['heavy_module_list']
+    return time_list, loaded_heavy_module_list
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--n-runs', type=int, default=5)
+    parser.add_argument('--modules', nargs='+', default=default_module_list)
+    args = parser.parse_args()
+
+    for module_name in args.modules:
+        try:
+            time_list, loaded_heavy_module_list = time_import(module_name=module_name, n_runs=args.n_runs)
+        except subprocess.CalledProcessError as error:
+            print('%-40s import failed: %s' % (module_name, error.stderr.strip().splitlines()[-1]))
+            continue
+        print('%-40s median %.3f s  min %.3f s  loads %s'
+              % (module_name, np.median(time_list), np.min(time_list), ', '.join(loaded_heavy_module_list) or '-'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""
+Benchmark to compare the per-run overhead of the pcigale backends.
+A tiny model grid is simulated several times with each backend so that the run time is dominated by the overhead of
+starting pcigale and handling the configuration. Needs an installed pcigale.
+
+usage: python benchmarks/bench_pcigale_backend.py --n-runs 5
+"""
+import sys
+import argparse
+import shutil
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+# the benchmark runs from a checkout without installing the package
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from cigale_wrapper import cigale_backend  # noqa: E402
+from cigale_wrapper import cigale_molde_wrapper  # noqa: E402
+
+
+tiny_sed_module_conf_dict = {
+    'sfh2exp': {'tau_main': [0.001], 'tau_burst': [0.001], 'f_burst': [0.0], 'age': [5], 'burst_age': [1],
+                'sfr_0': [1.0], 'normalise': [True]},
+    'bc03': {'imf': [1], 'metallicity': [0.02], 'separation_age': [10]},
+    'redshifting': {'redshift': [0.0]},
+}
+tiny_output_band_dict = {'hst': {'acs': [], 'uvis': ['F555W']}}
+
+
+def time_backend(backend, n_runs, scratch_path):
+    """
+    Parameters
+    ----------
+    backend : str
+    n_runs : int
+    scratch_path : str
+
+    Returns
+    -------
+    run_time_list : list
+    """
+    run_time_list = []
+    for _ in range(n_runs):
+        start = time.perf_counter()
+        run_path = cigale_molde_wrapper.CigaleModelWrapper.run_sim_cigale_model(
+            sed_module_conf_dict=tiny_sed_module_conf_dict, output_band_dict=tiny_output_band_dict,
+            scratch_path=scratch_path, backend=backend)
+        run_time_list.append(time.perf_counter() - start)
+        shutil.rmtree(run_path, ignore_errors=True)
+    return run_time_list
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--n-runs', type=int, default=5)
+    parser.add_argument('--backends', nargs='+', default=cigale_backend.CigaleBackend.backend_list)
+    args = parser.parse_args()
+
+    scratch_path = Path(tempfile.mkdtemp(prefix='cigale_bench_'))
+    try:
+        if 'worker' in args.backends:
+            # warm up the worker so that its start is not counted
+            time_backend(backend='worker', n_runs=1, scratch_path=scratch_path)
+        for backend in args.backends:
+            run_time_list = time_backend(backend=backend, n_runs=args.n_runs, scratch_path=scratch_path)
+            print('%-12s mean %.3f s  median %.3f s  min %.3f s  (%i runs)'
+                  % (backend, np.mean(run_time_list), np.median(run_time_list), np.min(run_time_list), args.n_runs))
+    finally:
+        cigale_backend.CigaleBackend.shutdown_worker_pool()
+        shutil.rmtree(scratch_path, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
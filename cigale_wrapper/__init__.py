@@ -2,8 +2,33 @@
 __all__ = [
     'cigale_molde_wrapper',
     'cigale_helper',
+    'cigale_cache',
+    'cigale_model_io',
+    'cigale_ini',
+    'cigale_backend',
+    'cigale_grid',
+    'cigale_fit',
+    'cigale_index',
+    'cigale_emulator',
+    'cigale_model_store',
+    'cigale_compact',
+    'cigale_sed',
+    'cigale_profile',
+    'cigale_async',
+    'cigale_population',
+    'cigale_queue',
 ]
 
-import cigale_wrapper.cigale_molde_wrapper
-import cigale_wrapper.cigale_helper
+import importlib
 
+
+def __getattr__(name):
+    # the submodules are only imported on first access, so that e.g. worker processes which only need
+    # cigale_helper do not import the model wrapper with all its dependencies
+    if name in __all__:
+        return importlib.import_module('cigale_wrapper.' + name)
+    raise AttributeError('module %r has no attribute %r' % (__name__, name))
+
+
+def __dir__():
+    return sorted(list(globals().keys()) + __all__)
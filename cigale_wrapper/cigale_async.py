@@ -0,0 +1,285 @@
+"""
+asyncio interface to run CIGALE simulations with progress, cancellation and timeouts
+"""
+import os
+import re
+import shutil
+import signal
+import asyncio
+import tempfile
+import subprocess
+from pathlib import Path
+
+from cigale_wrapper import cigale_helper
+from cigale_wrapper import cigale_ini
+from cigale_wrapper import cigale_backend
+
+
+# pcigale reports its progress as e.g. "12000/48000 models computed in 12.3 seconds"
+progress_pattern = re.compile(r'(\d+)/(\d+)')
+
+
+class CigaleAsync:
+    """
+    collection of coroutines to run the pcigale stages as managed subprocesses.
+    Cancelling a coroutine, directly or through a timeout, kills the running pcigale process and removes its run
+    directory.
+    """
+    @staticmethod
+    def parse_progress(line):
+        """
+        Parameters
+        ----------
+        line : str
+
+        Returns
+        -------
+        progress : tuple
+            (n_done, n_total) or None if the line contains no progress
+        """
+        progress_match = progress_pattern.search(line)
+        if progress_match is None:
+            return None
+        n_done, n_total = int(progress_match.group(1)), int(progress_match.group(2))
+        if (n_total == 0) or (n_done > n_total):
+            return None
+        return n_done, n_total
+
+    @staticmethod
+    async def kill_process(process, grace_time=5):
+        """
+        Function to stop a subprocess, first with SIGTERM and after the grace time with SIGKILL.
+        On POSIX systems the signals go to the process group of the subprocess, so that the worker processes pcigale
+        starts are stopped as well
+        Parameters
+        ----------
+        process : ``asyncio.subprocess.Process``
+            started in its own session, see run_stage
+        grace_time : float
+        """
+        if process.returncode is not None:
+            return
+        try:
+            CigaleAsync.send_signal(process=process, sig=signal.SIGTERM)
+            await asyncio.wait_for(process.wait(), timeout=grace_time)
+        except ProcessLookupError:
+            return
+        except asyncio.TimeoutError:
+            try:
+                CigaleAsync.send_signal(process=process, sig=signal.SIGKILL if hasattr(signal, 'SIGKILL')
+                                        else signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+            await process.wait()
+
+    @staticmethod
+    def send_signal(process, sig):
+        """
+        Function to send a signal to the process group of a subprocess or, without process groups, to the process
+        Parameters
+        ----------
+        process : ``asyncio.subprocess.Process``
+        sig : ``signal.Signals``
+        """
+        if hasattr(os, 'killpg'):
+            os.killpg(process.pid, sig)
+        else:
+            process.send_signal(sig)
+
+    @staticmethod
+    async def run_stage(run_path, stage, progress_callback=None):
+        """
+        Function to run one pcigale stage and report its progress
+        Parameters
+        ----------
+        run_path : str or ``pathlib.Path``
+        stage : str
+            'init', 'genconf' or 'run'
+        progress_callback : callable
+            called as progress_callback(stage, n_done, n_total) for every progress message of pcigale. Can be a
+            function or a coroutine function
+
+        Returns
+        -------
+        output : str
+            output of pcigale
+        """
+        # unbuffered output to get the progress as it happens and an own session to stop all pcigale processes
+        process = await asyncio.create_subprocess_exec('pcigale', stage, cwd=str(run_path),
+                                                       stdout=asyncio.subprocess.PIPE,
+                                                       stderr=asyncio.subprocess.STDOUT,
+                                                       env={**os.environ, 'PYTHONUNBUFFERED': '1'},
+                                                       start_new_session=hasattr(os, 'killpg'))
+        output_list = []
+        try:
+            pending = ''
+            while True:
+                data = await process.stdout.read(4096)
+                if not data:
+                    break
+                # progress lines are often only terminated by a carriage return
+                line_list = re.split(r'[\r\n]', pending + data.decode(errors='replace'))
+                pending = line_list.pop()
+                for line in line_list:
+                    output_list.append(line)
+                    progress = CigaleAsync.parse_progress(line=line)
+                    if (progress is not None) and (progress_callback is not None):
+                        callback_result = progress_callback(stage, *progress)
+                        if asyncio.iscoroutine(callback_result):
+                            await callback_result
+            output_list.append(pending)
+            return_code = await process.wait()
+        except BaseException:
+            await CigaleAsync.kill_process(process=process)
+            raise
+        output = '\n'.join(output_list)
+        if return_code != 0:
+            raise subprocess.CalledProcessError(return_code, ['pcigale', stage], output=output)
+        return output
+
+    @staticmethod
+    async def run_sim_cigale_model(sed_module_conf_dict, run_path, n_cores=1, output_band_dict=None,
+                                   save_sed=False, progress_callback=None):
+        """
+        Function to run all pcigale stages of a simulation inside an existing run directory
+        Parameters
+        ----------
+        sed_module_conf_dict : dict
+        run_path : str or ``pathlib.Path``
+        n_cores : int
+        output_band_dict : dict
+        save_sed : bool
+        progress_callback : callable
+        """
+        run_path = Path(run_path)
+        ini_file_name = run_path / 'pcigale.ini'
+        cigale_init_params = {
+            'sed_modules': list(sed_module_conf_dict.keys()),
+            'analysis_method': 'savefluxes',
+            'cores': n_cores,
+        }
+        analysis_params = {'bands': cigale_helper.CigaleHelper.create_output_band_list_str(
+            output_band_dict=output_band_dict), 'save_sed': save_sed}
+
+        await CigaleAsync.run_stage(run_path=run_path, stage='init', progress_callback=progress_callback)
+        ini_file = cigale_ini.CigaleIniFile(file_name=ini_file_name)
+        ini_file.set_params(param_dict=cigale_init_params)
+        ini_file.write()
+        await CigaleAsync.run_stage(run_path=run_path, stage='genconf', progress_callback=progress_callback)
+        ini_file = cigale_ini.CigaleIniFile(file_name=ini_file_name)
+        ini_file.apply_sim_config(sed_module_conf_dict=sed_module_conf_dict, analysis_params=analysis_params)
+        ini_file.write()
+        await CigaleAsync.run_stage(run_path=run_path, stage='run', progress_callback=progress_callback)
+
+    @staticmethod
+    async def run_in_thread(func, *args, **kwargs):
+        """
+        Function to run a function in a thread. A thread can not be stopped, so when the coroutine is cancelled it
+        waits until the function returned before the cancellation is raised. Files the function reads can then be
+        removed safely.
+        Parameters
+        ----------
+        func : callable
+        args, kwargs
+            arguments of func
+
+        Returns
+        -------
+        result
+            return value of func
+        """
+        thread_task = asyncio.ensure_future(asyncio.to_thread(func, *args, **kwargs))
+        try:
+            return await asyncio.shield(thread_task)
+        except asyncio.CancelledError:
+            while not thread_task.done():
+                try:
+                    await asyncio.wait({thread_task})
+                except asyncio.CancelledError:
+                    continue
+            if not thread_task.cancelled():
+                # an exception of func is replaced by the cancellation
+                thread_task.exception()
+            raise
+
+    @staticmethod
+    async def sim_cigale_model_params(sed_module_conf_dict, sed_param_list, output_band_dict, n_cores=1,
+                                      data_output_path='', file_name=None, save_output=True, scratch_path=None,
+                                      timeout=None, progress_callback=None):
+        """
+        async counterpart of ``cigale_molde_wrapper.CigaleModelWrapper.sim_cigale_model_params``.
+        The loading and saving of the models run in a thread, so that the event loop is not blocked.
+        Parameters
+        ----------
+        sed_module_conf_dict : dict
+        sed_param_list : list
+        output_band_dict : dict
+        n_cores : int
+        data_output_path : str
+        file_name : str
+        save_output : bool
+        scratch_path : str
+        timeout : float
+            time in seconds after which the simulation is stopped with an ``asyncio.TimeoutError``
+        progress_callback : callable
+            called as progress_callback(stage, n_done, n_total)
+
+        Return
+        ------
+        model_table : ``astropy.table.Table``
+        """
+        # imported here to not load the model wrapper with all its dependencies for the async interface only
+        from cigale_wrapper import cigale_molde_wrapper
+
+        # relative paths must not depend on the working directory of in-process runs of other threads
+        scratch_path = cigale_backend.CigaleBackend.resolve_path(scratch_path)
+        data_output_path = cigale_backend.CigaleBackend.resolve_path(data_output_path)
+        if (scratch_path is not None) and (not os.path.isdir(scratch_path)):
+            os.makedirs(scratch_path, exist_ok=True)
+        run_path = Path(tempfile.mkdtemp(prefix='cigale_run_', dir=scratch_path))
+        try:
+            await asyncio.wait_for(CigaleAsync.run_sim_cigale_model(
+                sed_module_conf_dict=sed_module_conf_dict, run_path=run_path, n_cores=n_cores,
+                output_band_dict=output_band_dict, progress_callback=progress_callback), timeout=timeout)
+            model_table = await CigaleAsync.run_in_thread(
+                cigale_molde_wrapper.CigaleModelWrapper.load_cigale_model_params, sed_param_list=sed_param_list,
+                output_band_dict=output_band_dict, out_path=run_path / 'out')
+        finally:
+            shutil.rmtree(run_path, ignore_errors=True)
+        if save_output & (file_name is not None):
+            await asyncio.to_thread(cigale_molde_wrapper.CigaleModelWrapper.save_model_table,
+                                    model_table=model_table, data_output_path=data_output_path, file_name=file_name)
+        return model_table
+
+    @staticmethod
+    async def gather_sim_cigale_model_params(sim_kwargs_list, max_concurrency=2, return_exceptions=False):
+        """
+        Function to run several simulations with at most max_concurrency of them at the same time
+        Parameters
+        ----------
+        sim_kwargs_list : list
+            list of keyword argument dictionaries of sim_cigale_model_params
+        max_concurrency : int
+        return_exceptions : bool
+            if True failed simulations return their exception. Otherwise the first failure cancels all other
+            simulations and is raised
+
+        Return
+        ------
+        model_table_list : list
+        """
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def run_limited(sim_kwargs):
+            async with semaphore:
+                return await CigaleAsync.sim_cigale_model_params(**sim_kwargs)
+
+        task_list = [asyncio.ensure_future(run_limited(sim_kwargs)) for sim_kwargs in sim_kwargs_list]
+        try:
+            return await asyncio.gather(*task_list, return_exceptions=return_exceptions)
+        except BaseException:
+            for task in task_list:
+                task.cancel()
+            # wait until all killed processes and run directories are cleaned up
+            await asyncio.gather(*task_list, return_exceptions=True)
+            raise
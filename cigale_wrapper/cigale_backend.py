@@ -0,0 +1,329 @@
+"""
+Backends to execute pcigale either as command line subprocesses or through its python API
+"""
+import os
+import inspect
+import threading
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from cigale_wrapper import cigale_ini
+from cigale_wrapper import cigale_profile
+
+
+# pcigale reads and writes everything relative to the current working directory, which is shared by all threads of
+# a process. In-process runs therefore have to be serialised.
+_chdir_lock = threading.Lock()
+# working directory of the process outside of in-process runs, which relative wrapper paths are resolved against
+_outer_cwd = None
+_cwd_lock = threading.Lock()
+# warm worker processes which have pcigale already imported. The lock guards replacing the pool and submitting to it
+_worker_pool = None
+_worker_pool_size = 0
+_worker_pool_lock = threading.RLock()
+
+
+class CigaleBackend:
+    """
+    collection of functions to execute the pcigale stages init, genconf and run inside a run directory
+    """
+    backend_list = ['subprocess', 'in_process', 'worker']
+
+    @staticmethod
+    def resolve_path(path):
+        """
+        Function to make a path absolute. Relative paths are resolved against the working directory of the process
+        and not against the run directory of an in-process pcigale run which another thread may currently execute.
+        Parameters
+        ----------
+        path : str or ``pathlib.Path`` or None
+
+        Returns
+        -------
+        path : ``pathlib.Path`` or None
+        """
+        if path is None:
+            return None
+        path = Path(path)
+        if path.is_absolute():
+            return path
+        with _cwd_lock:
+            return Path(_outer_cwd if _outer_cwd is not None else os.getcwd()) / path
+
+    @staticmethod
+    def _change_cwd(path):
+        global _outer_cwd
+        with _cwd_lock:
+            old_cwd = os.getcwd() if _outer_cwd is None else _outer_cwd
+            os.chdir(path)
+            _outer_cwd = old_cwd
+        return old_cwd
+
+    @staticmethod
+    def _restore_cwd(old_cwd):
+        global _outer_cwd
+        with _cwd_lock:
+            os.chdir(old_cwd)
+            _outer_cwd = None
+
+    @staticmethod
+    def run_pcigale(run_path, cigale_init_params, sed_module_conf_dict=None, analysis_params=None,
+                    backend='subprocess', recorder=None, n_workers=None):
+        """
+        Function to run pcigale with one of the available backends
+        Parameters
+        ----------
+        run_path : str or ``pathlib.Path``
+        cigale_init_params : dict
+            top level parameters of the pcigale.ini file like sed_modules, analysis_method and cores
+        sed_module_conf_dict : dict
+        analysis_params : dict
+        backend : str
+            'subprocess' to call the pcigale command line tool, 'in_process' to call the pcigale python API in this
+            process or 'worker' to call it in a warm worker process
+        recorder : ``cigale_profile.CigaleStageRecorder``
+            if given the stages are recorded. The worker backend is recorded as one stage 'pcigale'
+        n_workers : int
+            minimal number of warm worker processes of the worker backend, e.g. the number of runs started at the
+            same time from several threads
+        """
+        run_path = CigaleBackend.resolve_path(run_path)
+        if backend == 'subprocess':
+            CigaleBackend.run_pcigale_subprocess(run_path=run_path, cigale_init_params=cigale_init_params,
+                                                 sed_module_conf_dict=sed_module_conf_dict,
+                                                 analysis_params=analysis_params, recorder=recorder)
+        elif backend == 'in_process':
+            CigaleBackend.run_pcigale_in_process(run_path=run_path, cigale_init_params=cigale_init_params,
+                                                 sed_module_conf_dict=sed_module_conf_dict,
+                                                 analysis_params=analysis_params, recorder=recorder)
+        elif backend == 'worker':
+            n_models = CigaleBackend.count_models(sed_module_conf_dict=sed_module_conf_dict)
+            with cigale_profile.CigaleStageRecorder.get_stage(recorder=recorder, stage_name='pcigale',
+                                                              n_models=n_models, output_path=Path(run_path) / 'out'):
+                CigaleBackend.run_pcigale_in_worker(run_path=run_path, cigale_init_params=cigale_init_params,
+                                                    sed_module_conf_dict=sed_module_conf_dict,
+                                                    analysis_params=analysis_params, n_workers=n_workers)
+        else:
+            raise KeyError('backend must be one of %s' % CigaleBackend.backend_list)
+
+    @staticmethod
+    def run_pcigale_subprocess(run_path, cigale_init_params, sed_module_conf_dict=None, analysis_params=None,
+                               recorder=None):
+        """
+        Function to run pcigale through its command line tool. A failing stage raises a
+        ``subprocess.CalledProcessError``
+        Parameters
+        ----------
+        run_path : str or ``pathlib.Path``
+        cigale_init_params : dict
+        sed_module_conf_dict : dict
+        analysis_params : dict
+        recorder : ``cigale_profile.CigaleStageRecorder``
+        """
+        get_stage = cigale_profile.CigaleStageRecorder.get_stage
+        run_subprocess = cigale_profile.CigaleStageRecorder.run_subprocess
+        ini_file_name = Path(run_path) / 'pcigale.ini'
+        # initiate pcigale
+        with get_stage(recorder=recorder, stage_name='init') as stage_info:
+            run_subprocess(command_list=['pcigale', 'init'], cwd=run_path, stage_info=stage_info, recorder=recorder)
+        # set initial parameters
+        with get_stage(recorder=recorder, stage_name='ini_init'):
+            ini_file = cigale_ini.CigaleIniFile(file_name=ini_file_name)
+            ini_file.set_params(param_dict=cigale_init_params)
+            ini_file.write()
+        # configurate pcigale
+        with get_stage(recorder=recorder, stage_name='genconf') as stage_info:
+            run_subprocess(command_list=['pcigale', 'genconf'], cwd=run_path, stage_info=stage_info,
+                           recorder=recorder)
+        # set module and analysis configurations in one pass
+        with get_stage(recorder=recorder, stage_name='ini_config'):
+            ini_file = cigale_ini.CigaleIniFile(file_name=ini_file_name)
+            ini_file.apply_sim_config(sed_module_conf_dict=sed_module_conf_dict, analysis_params=analysis_params)
+            ini_file.write()
+        # run pcigale
+        n_models = CigaleBackend.count_models(sed_module_conf_dict=sed_module_conf_dict)
+        with get_stage(recorder=recorder, stage_name='run', n_models=n_models,
+                       output_path=Path(run_path) / 'out') as stage_info:
+            run_subprocess(command_list=['pcigale', 'run'], cwd=run_path, stage_info=stage_info, recorder=recorder)
+
+    @staticmethod
+    def count_models(sed_module_conf_dict):
+        """
+        Function to get the number of models a run simulates from the configured parameter grid
+        Parameters
+        ----------
+        sed_module_conf_dict : dict or None
+
+        Returns
+        -------
+        n_models : int or None
+            None if no configuration is given
+        """
+        if sed_module_conf_dict is None:
+            return None
+        # imported here to avoid a circular import through the model cache
+        from cigale_wrapper import cigale_grid
+        return cigale_grid.CigaleGridTools.count_models(sed_module_conf_dict=sed_module_conf_dict)
+
+    @staticmethod
+    def _to_config_value(value):
+        # ConfigObj expects strings or lists of strings
+        if isinstance(value, (list, tuple, np.ndarray)):
+            return [str(obj) for obj in value]
+        return str(value)
+
+    @staticmethod
+    def _load_configuration(file_name):
+        from pcigale.session.configuration import Configuration
+        # depending on the pcigale version the file name is a str or a pathlib.Path
+        default_file_name = inspect.signature(Configuration).parameters['filename'].default
+        if isinstance(default_file_name, str):
+            return Configuration(str(file_name))
+        return Configuration(Path(file_name))
+
+    @staticmethod
+    def _run_pcigale_stages(cigale_init_params, sed_module_conf_dict, analysis_params, recorder=None):
+        from pcigale.analysis_modules import get_module
+        get_stage = cigale_profile.CigaleStageRecorder.get_stage
+
+        # one configuration object is kept in memory through all stages, every stage writes it to disk
+        with get_stage(recorder=recorder, stage_name='init'):
+            config = CigaleBackend._load_configuration(file_name='pcigale.ini')
+            config.create_blank_conf()
+        with get_stage(recorder=recorder, stage_name='ini_init'):
+            for key in cigale_init_params.keys():
+                config.config[key] = CigaleBackend._to_config_value(cigale_init_params[key])
+            config.config.write()
+
+        with get_stage(recorder=recorder, stage_name='genconf'):
+            config.generate_conf()
+        with get_stage(recorder=recorder, stage_name='ini_config'):
+            CigaleBackend._apply_config(config=config, sed_module_conf_dict=sed_module_conf_dict,
+                                        analysis_params=analysis_params)
+
+        n_models = CigaleBackend.count_models(sed_module_conf_dict=sed_module_conf_dict)
+        with get_stage(recorder=recorder, stage_name='run', n_models=n_models, output_path=Path.cwd() / 'out'):
+            configuration = config.configuration
+            if not configuration:
+                raise RuntimeError('pcigale rejected the configuration in ' + str(Path.cwd() / 'pcigale.ini'))
+            analysis_module = get_module(configuration['analysis_method'])
+            analysis_module.process(configuration)
+
+    @staticmethod
+    def _apply_config(config, sed_module_conf_dict, analysis_params):
+        if sed_module_conf_dict is not None:
+            for module_str in sed_module_conf_dict.keys():
+                if module_str not in config.config['sed_modules_params']:
+                    raise KeyError('The module <<%s>> is not configured in pcigale' % module_str)
+                module_config = config.config['sed_modules_params'][module_str]
+                for key in sed_module_conf_dict[module_str].keys():
+                    if key not in module_config:
+                        raise KeyError('The parameter <<%s>> is not in the module %s' % (key, module_str))
+                    module_config[key] = CigaleBackend._to_config_value(sed_module_conf_dict[module_str][key])
+        if analysis_params is not None:
+            for key in analysis_params.keys():
+                # depending on the pcigale version some parameters like bands are top level parameters
+                if key in config.config['analysis_params']:
+                    config.config['analysis_params'][key] = CigaleBackend._to_config_value(analysis_params[key])
+                elif key in config.config:
+                    config.config[key] = CigaleBackend._to_config_value(analysis_params[key])
+                else:
+                    raise KeyError('The parameter <<%s>> is not in the pcigale configuration' % key)
+        # keep the configuration on disk for reproducibility
+        config.config.write()
+
+    @staticmethod
+    def run_pcigale_in_process(run_path, cigale_init_params, sed_module_conf_dict=None, analysis_params=None,
+                               recorder=None):
+        """
+        Function to run pcigale through its python API in the current process.
+        The configuration is passed as data and failures are raised as exceptions. As pcigale works in the current
+        directory, in-process runs of different threads are executed one after another. Relative paths used by
+        other threads during the run must go through ``resolve_path``.
+        Parameters
+        ----------
+        run_path : str or ``pathlib.Path``
+        cigale_init_params : dict
+        sed_module_conf_dict : dict
+        analysis_params : dict
+        recorder : ``cigale_profile.CigaleStageRecorder``
+        """
+        run_path = CigaleBackend.resolve_path(run_path)
+        with _chdir_lock:
+            old_cwd = CigaleBackend._change_cwd(run_path)
+            try:
+                CigaleBackend._run_pcigale_stages(cigale_init_params=cigale_init_params,
+                                                  sed_module_conf_dict=sed_module_conf_dict,
+                                                  analysis_params=analysis_params, recorder=recorder)
+            except SystemExit as exit_error:
+                raise RuntimeError('pcigale exited with status %s in %s' % (exit_error.code, run_path)) from None
+            finally:
+                CigaleBackend._restore_cwd(old_cwd)
+
+    @staticmethod
+    def _init_worker():
+        # pay the import cost once per worker
+        import pcigale.session.configuration  # noqa: F401
+        import pcigale.analysis_modules  # noqa: F401
+
+    @staticmethod
+    def get_worker_pool(n_workers=None):
+        """
+        Function to get the pool of warm worker processes. The pool is created on the first call and only recreated
+        if more workers are requested. Runs submitted to a replaced pool still finish.
+        Parameters
+        ----------
+        n_workers : int
+            if None the current pool or a pool of one worker is used
+
+        Returns
+        -------
+        worker_pool : ``concurrent.futures.ProcessPoolExecutor``
+        """
+        global _worker_pool, _worker_pool_size
+        with _worker_pool_lock:
+            if n_workers is None:
+                n_workers = max(1, _worker_pool_size)
+            if (_worker_pool is None) or (n_workers > _worker_pool_size):
+                if _worker_pool is not None:
+                    _worker_pool.shutdown(wait=False)
+                _worker_pool = ProcessPoolExecutor(max_workers=n_workers, initializer=CigaleBackend._init_worker)
+                _worker_pool_size = n_workers
+            return _worker_pool
+
+    @staticmethod
+    def shutdown_worker_pool():
+        """
+        Function to stop the warm worker processes
+        """
+        global _worker_pool, _worker_pool_size
+        with _worker_pool_lock:
+            worker_pool = _worker_pool
+            _worker_pool = None
+            _worker_pool_size = 0
+        if worker_pool is not None:
+            worker_pool.shutdown(wait=True)
+
+    @staticmethod
+    def run_pcigale_in_worker(run_path, cigale_init_params, sed_module_conf_dict=None, analysis_params=None,
+                              n_workers=None):
+        """
+        Function to run pcigale through its python API in a warm worker process.
+        Exceptions of the worker are raised in the calling process.
+        Parameters
+        ----------
+        run_path : str or ``pathlib.Path``
+        cigale_init_params : dict
+        sed_module_conf_dict : dict
+        analysis_params : dict
+        n_workers : int
+            minimal size of the worker pool, see get_worker_pool
+        """
+        # the pool can not be replaced between getting it and submitting to it
+        with _worker_pool_lock:
+            future = CigaleBackend.get_worker_pool(n_workers=n_workers).submit(
+                CigaleBackend.run_pcigale_in_process, str(run_path), cigale_init_params, sed_module_conf_dict,
+                analysis_params)
+        future.result()
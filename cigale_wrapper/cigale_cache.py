@@ -0,0 +1,231 @@
+"""
+Content addressed on-disk cache for simulated CIGALE model grids
+"""
+import os
+import json
+import time
+import hashlib
+import threading
+
+import numpy as np
+
+from cigale_wrapper import cigale_helper
+from cigale_wrapper import cigale_backend
+from cigale_wrapper import cigale_model_io
+
+
+class CigaleModelCache:
+    """
+    Cache of model tables keyed by a hash of the full simulation configuration.
+    All entries are listed in a json manifest which is used to evict the least recently used tables as soon as the
+    cache exceeds its disk size budget. Every read-modify-write of the manifest holds an exclusive lock file, so that
+    several processes can use the same cache.
+    """
+    manifest_file_name = 'manifest.json'
+    lock_file_name = 'manifest.lock'
+    # files stored alongside a table, see ``cigale_index.CigaleColourIndex.get_index_file_path``
+    sidecar_suffix_list = ['.colour_index.pkl']
+
+    def __init__(self, cache_path, max_size_bytes=None):
+        """
+        Parameters
+        ----------
+        cache_path : str or ``pathlib.Path``
+        max_size_bytes : int
+            disk size budget of the cache. If None the cache is never evicted
+        """
+        self.cache_path = cigale_backend.CigaleBackend.resolve_path(cache_path)
+        self.max_size_bytes = max_size_bytes
+        if not os.path.isdir(self.cache_path):
+            os.makedirs(self.cache_path)
+
+    @staticmethod
+    def _json_default(obj):
+        # make numpy objects and other types canonical json values
+        if isinstance(obj, np.integer):
+            return int(obj)
+        if isinstance(obj, np.floating):
+            return float(obj)
+        if isinstance(obj, np.bool_):
+            return bool(obj)
+        if isinstance(obj, np.ndarray):
+            return obj.tolist()
+        return str(obj)
+
+    @staticmethod
+    def compute_config_hash(sed_module_conf_dict, output_band_dict, sed_param_list, pcigale_version=None):
+        """
+        Function to compute a canonical hash of a model configuration
+        Parameters
+        ----------
+        sed_module_conf_dict : dict
+        output_band_dict : dict
+        sed_param_list : list
+        pcigale_version : str
+            if None the version of the installed pcigale is used
+
+        Returns
+        -------
+        config_hash : str
+        """
+        if pcigale_version is None:
+            pcigale_version = cigale_helper.CigaleHelper.get_pcigale_version()
+        # the module order matters for pcigale, so it is kept as an explicit list
+        config = {
+            'sed_modules': list(sed_module_conf_dict.keys()),
+            'sed_module_conf_dict': sed_module_conf_dict,
+            'output_band_list': cigale_helper.CigaleHelper.create_output_band_list_str(
+                output_band_dict=output_band_dict),
+            'sed_param_list': list(sed_param_list),
+            'pcigale_version': pcigale_version,
+        }
+        config_str = json.dumps(config, sort_keys=True, separators=(',', ':'),
+                                default=CigaleModelCache._json_default)
+        return hashlib.sha256(config_str.encode('utf-8')).hexdigest()
+
+    def get_file_path(self, config_hash):
+        """
+        Parameters
+        ----------
+        config_hash : str
+
+        Returns
+        -------
+        file_path : ``pathlib.Path``
+        """
+        return self.cache_path / (config_hash + '.fits')
+
+    def lock_manifest(self):
+        """
+        Returns
+        -------
+        lock : context manager
+            holding an exclusive lock on the manifest
+        """
+        return cigale_helper.CigaleHelper.lock_file(lock_file_name=self.cache_path / self.lock_file_name)
+
+    def load_manifest(self):
+        """
+        Returns
+        -------
+        manifest : dict
+        """
+        manifest_path = self.cache_path / self.manifest_file_name
+        if not os.path.isfile(manifest_path):
+            return {}
+        with open(manifest_path, 'r', encoding='utf-8') as file:
+            manifest = json.load(file)
+        # drop entries which were removed from disk by hand
+        return {key: entry for key, entry in manifest.items() if os.path.isfile(self.get_file_path(key))}
+
+    def write_manifest(self, manifest):
+        """
+        Parameters
+        ----------
+        manifest : dict
+        """
+        manifest_path = self.cache_path / self.manifest_file_name
+        tmp_path = manifest_path.with_suffix('.json.%i.%i.tmp' % (os.getpid(), threading.get_ident()))
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            json.dump(manifest, file, indent=1, sort_keys=True)
+        os.replace(tmp_path, manifest_path)
+
+    def get(self, config_hash, memmap=False):
+        """
+        Function to get a cached model table
+        Parameters
+        ----------
+        config_hash : str
+        memmap : bool
+
+        Returns
+        -------
+        model_table : ``astropy.table.Table`` or None
+        """
+        with self.lock_manifest():
+            if config_hash not in self.load_manifest():
+                return None
+        # the table is read without holding the lock, an entry evicted in the meantime is a cache miss
+        try:
+            model_table = cigale_model_io.CigaleModelIO.read_model_table(file_name=self.get_file_path(config_hash),
+                                                                         memmap=memmap)
+        except FileNotFoundError:
+            return None
+        with self.lock_manifest():
+            manifest = self.load_manifest()
+            if config_hash in manifest:
+                manifest[config_hash]['last_access'] = time.time()
+                self.write_manifest(manifest=manifest)
+        return model_table
+
+    def put(self, config_hash, model_table, pcigale_version=None):
+        """
+        Function to add a model table to the cache and evict old entries if needed
+        Parameters
+        ----------
+        config_hash : str
+        model_table : ``astropy.table.Table``
+        pcigale_version : str
+        """
+        if pcigale_version is None:
+            pcigale_version = cigale_helper.CigaleHelper.get_pcigale_version()
+        file_path = self.get_file_path(config_hash)
+        # write to a temporary file first so that readers never see a half written table
+        tmp_path = file_path.with_suffix('.%i.%i.tmp.fits' % (os.getpid(), threading.get_ident()))
+        model_table.write(tmp_path, overwrite=True)
+
+        with self.lock_manifest():
+            os.replace(tmp_path, file_path)
+            manifest = self.load_manifest()
+            now = time.time()
+            manifest[config_hash] = {'file_name': file_path.name, 'size': os.path.getsize(file_path),
+                                     'n_models': len(model_table), 'pcigale_version': pcigale_version,
+                                     'created': now, 'last_access': now}
+            self.evict(manifest=manifest, keep=config_hash)
+            self.write_manifest(manifest=manifest)
+
+    def evict(self, manifest, keep=None):
+        """
+        Function to remove least recently used entries until the cache fits into its size budget.
+        Must be called while holding lock_manifest
+        Parameters
+        ----------
+        manifest : dict
+            is modified in place
+        keep : str
+            hash which is never evicted
+        """
+        if self.max_size_bytes is None:
+            return
+        total_size = sum(entry['size'] for entry in manifest.values())
+        for key in sorted(manifest.keys(), key=lambda k: manifest[k]['last_access']):
+            if total_size <= self.max_size_bytes:
+                break
+            if key == keep:
+                continue
+            total_size -= manifest[key]['size']
+            self.remove_entry_files(config_hash=key)
+            del manifest[key]
+
+    def clear(self):
+        """
+        Function to remove all cached tables
+        """
+        with self.lock_manifest():
+            for key in self.load_manifest().keys():
+                self.remove_entry_files(config_hash=key)
+            self.write_manifest(manifest={})
+
+    def remove_entry_files(self, config_hash):
+        """
+        Function to remove a cached table together with the files stored alongside it, e.g. a colour index.
+        Temporary files of tables which are currently written are not touched
+        Parameters
+        ----------
+        config_hash : str
+        """
+        file_path_list = [self.get_file_path(config_hash)] + [self.cache_path / (config_hash + suffix)
+                                                              for suffix in self.sidecar_suffix_list]
+        for file_path in file_path_list:
+            if os.path.isfile(file_path):
+                os.remove(file_path)
@@ -0,0 +1,143 @@
+"""
+Compact in-memory representation of CIGALE model tables
+"""
+import numpy as np
+from astropy.table import Table
+
+
+class CompactModelTable:
+    """
+    Model table with dictionary encoded low-cardinality columns and float32 columns where the precision allows it.
+    Columns are decoded on access, so that it can be used like a table in functions which read columns by name,
+    e.g. ``cigale_helper.CigaleHelper.compute_sim_band_flux_rescaled``. float32 columns are returned as float32.
+    """
+    def __init__(self, model_table, max_n_categories=256, float32_rtol=1e-6, encode_column_list=None,
+                 float32_column_list=None, band_list=None):
+        """
+        Parameters
+        ----------
+        model_table : ``astropy.table.Table``
+        max_n_categories : int
+            numeric columns with at most this number of distinct values are dictionary encoded, if this is smaller
+            than storing them plain or as float32
+        float32_rtol : float
+            maximal relative rounding error of a column stored as float32
+        encode_column_list : list
+            if given only these columns are dictionary encoded
+        float32_column_list : list
+            if given only these columns are stored as float32
+        band_list : list
+            flux columns, which are not dictionary encoded unless they are in encode_column_list
+        """
+        self.colnames = list(model_table.colnames)
+        self.n_rows = len(model_table)
+        self.unit_dict = {col: model_table[col].unit for col in self.colnames}
+        self.original_bytes = {}
+        self.encoding = {}
+        # dictionary encoded columns are stored as (categories, codes)
+        self.data = {}
+        band_list = [] if band_list is None else list(band_list)
+        for col in self.colnames:
+            values = np.asarray(model_table[col])
+            self.original_bytes[col] = values.nbytes
+            self.data[col] = values
+            self.encoding[col] = 'plain'
+            if (values.dtype == np.float64) and ((float32_column_list is None) or (col in float32_column_list)):
+                values_32 = values.astype(np.float32)
+                finite = np.isfinite(values) & (values != 0)
+                with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+                    rel_err = np.abs(values_32[finite].astype(np.float64) / values[finite] - 1)
+                if (np.all(np.isfinite(values_32) == np.isfinite(values)) and
+                        ((len(rel_err) == 0) or (np.max(rel_err) <= float32_rtol))):
+                    self.data[col] = values_32
+                    self.encoding[col] = 'float32'
+            if encode_column_list is None:
+                encode = col not in band_list
+            else:
+                encode = col in encode_column_list
+            if encode and np.issubdtype(values.dtype, np.number):
+                categories, codes = np.unique(values, return_inverse=True)
+                if len(categories) <= max_n_categories:
+                    code_dtype = np.uint8 if len(categories) <= 2**8 else np.uint16 if len(categories) <= 2**16 \
+                        else np.uint32
+                    codes = codes.ravel().astype(code_dtype)
+                    # only encode if it is smaller than the plain or float32 column
+                    if categories.nbytes + codes.nbytes < self.data[col].nbytes:
+                        self.data[col] = (categories, codes)
+                        self.encoding[col] = 'dictionary'
+
+    def __len__(self):
+        return self.n_rows
+
+    def __contains__(self, col):
+        return col in self.data
+
+    def __getitem__(self, col):
+        """
+        Parameters
+        ----------
+        col : str
+
+        Returns
+        -------
+        values : ``np.ndarray``
+        """
+        if isinstance(col, (list, tuple)):
+            return self.to_table(column_list=col)
+        if self.encoding[col] == 'dictionary':
+            categories, codes = self.data[col]
+            return categories[codes]
+        return self.data[col]
+
+    def get_compact_bytes(self, col):
+        """
+        Parameters
+        ----------
+        col : str
+
+        Returns
+        -------
+        n_bytes : int
+        """
+        if self.encoding[col] == 'dictionary':
+            return self.data[col][0].nbytes + self.data[col][1].nbytes
+        return self.data[col].nbytes
+
+    def to_table(self, column_list=None):
+        """
+        Function to decode the table into an ``astropy.table.Table``. Dictionary encoded and plain columns have
+        their original values, float32 columns stay float32 and deviate by at most float32_rtol
+        Parameters
+        ----------
+        column_list : list
+
+        Returns
+        -------
+        model_table : ``astropy.table.Table``
+        """
+        if column_list is None:
+            column_list = self.colnames
+        model_table = Table()
+        for col in column_list:
+            model_table[col] = self[col]
+            if self.unit_dict[col] is not None:
+                model_table[col].unit = self.unit_dict[col]
+        return model_table
+
+    def memory_report(self):
+        """
+        Function to compare the memory of the compact and the original columns
+
+        Returns
+        -------
+        report_table : ``astropy.table.Table``
+            one row per column and a last row 'total'
+        """
+        original_bytes = [self.original_bytes[col] for col in self.colnames]
+        compact_bytes = [self.get_compact_bytes(col) for col in self.colnames]
+        report_table = Table({'column': self.colnames + ['total'],
+                              'encoding': [self.encoding[col] for col in self.colnames] + [''],
+                              'original_bytes': original_bytes + [sum(original_bytes)],
+                              'compact_bytes': compact_bytes + [sum(compact_bytes)]})
+        report_table['ratio'] = report_table['original_bytes'] / np.maximum(report_table['compact_bytes'], 1)
+        return report_table
@@ -0,0 +1,201 @@
+"""
+Interpolating emulator over the parameter axes of a regular CIGALE model grid
+"""
+import numpy as np
+from astropy.table import Table
+
+
+class CigaleGridEmulator:
+    """
+    Emulator which interpolates band fluxes and other model outputs between the points of a regular grid.
+    Ages are interpolated in log space. Outputs which are positive everywhere, like fluxes, are interpolated in log
+    space as well. As dust attenuation changes the log flux linearly with E(B-V), this makes the interpolation along
+    attenuation axes exact for a simple screen.
+    """
+    def __init__(self, model_table, axis_list, output_list, log_axis_list=('sfh.age',), log_output_list=None,
+                 method='linear'):
+        """
+        Parameters
+        ----------
+        model_table : ``astropy.table.Table``
+            must contain every combination of the axis values exactly once
+        axis_list : list
+            parameter columns spanning the grid, e.g. ['sfh.age', 'attenuation.E_BV', 'stellar.metallicity']
+        output_list : list
+            columns to emulate
+        log_axis_list : list or tuple
+            axes which are interpolated in log10
+        log_output_list : list
+            outputs which are interpolated in log10. If None all outputs which are positive everywhere
+        method : str
+            interpolation method of ``scipy.interpolate.RegularGridInterpolator``
+        """
+        self.axis_list = list(axis_list)
+        self.output_list = list(output_list)
+        self.log_axis_list = [axis for axis in log_axis_list if axis in self.axis_list]
+        self.method = method
+
+        self.axis_values = {axis: np.unique(np.asarray(model_table[axis], dtype=float)) for axis in self.axis_list}
+        grid_shape = tuple(len(self.axis_values[axis]) for axis in self.axis_list)
+        if np.prod(grid_shape) != len(model_table):
+            raise KeyError('The model table with %i rows is not a regular grid of shape %s'
+                           % (len(model_table), grid_shape))
+        grid_index = tuple(np.searchsorted(self.axis_values[axis], np.asarray(model_table[axis], dtype=float))
+                           for axis in self.axis_list)
+        flat_index = np.ravel_multi_index(grid_index, grid_shape)
+        if len(np.unique(flat_index)) != len(model_table):
+            raise KeyError('The model table contains parameter combinations more than once')
+
+        output_values = np.stack([np.asarray(model_table[output], dtype=float) for output in self.output_list],
+                                 axis=1)
+        if log_output_list is None:
+            log_output_list = [output for output_index, output in enumerate(self.output_list)
+                               if np.all(output_values[:, output_index] > 0)]
+        self.log_output_mask = np.array([output in log_output_list for output in self.output_list], dtype=bool)
+        output_values[:, self.log_output_mask] = np.log10(output_values[:, self.log_output_mask])
+
+        self.grid_values = np.empty(grid_shape + (len(self.output_list),))
+        self.grid_values.reshape(-1, len(self.output_list))[flat_index] = output_values
+        # axes with a single value can not be interpolated and are only checked
+        self.interp_axis_list = [axis for axis in self.axis_list if len(self.axis_values[axis]) > 1]
+        self.interpolator = self.build_interpolator(grid_values=self.grid_values, axis_values=self.axis_values)
+
+    def transform_axis(self, axis, values):
+        """
+        Parameters
+        ----------
+        axis : str
+        values : array-like
+
+        Returns
+        -------
+        coordinates : ``np.ndarray``
+        """
+        values = np.asarray(values, dtype=float)
+        if axis in self.log_axis_list:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                return np.log10(values)
+        return values
+
+    def build_interpolator(self, grid_values, axis_values):
+        """
+        Parameters
+        ----------
+        grid_values : ``np.ndarray``
+            array of shape (n_axis_1, ..., n_axis_n, n_outputs)
+        axis_values : dict
+
+        Returns
+        -------
+        interpolator : ``scipy.interpolate.RegularGridInterpolator``
+        """
+        try:
+            from scipy.interpolate import RegularGridInterpolator
+        except ImportError as import_error:
+            raise ImportError('The emulator needs scipy. Please install it with pip install scipy') from import_error
+        # remove the axes with only one value
+        squeezed_values = grid_values.reshape(tuple(len(axis_values[axis]) for axis in self.axis_list
+                                                    if axis in self.interp_axis_list) + (grid_values.shape[-1],))
+        return RegularGridInterpolator(tuple(self.transform_axis(axis, axis_values[axis])
+                                             for axis in self.interp_axis_list),
+                                       squeezed_values, method=self.method, bounds_error=False, fill_value=np.nan)
+
+    def get_query_coordinates(self, param_dict):
+        """
+        Function to convert query points into interpolator coordinates.
+        Points whose value of a single valued axis differs from the grid value are outside the grid and get nan
+        coordinates.
+        Parameters
+        ----------
+        param_dict : dict
+            values of every interpolated axis. Axes with a single grid value can be omitted
+
+        Returns
+        -------
+        coordinates : ``np.ndarray``
+            (n_points, n_interp_axes)
+        """
+        missing_axis_list = [axis for axis in self.interp_axis_list if axis not in param_dict]
+        if missing_axis_list:
+            raise KeyError('The query is missing the axes %s' % missing_axis_list)
+        single_axis_list = [axis for axis in self.axis_list
+                            if (axis not in self.interp_axis_list) and (axis in param_dict)]
+        column_list = np.broadcast_arrays(*[np.atleast_1d(np.asarray(param_dict[axis], dtype=float))
+                                            for axis in self.interp_axis_list + single_axis_list])
+        coordinates = np.stack([self.transform_axis(axis, column) for axis, column in zip(self.interp_axis_list,
+                                                                                           column_list)], axis=1)
+        for axis, column in zip(single_axis_list, column_list[len(self.interp_axis_list):]):
+            coordinates[~np.isclose(column, self.axis_values[axis][0])] = np.nan
+        return coordinates
+
+    def predict(self, param_dict, chunk_size=1000000):
+        """
+        Function to emulate the outputs at arbitrary parameter points. Points outside the grid get nan.
+        Parameters
+        ----------
+        param_dict : dict
+            array of values for each axis
+        chunk_size : int
+            number of points interpolated at once
+
+        Returns
+        -------
+        output_dict : dict
+            array of emulated values for each output
+        """
+        coordinates = self.get_query_coordinates(param_dict=param_dict)
+        output_values = np.empty((len(coordinates), len(self.output_list)))
+        for start in range(0, len(coordinates), chunk_size):
+            output_values[start:start + chunk_size] = self.interpolator(coordinates[start:start + chunk_size])
+        output_values[:, self.log_output_mask] = 10 ** output_values[:, self.log_output_mask]
+        return {output: output_values[:, output_index] for output_index, output in enumerate(self.output_list)}
+
+    def compute_holdout_errors(self):
+        """
+        Function to estimate the interpolation error. Along each axis with at least three values every second inner
+        grid value is removed, the emulator is rebuilt from the remaining grid and compared with the true models at
+        the removed points.
+
+        Returns
+        -------
+        error_table : ``astropy.table.Table``
+            for each axis and output the number of held-out points and the median, 95 percentile and maximum of the
+            absolute relative error
+        """
+        row_list = []
+        for axis_index, axis in enumerate(self.axis_list):
+            n_values = len(self.axis_values[axis])
+            if n_values < 3:
+                continue
+            holdout_index = np.arange(1, n_values - 1, 2)
+            keep_index = np.setdiff1d(np.arange(n_values), holdout_index)
+            axis_values = dict(self.axis_values)
+            axis_values[axis] = self.axis_values[axis][keep_index]
+            interpolator = self.build_interpolator(grid_values=np.take(self.grid_values, keep_index, axis=axis_index),
+                                                   axis_values=axis_values)
+
+            # all grid points with a held-out value of this axis
+            holdout_axis_values = dict(self.axis_values)
+            holdout_axis_values[axis] = self.axis_values[axis][holdout_index]
+            mesh = np.meshgrid(*[self.transform_axis(interp_axis, holdout_axis_values[interp_axis])
+                                 for interp_axis in self.interp_axis_list], indexing='ij')
+            coordinates = np.stack([coordinate.ravel() for coordinate in mesh], axis=1)
+            predicted = interpolator(coordinates)
+            true = np.take(self.grid_values, holdout_index, axis=axis_index).reshape(-1, len(self.output_list))
+
+            predicted[:, self.log_output_mask] = 10 ** predicted[:, self.log_output_mask]
+            true = true.copy()
+            true[:, self.log_output_mask] = 10 ** true[:, self.log_output_mask]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                rel_err = np.abs(predicted / true - 1)
+            for output_index, output in enumerate(self.output_list):
+                output_err = rel_err[:, output_index]
+                output_err = output_err[np.isfinite(output_err)]
+                if len(output_err) == 0:
+                    output_err = np.array([np.nan])
+                row_list.append((axis, output, len(true), np.median(output_err), np.percentile(output_err, 95),
+                                 np.max(output_err)))
+        names = ('axis', 'output', 'n_holdout', 'median_rel_err', 'p95_rel_err', 'max_rel_err')
+        if not row_list:
+            return Table(names=names, dtype=(str, str, int, float, float, float))
+        return Table(rows=row_list, names=names)
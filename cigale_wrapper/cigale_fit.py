@@ -0,0 +1,191 @@
+"""
+Native chi-square fitting of observed fluxes against simulated CIGALE model grids
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from astropy.table import Table
+
+
+class CigaleChi2Fitter:
+    """
+    Fitter comparing every object with every model of a grid.
+    For each object-model pair the model is rescaled with the analytic best-fit factor
+    s = sum(f_obs f_mod / err^2) / sum(f_mod^2 / err^2), so that the chi-square of all pairs reduces to three matrix
+    products per block of objects.
+    """
+    def __init__(self, model_table, band_list, sed_param_list, scaled_param_list=('stellar.m_star',)):
+        """
+        Parameters
+        ----------
+        model_table : ``astropy.table.Table``
+        band_list : list
+            model flux columns in the order of the observed flux columns
+        sed_param_list : list
+            parameters which are estimated
+        scaled_param_list : list or tuple
+            parameters of sed_param_list which scale with the best-fit factor like the stellar mass
+        """
+        self.band_list = list(band_list)
+        self.sed_param_list = list(sed_param_list)
+        self.scaled_param_list = [param for param in scaled_param_list if param in self.sed_param_list]
+        self.model_flux = np.stack([np.asarray(model_table[band], dtype=float) for band in self.band_list], axis=1)
+        self.model_params = np.stack([np.asarray(model_table[param], dtype=float)
+                                      for param in self.sed_param_list], axis=1)
+
+    @staticmethod
+    def compute_chi2_block(obs_flux, obs_flux_err, model_flux):
+        """
+        Function to compute the chi-square and best-fit scaling of a block of objects against all models.
+        Bands with a non finite flux or a non positive uncertainty are ignored.
+        Parameters
+        ----------
+        obs_flux : ``np.ndarray``
+            (n_objects, n_bands)
+        obs_flux_err : ``np.ndarray``
+            (n_objects, n_bands)
+        model_flux : ``np.ndarray``
+            (n_models, n_bands)
+
+        Returns
+        -------
+        chi2 : ``np.ndarray``
+            (n_objects, n_models)
+        scale : ``np.ndarray``
+            (n_objects, n_models)
+        """
+        valid = np.isfinite(obs_flux) & np.isfinite(obs_flux_err) & (obs_flux_err > 0)
+        inv_var = np.zeros_like(obs_flux)
+        inv_var[valid] = 1 / obs_flux_err[valid] ** 2
+        weighted_flux = np.where(valid, obs_flux, 0) * inv_var
+
+        obs_term = np.sum(weighted_flux * np.where(valid, obs_flux, 0), axis=1)
+        cross_term = weighted_flux @ model_flux.T
+        model_term = inv_var @ (model_flux ** 2).T
+        with np.errstate(divide='ignore', invalid='ignore'):
+            scale = np.where(model_term > 0, cross_term / model_term, 0)
+        chi2 = obs_term[:, None] - scale * cross_term
+        # rounding errors must not produce negative values
+        np.maximum(chi2, 0, out=chi2)
+        return chi2, scale
+
+    @staticmethod
+    def fit_block(obs_flux, obs_flux_err, model_flux, model_params, scaled_param_mask):
+        """
+        Function to fit a block of objects and to compute best-fit and likelihood weighted parameters
+        Parameters
+        ----------
+        obs_flux : ``np.ndarray``
+        obs_flux_err : ``np.ndarray``
+        model_flux : ``np.ndarray``
+        model_params : ``np.ndarray``
+            (n_models, n_params)
+        scaled_param_mask : ``np.ndarray``
+            boolean mask of the parameters which scale with the best-fit factor
+
+        Returns
+        -------
+        result_dict : dict
+        """
+        chi2, scale = CigaleChi2Fitter.compute_chi2_block(obs_flux=obs_flux, obs_flux_err=obs_flux_err,
+                                                          model_flux=model_flux)
+        best_index = np.argmin(chi2, axis=1)
+        object_index = np.arange(len(best_index))
+        best_chi2 = chi2[object_index, best_index]
+        best_scale = scale[object_index, best_index]
+
+        # likelihood relative to the best model of each object to avoid underflows
+        likelihood = np.exp(-0.5 * (chi2 - best_chi2[:, None]))
+        likelihood /= np.sum(likelihood, axis=1)[:, None]
+
+        best_params = model_params[best_index].copy()
+        best_params[:, scaled_param_mask] *= best_scale[:, None]
+        unscaled_params = model_params[:, ~scaled_param_mask]
+        mean_params = np.empty_like(best_params)
+        std_params = np.empty_like(best_params)
+        mean_params[:, ~scaled_param_mask] = likelihood @ unscaled_params
+        std_params[:, ~scaled_param_mask] = np.sqrt(np.maximum(
+            likelihood @ unscaled_params ** 2 - mean_params[:, ~scaled_param_mask] ** 2, 0))
+        for param_index in np.where(scaled_param_mask)[0]:
+            scaled_values = scale * model_params[:, param_index][None, :]
+            mean_params[:, param_index] = np.sum(likelihood * scaled_values, axis=1)
+            std_params[:, param_index] = np.sqrt(np.maximum(
+                np.sum(likelihood * scaled_values ** 2, axis=1) - mean_params[:, param_index] ** 2, 0))
+
+        n_bands_used = np.sum(np.isfinite(obs_flux) & np.isfinite(obs_flux_err) & (obs_flux_err > 0), axis=1)
+        return {'best_index': best_index, 'best_chi2': best_chi2, 'best_scale': best_scale,
+                'n_bands_used': n_bands_used, 'best_params': best_params, 'mean_params': mean_params,
+                'std_params': std_params}
+
+    @staticmethod
+    def fit_block_sequence(obs_flux, obs_flux_err, model_flux, model_params, scaled_param_mask, block_size):
+        # fits several blocks one after another to bound the size of the chi2 matrix
+        result_list = [CigaleChi2Fitter.fit_block(obs_flux=obs_flux[start:start + block_size],
+                                                  obs_flux_err=obs_flux_err[start:start + block_size],
+                                                  model_flux=model_flux, model_params=model_params,
+                                                  scaled_param_mask=scaled_param_mask)
+                       for start in range(0, len(obs_flux), block_size)]
+        return {key: np.concatenate([result[key] for result in result_list]) for key in result_list[0].keys()}
+
+    def fit(self, obs_flux, obs_flux_err, block_size=None, max_block_bytes=2**27, n_processes=1):
+        """
+        Function to fit a catalogue of observed fluxes
+        Parameters
+        ----------
+        obs_flux : array-like
+            (n_objects, n_bands) in the same units as the model fluxes
+        obs_flux_err : array-like
+            (n_objects, n_bands)
+        block_size : int
+            number of objects fitted at once. If None it is computed from max_block_bytes
+        max_block_bytes : int
+            memory budget of one object-model block
+        n_processes : int
+            number of processes. If None all cpus are used
+
+        Returns
+        -------
+        result_table : ``astropy.table.Table``
+            best_model_index, best_chi2, reduced best_chi2, best_scale and for each parameter the best-fit value as
+            best.<param> and the likelihood weighted mean and uncertainty as bayes.<param> and bayes.<param>_err
+        """
+        obs_flux = np.atleast_2d(np.asarray(obs_flux, dtype=float))
+        obs_flux_err = np.atleast_2d(np.asarray(obs_flux_err, dtype=float))
+        if (obs_flux.shape != obs_flux_err.shape) or (obs_flux.shape[1] != len(self.band_list)):
+            raise KeyError('obs_flux and obs_flux_err must be of shape (n_objects, %i)' % len(self.band_list))
+        n_objects, n_models = obs_flux.shape[0], self.model_flux.shape[0]
+        if block_size is None:
+            # chi2, scale, likelihood and one temporary array of float64 per object
+            block_size = max(1, int(max_block_bytes // (4 * 8 * n_models)))
+        scaled_param_mask = np.array([param in self.scaled_param_list for param in self.sed_param_list], dtype=bool)
+        if n_processes is None:
+            n_processes = os.cpu_count() or 1
+
+        if (n_processes <= 1) or (n_objects <= block_size):
+            result_dict = self.fit_block_sequence(obs_flux=obs_flux, obs_flux_err=obs_flux_err,
+                                                  model_flux=self.model_flux, model_params=self.model_params,
+                                                  scaled_param_mask=scaled_param_mask, block_size=block_size)
+        else:
+            # every process gets a contiguous part of the catalogue which it fits block by block
+            part_list = np.array_split(np.arange(n_objects), min(n_processes, -(-n_objects // block_size)))
+            with ProcessPoolExecutor(max_workers=len(part_list)) as executor:
+                futures = [executor.submit(CigaleChi2Fitter.fit_block_sequence, obs_flux[part], obs_flux_err[part],
+                                           self.model_flux, self.model_params, scaled_param_mask, block_size)
+                           for part in part_list]
+                result_list = [future.result() for future in futures]
+            result_dict = {key: np.concatenate([result[key] for result in result_list])
+                           for key in result_list[0].keys()}
+
+        result_table = Table()
+        result_table['best_model_index'] = result_dict['best_index']
+        result_table['best_chi2'] = result_dict['best_chi2']
+        with np.errstate(divide='ignore', invalid='ignore'):
+            result_table['best_reduced_chi2'] = result_dict['best_chi2'] / np.maximum(
+                result_dict['n_bands_used'] - 1, 1)
+        result_table['best_scale'] = result_dict['best_scale']
+        for param_index, param in enumerate(self.sed_param_list):
+            result_table['best.' + param] = result_dict['best_params'][:, param_index]
+            result_table['bayes.' + param] = result_dict['mean_params'][:, param_index]
+            result_table['bayes.' + param + '_err'] = result_dict['std_params'][:, param_index]
+        return result_table
@@ -0,0 +1,581 @@
+"""
+Tools to partition CIGALE parameter grids and to simulate them chunk by chunk
+"""
+import os
+import json
+import shutil
+import socket
+import itertools
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from cigale_wrapper import cigale_helper
+from cigale_wrapper import cigale_cache
+from cigale_wrapper import cigale_model_io
+
+
+class CigaleGridTools:
+    """
+    collection of functions to expand and split sed module configurations
+    """
+    # output columns in which pcigale stores the module parameters
+    default_param_column_dict = {
+        'sfh2exp.tau_main': 'sfh.tau_main',
+        'sfh2exp.tau_burst': 'sfh.tau_burst',
+        'sfh2exp.f_burst': 'sfh.f_burst',
+        'sfh2exp.age': 'sfh.age',
+        'sfh2exp.burst_age': 'sfh.burst_age',
+        'bc03.imf': 'stellar.imf',
+        'bc03.metallicity': 'stellar.metallicity',
+        'bc03.separation_age': 'stellar.old_young_separation_age',
+        'nebular.logU': 'nebular.logU',
+        'nebular.zgas': 'nebular.zgas',
+        'nebular.ne': 'nebular.ne',
+        'nebular.f_esc': 'nebular.f_esc',
+        'nebular.f_dust': 'nebular.f_dust',
+        'nebular.lines_width': 'nebular.lines_width',
+        'dustext.E_BV': 'attenuation.E_BV',
+        'redshifting.redshift': 'universe.redshift',
+    }
+
+    @staticmethod
+    def get_axis_values(value):
+        """
+        Function to get the list of grid values of one module parameter. Single values are one point of the grid.
+        Parameters
+        ----------
+        value : str, bool, int, float or list
+
+        Returns
+        -------
+        value_list : list
+        """
+        if isinstance(value, (list, tuple, np.ndarray)):
+            return list(value)
+        return [value]
+
+    @staticmethod
+    def get_grid_axes(sed_module_conf_dict):
+        """
+        Function to get all parameter axes of a configuration
+        Parameters
+        ----------
+        sed_module_conf_dict : dict
+
+        Returns
+        -------
+        axes_dict : dict
+            dictionary of 'module.parameter' to the list of values of this axis
+        """
+        axes_dict = {}
+        for module_str in sed_module_conf_dict.keys():
+            for key in sed_module_conf_dict[module_str].keys():
+                axes_dict[module_str + '.' + key] = CigaleGridTools.get_axis_values(
+                    sed_module_conf_dict[module_str][key])
+        return axes_dict
+
+    @staticmethod
+    def count_models(sed_module_conf_dict):
+        """
+        Function to compute the number of models of the cartesian product of all parameters
+        Parameters
+        ----------
+        sed_module_conf_dict : dict
+
+        Returns
+        -------
+        n_models : int
+        """
+        n_models = 1
+        for value_list in CigaleGridTools.get_grid_axes(sed_module_conf_dict=sed_module_conf_dict).values():
+            n_models *= len(value_list)
+        return n_models
+
+    @staticmethod
+    def split_grid(sed_module_conf_dict, split_axes):
+        """
+        Function to split a configuration into chunks along chosen axes.
+        The cartesian product of all chunks is exactly the original grid.
+        Parameters
+        ----------
+        sed_module_conf_dict : dict
+        split_axes : list or dict
+            axes in the form 'module.parameter'. With a list, every chunk gets one value of each axis. With a dict,
+            the values give the number of axis values per chunk
+
+        Returns
+        -------
+        chunk_conf_list : list
+            list of sed_module_conf_dict for each chunk
+        """
+        if not isinstance(split_axes, dict):
+            split_axes = {axis: 1 for axis in split_axes}
+        axes_dict = CigaleGridTools.get_grid_axes(sed_module_conf_dict=sed_module_conf_dict)
+        piece_list = []
+        for axis in split_axes.keys():
+            if axis not in axes_dict:
+                raise KeyError('The axis <<%s>> is not in the sed module configuration' % axis)
+            value_list = axes_dict[axis]
+            n_values = max(1, int(split_axes[axis]))
+            piece_list.append([value_list[start:start + n_values] for start in range(0, len(value_list), n_values)])
+
+        chunk_conf_list = []
+        for pieces in itertools.product(*piece_list):
+            chunk_conf = {module_str: dict(sed_module_conf_dict[module_str])
+                          for module_str in sed_module_conf_dict.keys()}
+            for axis, values in zip(split_axes.keys(), pieces):
+                module_str, key = axis.split('.', 1)
+                chunk_conf[module_str][key] = values
+            chunk_conf_list.append(chunk_conf)
+        return chunk_conf_list
+
+    @staticmethod
+    def cast_like(value_list, reference_list):
+        """
+        Function to cast values read from a model table to the type of the configured values, e.g. ages to int
+        Parameters
+        ----------
+        value_list : list
+        reference_list : list
+
+        Returns
+        -------
+        value_list : list
+        """
+        if reference_list and all(isinstance(value, (int, np.integer)) and not isinstance(value, bool)
+                                  for value in reference_list):
+            return [int(np.rint(value)) for value in value_list]
+        return [float(value) for value in value_list]
+
+    @staticmethod
+    def find_missing_sub_grids(sed_module_conf_dict, model_table, param_column_dict=None):
+        """
+        Function to find the parameter combinations of a configuration which are not in a model table yet.
+        The missing part of the union of the stored and requested grid is returned as disjoint cartesian sub grids,
+        so that the stored table stays a regular grid after merging.
+        Only axes with a parameter column in the table are compared; all other parameters are assumed to be the same
+        as the ones the table was simulated with.
+        Parameters
+        ----------
+        sed_module_conf_dict : dict
+        model_table : ``astropy.table.Table``
+        param_column_dict : dict
+            dictionary of 'module.parameter' to output column. If None default_param_column_dict is used
+
+        Returns
+        -------
+        sub_grid_conf_list : list or None
+            list of sed_module_conf_dict of the missing sub grids. None if the table is not a regular grid of its
+            parameter columns, so that it can not be extended
+        """
+        if param_column_dict is None:
+            param_column_dict = CigaleGridTools.default_param_column_dict
+        axes_dict = CigaleGridTools.get_grid_axes(sed_module_conf_dict=sed_module_conf_dict)
+        compare_axis_list = [axis for axis in axes_dict.keys()
+                             if (axis in param_column_dict) and (param_column_dict[axis] in model_table.colnames)]
+        unknown_axis_list = [axis for axis in axes_dict.keys()
+                             if (axis not in compare_axis_list) and (len(axes_dict[axis]) > 1)]
+        if unknown_axis_list:
+            raise KeyError('The axes %s have several values but no parameter column in the model table'
+                           % unknown_axis_list)
+
+        stored_values = {axis: np.unique(np.asarray(model_table[param_column_dict[axis]], dtype=float))
+                         for axis in compare_axis_list}
+        # the stored table must be a complete cartesian product of its parameter values
+        n_stored_models = 1
+        for axis in compare_axis_list:
+            n_stored_models *= len(stored_values[axis])
+        if len(model_table) != n_stored_models:
+            return None
+        if compare_axis_list:
+            stored_index = np.stack([np.searchsorted(stored_values[axis],
+                                                     np.asarray(model_table[param_column_dict[axis]], dtype=float))
+                                     for axis in compare_axis_list], axis=1)
+            if len(np.unique(stored_index, axis=0)) != len(model_table):
+                return None
+
+        old_dict, new_dict, union_dict = {}, {}, {}
+        for axis in compare_axis_list:
+            requested = axes_dict[axis]
+            is_new = [not np.any(np.isclose(float(value), stored_values[axis], rtol=1e-9, atol=0))
+                      for value in requested]
+            old_dict[axis] = CigaleGridTools.cast_like(value_list=stored_values[axis], reference_list=requested)
+            new_dict[axis] = [value for value, value_is_new in zip(requested, is_new) if value_is_new]
+            union_dict[axis] = old_dict[axis] + new_dict[axis]
+
+        # union grid minus stored grid as disjoint blocks: stored values on the axes before, new values on this axis
+        # and all values on the axes after
+        sub_grid_conf_list = []
+        for axis_index, axis in enumerate(compare_axis_list):
+            if not new_dict[axis]:
+                continue
+            sub_grid_conf = {module_str: dict(sed_module_conf_dict[module_str])
+                             for module_str in sed_module_conf_dict.keys()}
+            for other_index, other_axis in enumerate(compare_axis_list):
+                if other_index < axis_index:
+                    other_values = old_dict[other_axis]
+                elif other_index == axis_index:
+                    other_values = new_dict[other_axis]
+                else:
+                    other_values = union_dict[other_axis]
+                module_str, key = other_axis.split('.', 1)
+                sub_grid_conf[module_str][key] = other_values
+            sub_grid_conf_list.append(sub_grid_conf)
+        return sub_grid_conf_list
+
+    @staticmethod
+    def select_grid_models(sed_module_conf_dict, model_table, param_column_dict=None):
+        """
+        Function to find the rows of a model table which belong to the grid of a configuration
+        Parameters
+        ----------
+        sed_module_conf_dict : dict
+        model_table : ``astropy.table.Table``
+        param_column_dict : dict
+
+        Returns
+        -------
+        mask : ``np.ndarray``
+        """
+        if param_column_dict is None:
+            param_column_dict = CigaleGridTools.default_param_column_dict
+        axes_dict = CigaleGridTools.get_grid_axes(sed_module_conf_dict=sed_module_conf_dict)
+        mask = np.ones(len(model_table), dtype=bool)
+        for axis in axes_dict.keys():
+            if (axis not in param_column_dict) or (param_column_dict[axis] not in model_table.colnames):
+                continue
+            column = np.asarray(model_table[param_column_dict[axis]], dtype=float)
+            requested = np.asarray(axes_dict[axis], dtype=float)
+            mask &= np.any(np.isclose(column[:, None], requested[None, :], rtol=1e-9, atol=0), axis=1)
+        return mask
+
+
+class CigaleGridScheduler:
+    """
+    Scheduler to simulate a large grid in chunks on a process pool.
+    Every finished chunk is written to the work directory and recorded in a checkpoint file, so that an interrupted
+    job continues with the missing chunks when it is started again.
+    """
+    chunk_file_name = 'chunks.json'
+    checkpoint_file_name = 'checkpoint.json'
+
+    def __init__(self, sed_module_conf_dict, sed_param_list, output_band_dict, work_path, split_axes,
+                 n_cores_total=None, n_cores_per_chunk=1, scratch_path=None, backend='subprocess'):
+        """
+        Parameters
+        ----------
+        sed_module_conf_dict : dict
+        sed_param_list : list
+        output_band_dict : dict
+        work_path : str or ``pathlib.Path``
+            directory for the chunk outputs and the checkpoint
+        split_axes : list or dict
+            see ``CigaleGridTools.split_grid``
+        n_cores_total : int
+            total number of cores the scheduler may use. If None all cpus are used
+        n_cores_per_chunk : int
+            pcigale cores of each chunk run
+        scratch_path : str
+        backend : str
+        """
+        self.sed_module_conf_dict = sed_module_conf_dict
+        self.sed_param_list = list(sed_param_list)
+        self.output_band_dict = output_band_dict
+        self.work_path = Path(work_path)
+        self.split_axes = split_axes
+        if n_cores_total is None:
+            n_cores_total = os.cpu_count() or 1
+        self.n_cores_per_chunk = max(1, min(n_cores_per_chunk, n_cores_total))
+        self.n_workers = max(1, n_cores_total // self.n_cores_per_chunk)
+        self.scratch_path = scratch_path
+        self.backend = backend
+
+        if not os.path.isdir(self.work_path):
+            os.makedirs(self.work_path, exist_ok=True)
+        self.chunk_conf_list = CigaleGridTools.split_grid(sed_module_conf_dict=sed_module_conf_dict,
+                                                          split_axes=split_axes)
+        self.grid_hash = cigale_cache.CigaleModelCache.compute_config_hash(
+            sed_module_conf_dict={'grid': sed_module_conf_dict, 'split_axes': split_axes},
+            output_band_dict=output_band_dict, sed_param_list=self.sed_param_list)
+        self.write_chunk_file()
+
+    def write_chunk_file(self):
+        """
+        Function to write the chunk definitions and to make sure that an existing work directory belongs to the
+        same grid
+        """
+        chunk_file_path = self.work_path / self.chunk_file_name
+        if os.path.isfile(chunk_file_path):
+            with open(chunk_file_path, 'r', encoding='utf-8') as file:
+                grid_hash = json.load(file)['grid_hash']
+            if grid_hash != self.grid_hash:
+                raise ValueError('The work directory %s belongs to a different grid configuration' % self.work_path)
+            return
+        chunk_dict = {'grid_hash': self.grid_hash, 'chunk_conf_list': self.chunk_conf_list}
+        with open(chunk_file_path, 'w', encoding='utf-8') as file:
+            json.dump(chunk_dict, file, indent=1, default=cigale_cache.CigaleModelCache._json_default)
+
+    def get_chunk_file_path(self, chunk_index):
+        """
+        Parameters
+        ----------
+        chunk_index : int
+
+        Returns
+        -------
+        file_path : ``pathlib.Path``
+        """
+        return self.work_path / ('chunk_%05i.fits' % chunk_index)
+
+    def load_checkpoint(self):
+        """
+        Returns
+        -------
+        finished_chunk_list : list
+            indices of all chunks which are finished and whose output exists
+        """
+        checkpoint_path = self.work_path / self.checkpoint_file_name
+        if not os.path.isfile(checkpoint_path):
+            return []
+        with open(checkpoint_path, 'r', encoding='utf-8') as file:
+            finished_chunk_list = json.load(file)['finished_chunk_list']
+        return [chunk_index for chunk_index in finished_chunk_list
+                if os.path.isfile(self.get_chunk_file_path(chunk_index=chunk_index))]
+
+    def write_checkpoint(self, finished_chunk_list):
+        """
+        Parameters
+        ----------
+        finished_chunk_list : list
+        """
+        checkpoint_path = self.work_path / self.checkpoint_file_name
+        tmp_path = checkpoint_path.with_suffix('.json.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            json.dump({'n_chunks': len(self.chunk_conf_list), 'finished_chunk_list': sorted(finished_chunk_list)},
+                      file)
+        os.replace(tmp_path, checkpoint_path)
+
+    @staticmethod
+    def run_chunk(chunk_conf, sed_param_list, output_band_dict, file_path, n_cores, scratch_path, backend,
+                  has_claim=None):
+        """
+        Function to simulate one chunk and to write its model table.
+        The table is written to a temporary file unique to the host and process and then moved to file_path.
+        Parameters
+        ----------
+        chunk_conf : dict
+        sed_param_list : list
+        output_band_dict : dict
+        file_path : str or ``pathlib.Path``
+        n_cores : int
+        scratch_path : str
+        backend : str
+        has_claim : callable
+            called without arguments before the output is moved to file_path. If it returns False, e.g. because
+            the job was given to another worker of a ``cigale_queue.CigaleJobQueue``, the output is discarded
+
+        Returns
+        -------
+        n_models : int or None
+            None if the output was discarded
+        """
+        # imported here to avoid a circular import with the wrapper
+        from cigale_wrapper import cigale_molde_wrapper
+        model_table = cigale_molde_wrapper.CigaleModelWrapper.sim_cigale_model_params(
+            sed_module_conf_dict=chunk_conf, sed_param_list=sed_param_list, output_band_dict=output_band_dict,
+            n_cores=n_cores, save_output=False, scratch_path=scratch_path, backend=backend)
+        tmp_path = Path(file_path).with_suffix('.%s.%i.tmp.fits' % (socket.gethostname(), os.getpid()))
+        model_table.write(tmp_path, overwrite=True)
+        if (has_claim is not None) and (not has_claim()):
+            os.remove(tmp_path)
+            return None
+        os.replace(tmp_path, file_path)
+        return len(model_table)
+
+    def run(self):
+        """
+        Function to simulate all chunks which are not finished yet.
+        Every chunk which finishes is recorded in the checkpoint, also if other chunks fail. Failed chunks raise a
+        RuntimeError after all other chunks are done, so that they are run again when the job is restarted.
+
+        Returns
+        -------
+        finished_chunk_list : list
+        """
+        finished_chunk_list = self.load_checkpoint()
+        pending_chunk_list = [chunk_index for chunk_index in range(len(self.chunk_conf_list))
+                              if chunk_index not in finished_chunk_list]
+        if not pending_chunk_list:
+            return finished_chunk_list
+        error_dict = {}
+        with ProcessPoolExecutor(max_workers=min(self.n_workers, len(pending_chunk_list))) as executor:
+            future_dict = {executor.submit(self.run_chunk, self.chunk_conf_list[chunk_index],
+                                           self.sed_param_list, self.output_band_dict,
+                                           self.get_chunk_file_path(chunk_index=chunk_index), self.n_cores_per_chunk,
+                                           self.scratch_path, self.backend): chunk_index
+                           for chunk_index in pending_chunk_list}
+            for future in as_completed(future_dict):
+                try:
+                    future.result()
+                except Exception as error:
+                    error_dict[future_dict[future]] = error
+                    continue
+                finished_chunk_list.append(future_dict[future])
+                self.write_checkpoint(finished_chunk_list=finished_chunk_list)
+        if error_dict:
+            failed_chunk_list = sorted(error_dict.keys())
+            raise RuntimeError('The chunks %s failed, %i chunks are finished'
+                               % (failed_chunk_list, len(finished_chunk_list))) \
+                from error_dict[failed_chunk_list[0]]
+        return finished_chunk_list
+
+    def merge(self, n_threads=None):
+        """
+        Function to merge the outputs of all chunks into one model table
+        Parameters
+        ----------
+        n_threads : int
+
+        Returns
+        -------
+        model_table : ``astropy.table.Table``
+        """
+        finished_chunk_list = self.load_checkpoint()
+        missing_chunk_list = [chunk_index for chunk_index in range(len(self.chunk_conf_list))
+                              if chunk_index not in finished_chunk_list]
+        if missing_chunk_list:
+            raise RuntimeError('The chunks %s are not finished yet' % missing_chunk_list)
+        column_list = cigale_helper.CigaleHelper.create_output_band_list_str(output_band_dict=self.output_band_dict)
+        column_list += self.sed_param_list
+        block_file_list = [self.get_chunk_file_path(chunk_index=chunk_index)
+                           for chunk_index in range(len(self.chunk_conf_list))]
+        return cigale_model_io.CigaleModelIO.read_model_blocks(block_file_list=block_file_list,
+                                                               column_list=column_list, n_threads=n_threads)
+
+    def run_and_merge(self, n_threads=None):
+        """
+        Function to simulate all missing chunks and to merge the full grid
+        Parameters
+        ----------
+        n_threads : int
+
+        Returns
+        -------
+        model_table : ``astropy.table.Table``
+        """
+        self.run()
+        return self.merge(n_threads=n_threads)
+
+
+class CigaleGridPlanner:
+    """
+    collection of functions to estimate the size of a simulation before running pcigale
+    """
+    # rough number of physical properties pcigale saves for each model with the standard sed modules, when no list of
+    # variables is given
+    n_pcigale_param_columns = 50
+
+    @staticmethod
+    def estimate_output_size(sed_module_conf_dict, output_band_dict, sed_param_list, n_output_param_columns=None,
+                             bytes_per_value=8):
+        """
+        Function to estimate the number of models and the memory and disk size of a simulation
+        Parameters
+        ----------
+        sed_module_conf_dict : dict
+        output_band_dict : dict
+        sed_param_list : list
+        n_output_param_columns : int
+            number of parameter columns pcigale writes. If None it is estimated
+        bytes_per_value : int
+
+        Returns
+        -------
+        size_dict : dict
+            n_models, n_bands, bytes_per_model of the pcigale output and of the loaded table, output_bytes and
+            load_bytes
+        """
+        n_models = CigaleGridTools.count_models(sed_module_conf_dict=sed_module_conf_dict)
+        n_bands = len(cigale_helper.CigaleHelper.create_output_band_list_str(output_band_dict=output_band_dict))
+        if n_output_param_columns is None:
+            n_output_param_columns = max(len(sed_param_list), CigaleGridPlanner.n_pcigale_param_columns)
+        output_bytes_per_model = (n_bands + n_output_param_columns + 1) * bytes_per_value
+        load_bytes_per_model = (n_bands + len(sed_param_list)) * bytes_per_value
+        return {'n_models': n_models, 'n_bands': n_bands,
+                'output_bytes_per_model': output_bytes_per_model, 'load_bytes_per_model': load_bytes_per_model,
+                'output_bytes': n_models * output_bytes_per_model, 'load_bytes': n_models * load_bytes_per_model}
+
+    @staticmethod
+    def find_split_axes(sed_module_conf_dict, max_models_per_chunk):
+        """
+        Function to find the axes and number of values per chunk so that every chunk has at most
+        max_models_per_chunk models. The longest axes are split first.
+        Parameters
+        ----------
+        sed_module_conf_dict : dict
+        max_models_per_chunk : int
+
+        Returns
+        -------
+        split_axes : dict
+            can be passed to ``CigaleGridTools.split_grid``
+        n_models_per_chunk : int
+        n_chunks : int
+        """
+        axes_dict = CigaleGridTools.get_grid_axes(sed_module_conf_dict=sed_module_conf_dict)
+        n_models_per_chunk = CigaleGridTools.count_models(sed_module_conf_dict=sed_module_conf_dict)
+        split_axes = {}
+        n_chunks = 1
+        for axis in sorted(axes_dict.keys(), key=lambda axis_key: len(axes_dict[axis_key]), reverse=True):
+            n_axis_values = len(axes_dict[axis])
+            if (n_models_per_chunk <= max_models_per_chunk) or (n_axis_values == 1):
+                break
+            n_models_other_axes = n_models_per_chunk // n_axis_values
+            n_values = int(max(1, min(n_axis_values, max_models_per_chunk // max(1, n_models_other_axes))))
+            split_axes[axis] = n_values
+            n_models_per_chunk = n_models_other_axes * n_values
+            n_chunks *= -(-n_axis_values // n_values)
+        return split_axes, n_models_per_chunk, n_chunks
+
+    @staticmethod
+    def plan_grid(sed_module_conf_dict, output_band_dict, sed_param_list, memory_budget_bytes,
+                  n_output_param_columns=None, output_path=None):
+        """
+        Function to plan a simulation: number of models, output sizes and a chunking which fits into a memory budget.
+        Only the lengths of the parameter lists are used, so this is cheap even for huge grids.
+        Parameters
+        ----------
+        sed_module_conf_dict : dict
+        output_band_dict : dict
+        sed_param_list : list
+        memory_budget_bytes : int
+            memory available for one chunk
+        n_output_param_columns : int
+        output_path : str
+            if given the free disk space at this path is compared to the output size
+
+        Returns
+        -------
+        plan_dict : dict
+            the output of estimate_output_size together with split_axes, n_chunks, n_models_per_chunk,
+            chunk_memory_bytes, fits_memory and, if output_path is given, disk_free_bytes and fits_disk
+        """
+        plan_dict = CigaleGridPlanner.estimate_output_size(sed_module_conf_dict=sed_module_conf_dict,
+                                                           output_band_dict=output_band_dict,
+                                                           sed_param_list=sed_param_list,
+                                                           n_output_param_columns=n_output_param_columns)
+        # pcigale keeps a full output block in memory, which needs more than the loaded table
+        bytes_per_model = max(plan_dict['output_bytes_per_model'], plan_dict['load_bytes_per_model'])
+        max_models_per_chunk = max(1, int(memory_budget_bytes // bytes_per_model))
+        split_axes, n_models_per_chunk, n_chunks = CigaleGridPlanner.find_split_axes(
+            sed_module_conf_dict=sed_module_conf_dict, max_models_per_chunk=max_models_per_chunk)
+        plan_dict.update({'split_axes': split_axes, 'n_chunks': n_chunks, 'n_models_per_chunk': n_models_per_chunk,
+                          'chunk_memory_bytes': n_models_per_chunk * bytes_per_model,
+                          'fits_memory': n_models_per_chunk * bytes_per_model <= memory_budget_bytes})
+        if output_path is not None:
+            disk_free_bytes = shutil.disk_usage(output_path).free
+            plan_dict.update({'disk_free_bytes': disk_free_bytes,
+                              'fits_disk': plan_dict['output_bytes'] <= disk_free_bytes})
+        return plan_dict
@@ -1,8 +1,17 @@
 """
 Here we gather all the helper functions we need for the Cigale wrapper
 """
+import contextlib
+from importlib import metadata
+from pathlib import Path
+
 import numpy as np
-import astropy.units as u
+
+from cigale_wrapper import cigale_ini
+
+# conversion factor from Mpc to m which is used for the flux rescaling of the models: 1 pc = 648000 / pi au with the
+# IAU astronomical unit, the same value as (1 * u.Mpc).to(u.m) without importing astropy.units
+mpc_to_m = 648000 / np.pi * 149597870700 * 1e6
 
 
 class CigaleHelper:
@@ -56,45 +65,42 @@ class CigaleHelper:
         return filter_name
 
     @staticmethod
-    def replace_params_in_file(param_dict, file_name='pcigale.ini'):
+    def replace_params_in_file(param_dict, file_name='pcigale.ini', section=None):
         """
         function to replace specific model configurations in pcigale ini files
         Parameters
         ----------
         param_dict : dict
         file_name : str
+        section : tuple or str
+            section of the ini file the parameters are in. If None each key must be unique on its lowest nesting level
+        """
+        ini_file = cigale_ini.CigaleIniFile(file_name=file_name)
+        ini_file.set_params(param_dict=param_dict, section=section)
+        ini_file.write()
+
+    @staticmethod
+    @contextlib.contextmanager
+    def lock_file(lock_file_name):
         """
-        with open(file_name, 'r', encoding='utf-8') as file:
-            lines = file.readlines()
-        print(param_dict.keys())
-        for key in param_dict.keys():
-            print('key ', key)
-            line_index = [i for i in range(len(lines)) if lines[i].startswith(key)]
-            prefix = ''
-            if not line_index:
-                line_index = [i for i in range(len(lines)) if lines[i].startswith('  ' + key)]
-                prefix = '  '
-            if not line_index:
-                line_index = [i for i in range(len(lines)) if lines[i].startswith('    ' + key)]
-                prefix = '    '
-            if len(line_index) > 1:
-                raise KeyError('There is apparently more than one line beginning with <<', key, '>>')
-            if isinstance(param_dict[key], (str, bool, int, float)):
-                new_line = prefix + key + ' = ' + str(param_dict[key]) + '\n'
-            elif isinstance(param_dict[key], list):
-                new_line = prefix + key + ' = '
-                for obj in param_dict[key]:
-                    new_line += str(obj) + ', '
-            else:
-                raise KeyError('The given parameters mus be of type str, bool, int, float or a list of these types')
-            # check if there is no , at the end
-            if new_line[-2:] == ', ':
-                new_line = new_line[:-2]
-
-            print('new_line ', new_line)
-            lines[line_index[0]] = new_line
-        with open(file_name, 'w', encoding='utf-8') as file:
-            file.writelines(lines)
+        Context manager holding an exclusive lock on a lock file, e.g. around a read-modify-write of a file which
+        several processes or threads update. On systems without fcntl nothing is locked
+        Parameters
+        ----------
+        lock_file_name : str or ``pathlib.Path``
+        """
+        try:
+            import fcntl
+        except ImportError:
+            yield
+            return
+        # every holder opens the file itself, so that the lock also excludes threads of the same process
+        with open(lock_file_name, 'a') as lock_file:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
 
     @staticmethod
     def create_output_band_list_str(output_band_dict):
@@ -135,8 +141,47 @@ class CigaleHelper:
         """
         return list(np.array(np.unique(np.rint(np.logspace(np.log10(start), np.log10(stop), n_steps))), dtype=int))
 
+    @staticmethod
+    def verify_suffix(file_name, suffix):
+        """
+        Function to make sure a file name ends with a suffix. Uses ``phangs_data_access`` if it is installed and
+        otherwise appends the suffix if it is missing
+        Parameters
+        ----------
+        file_name : str or ``pathlib.Path``
+        suffix : str
+            without the dot, e.g. 'fits'
+
+        Returns
+        -------
+        file_name : ``pathlib.Path``
+        """
+        try:
+            from phangs_data_access import helper_func
+        except ImportError:
+            file_name = Path(file_name)
+            if file_name.name.endswith('.' + suffix):
+                return file_name
+            return file_name.with_name(file_name.name + '.' + suffix)
+        return Path(helper_func.FileTools.verify_suffix(file_name=file_name, suffix=suffix))
+
+    @staticmethod
+    def get_pcigale_version():
+        """
+        Function to get the version of the installed pcigale package
+        Returns
+        -------
+        version : str
+            'unknown' if pcigale is not installed as a distribution
+        """
+        try:
+            return metadata.version('pcigale')
+        except metadata.PackageNotFoundError:
+            return 'unknown'
+
     @staticmethod
     def compute_sim_band_flux_rescaled(model_table, mstar_scale, dist_scale, band='hst.wfc3.F555W'):
+        import astropy.units as u
 
         sim_flux = np.array(model_table[band])
         sim_dist = np.array(model_table['universe.luminosity_distance']) * u.m
@@ -147,4 +192,84 @@ class CigaleHelper:
 
         return sim_flux * mass_scale_factor * dist_scale_factor
 
+    @staticmethod
+    def compute_sim_model_flux_norm(model_table, band_list):
+        """
+        Function to compute the model fluxes normalised to one solar mass at a distance of one meter.
+        Multiplying them with mstar / dist**2 for a stellar mass in M_sun and a distance in m gives rescaled fluxes.
+        Parameters
+        ----------
+        model_table : ``astropy.table.Table``
+        band_list : list
+
+        Returns
+        -------
+        flux_norm : ``np.ndarray``
+            array of shape (n_models, n_bands)
+        """
+        sim_dist = np.asarray(model_table['universe.luminosity_distance'], dtype=float)
+        sim_mstar = np.asarray(model_table['stellar.m_star'], dtype=float)
+        flux_norm = np.empty((len(model_table), len(band_list)))
+        for band_index, band in enumerate(band_list):
+            flux_norm[:, band_index] = np.asarray(model_table[band], dtype=float)
+        flux_norm *= (sim_dist ** 2 / sim_mstar)[:, None]
+        return flux_norm
 
+    @staticmethod
+    def compute_sim_band_flux_rescaled_batch(model_table, mstar_scale, dist_scale, band_list, flux_norm=None):
+        """
+        Function to rescale the fluxes of all models in several bands to many stellar masses and distances at once
+        Parameters
+        ----------
+        model_table : ``astropy.table.Table``
+        mstar_scale : float or array-like
+            stellar masses in M_sun
+        dist_scale : float or array-like
+            distances in Mpc. Must broadcast with mstar_scale
+        band_list : list
+        flux_norm : ``np.ndarray``
+            precomputed output of compute_sim_model_flux_norm to avoid computing it again
+
+        Returns
+        -------
+        flux : ``np.ndarray``
+            array of shape (n_models, n_bands, n_targets)
+        """
+        if flux_norm is None:
+            flux_norm = CigaleHelper.compute_sim_model_flux_norm(model_table=model_table, band_list=band_list)
+        mstar_scale, dist_scale = np.broadcast_arrays(np.atleast_1d(np.asarray(mstar_scale, dtype=float)),
+                                                      np.atleast_1d(np.asarray(dist_scale, dtype=float)))
+        target_factor = mstar_scale / (dist_scale * mpc_to_m) ** 2
+        return flux_norm[:, :, None] * target_factor[None, None, :]
+
+    @staticmethod
+    def iter_sim_band_flux_rescaled_batch(model_table, mstar_scale, dist_scale, band_list, chunk_size=None,
+                                          max_memory_bytes=2**28):
+        """
+        Function to iterate over chunks of targets of the rescaled fluxes, so that the memory usage stays bounded
+        Parameters
+        ----------
+        model_table : ``astropy.table.Table``
+        mstar_scale : float or array-like
+        dist_scale : float or array-like
+        band_list : list
+        chunk_size : int
+            number of targets per chunk. If None it is computed from max_memory_bytes
+        max_memory_bytes : int
+
+        Yields
+        ------
+        target_slice : slice
+        flux : ``np.ndarray``
+            array of shape (n_models, n_bands, chunk_size)
+        """
+        flux_norm = CigaleHelper.compute_sim_model_flux_norm(model_table=model_table, band_list=band_list)
+        mstar_scale, dist_scale = np.broadcast_arrays(np.atleast_1d(np.asarray(mstar_scale, dtype=float)),
+                                                      np.atleast_1d(np.asarray(dist_scale, dtype=float)))
+        if chunk_size is None:
+            chunk_size = max(1, int(max_memory_bytes // max(1, flux_norm.nbytes)))
+        for start in range(0, len(mstar_scale), chunk_size):
+            target_slice = slice(start, min(start + chunk_size, len(mstar_scale)))
+            yield target_slice, CigaleHelper.compute_sim_band_flux_rescaled_batch(
+                model_table=model_table, mstar_scale=mstar_scale[target_slice], dist_scale=dist_scale[target_slice],
+                band_list=band_list, flux_norm=flux_norm)
@@ -0,0 +1,253 @@
+"""
+Nearest neighbour index over model grids in colour space
+"""
+import os
+import pickle
+import threading
+from pathlib import Path
+
+import numpy as np
+
+
+class CigaleColourIndex:
+    """
+    KD-tree over the colours of a model grid to find the closest models of whole catalogues at once.
+    Colours are magnitude differences -2.5 log10(f_1 / f_2), so they do not depend on the stellar mass or distance
+    of the models.
+    """
+    # factor to convert relative flux uncertainties into magnitude uncertainties
+    mag_err_factor = 2.5 / np.log(10)
+
+    def __init__(self, model_table, band_list=None, colour_list=None, leaf_size=32):
+        """
+        Parameters
+        ----------
+        model_table : ``astropy.table.Table``
+        band_list : list
+            if colour_list is None the colours are built from consecutive bands of this list
+        colour_list : list
+            list of (band_1, band_2) tuples
+        leaf_size : int
+        """
+        if colour_list is None:
+            if (band_list is None) or (len(band_list) < 2):
+                raise KeyError('Either a colour_list or a band_list of at least two bands must be given')
+            colour_list = list(zip(band_list[:-1], band_list[1:]))
+        self.colour_list = [tuple(colour) for colour in colour_list]
+        self.band_list = list(dict.fromkeys([band for colour in self.colour_list for band in colour]))
+        self.n_models = len(model_table)
+        self.leaf_size = leaf_size
+
+        model_flux = np.stack([np.asarray(model_table[band], dtype=float) for band in self.band_list], axis=1)
+        model_features = self.compute_colours(flux=model_flux)
+        # models without a positive flux in all bands can not be placed in colour space
+        self.model_index = np.where(np.all(np.isfinite(model_features), axis=1))[0]
+        self.model_features = model_features[self.model_index]
+        self.tree = self.build_tree(features=self.model_features, leaf_size=leaf_size)
+
+    @staticmethod
+    def build_tree(features, leaf_size=32):
+        """
+        Parameters
+        ----------
+        features : ``np.ndarray``
+        leaf_size : int
+
+        Returns
+        -------
+        tree : ``scipy.spatial.cKDTree``
+        """
+        try:
+            from scipy.spatial import cKDTree
+        except ImportError as import_error:
+            raise ImportError('The colour index needs scipy. Please install it with pip install scipy') \
+                from import_error
+        return cKDTree(features, leafsize=leaf_size)
+
+    def compute_colours(self, flux):
+        """
+        Function to compute the colours of a flux matrix
+        Parameters
+        ----------
+        flux : ``np.ndarray``
+            (n_objects, n_bands) in the band order of self.band_list
+
+        Returns
+        -------
+        colours : ``np.ndarray``
+            (n_objects, n_colours)
+        """
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mag = np.where(flux > 0, -2.5 * np.log10(flux), np.nan)
+        band_index = {band: index for index, band in enumerate(self.band_list)}
+        return np.stack([mag[:, band_index[band_1]] - mag[:, band_index[band_2]]
+                         for band_1, band_2 in self.colour_list], axis=1)
+
+    def compute_colour_err(self, flux, flux_err):
+        """
+        Function to propagate flux uncertainties to colour uncertainties
+        Parameters
+        ----------
+        flux : ``np.ndarray``
+        flux_err : ``np.ndarray``
+
+        Returns
+        -------
+        colour_err : ``np.ndarray``
+        """
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mag_err = self.mag_err_factor * np.abs(flux_err / flux)
+        band_index = {band: index for index, band in enumerate(self.band_list)}
+        return np.stack([np.sqrt(mag_err[:, band_index[band_1]] ** 2 + mag_err[:, band_index[band_2]] ** 2)
+                         for band_1, band_2 in self.colour_list], axis=1)
+
+    def query(self, obs_flux, obs_flux_err=None, k=1, n_candidates=None, n_jobs=1):
+        """
+        Function to find the k closest models in colour space for a catalogue.
+        With uncertainties, n_candidates euclidean neighbours are taken from the tree and re-ranked by their
+        error weighted distance.
+        Objects without valid colours, e.g. with a non-positive flux, have no closest model. Their rows are masked
+        in both returned arrays and hold the fill values inf and -1. As -1 is a valid numpy index, model_index must
+        not be used to index the model table without checking its mask first, e.g. with model_index.compressed()
+        or model_index.mask.
+        Parameters
+        ----------
+        obs_flux : array-like
+            (n_objects, n_bands) in the band order of self.band_list
+        obs_flux_err : array-like
+            (n_objects, n_bands). If None all colours have the same weight
+        k : int
+        n_candidates : int
+            if None it is max(10 k, 32)
+        n_jobs : int
+            number of threads of the tree query, -1 uses all cpus
+
+        Returns
+        -------
+        distance : ``np.ma.MaskedArray``
+            (n_objects, k) euclidean or error weighted colour distance. Masked with inf for objects without valid
+            colours
+        model_index : ``np.ma.MaskedArray``
+            (n_objects, k) rows of the model table. Masked with -1 for objects without valid colours
+        """
+        obs_flux = np.atleast_2d(np.asarray(obs_flux, dtype=float))
+        obs_features = self.compute_colours(flux=obs_flux)
+        valid = np.all(np.isfinite(obs_features), axis=1)
+        k = min(k, len(self.model_index))
+        distance = np.full((len(obs_flux), k), np.inf)
+        model_index = np.full((len(obs_flux), k), -1, dtype=int)
+
+        if obs_flux_err is None:
+            tree_distance, tree_index = self.tree.query(obs_features[valid], k=k, workers=n_jobs)
+            distance[valid] = np.reshape(tree_distance, (-1, k))
+            model_index[valid] = self.model_index[np.reshape(tree_index, (-1, k))]
+            return self.mask_invalid(distance=distance, model_index=model_index, valid=valid)
+
+        obs_colour_err = self.compute_colour_err(flux=obs_flux, flux_err=np.atleast_2d(np.asarray(obs_flux_err,
+                                                                                                     dtype=float)))
+        valid &= np.all(np.isfinite(obs_colour_err) & (obs_colour_err > 0), axis=1)
+        if n_candidates is None:
+            n_candidates = max(10 * k, 32)
+        n_candidates = max(k, min(n_candidates, len(self.model_index)))
+        _, candidate_index = self.tree.query(obs_features[valid], k=n_candidates, workers=n_jobs)
+        candidate_index = np.reshape(candidate_index, (-1, n_candidates))
+        # error weighted distance of all candidates
+        weighted_distance = np.sqrt(np.sum(((self.model_features[candidate_index] - obs_features[valid][:, None, :]) /
+                                            obs_colour_err[valid][:, None, :]) ** 2, axis=2))
+        order = np.argsort(weighted_distance, axis=1)[:, :k]
+        distance[valid] = np.take_along_axis(weighted_distance, order, axis=1)
+        model_index[valid] = self.model_index[np.take_along_axis(candidate_index, order, axis=1)]
+        return self.mask_invalid(distance=distance, model_index=model_index, valid=valid)
+
+    @staticmethod
+    def mask_invalid(distance, model_index, valid):
+        """
+        Function to mask the query results of objects without valid colours
+        Parameters
+        ----------
+        distance : ``np.ndarray``
+        model_index : ``np.ndarray``
+        valid : ``np.ndarray``
+            (n_objects,) boolean
+
+        Returns
+        -------
+        distance : ``np.ma.MaskedArray``
+        model_index : ``np.ma.MaskedArray``
+        """
+        mask = np.repeat(~valid[:, None], distance.shape[1], axis=1)
+        return (np.ma.MaskedArray(distance, mask=mask, fill_value=np.inf),
+                np.ma.MaskedArray(model_index, mask=mask.copy(), fill_value=-1))
+
+    def save(self, file_path):
+        """
+        Parameters
+        ----------
+        file_path : str or ``pathlib.Path``
+        """
+        # unique for every thread, so that concurrent writers of the same index do not share a temporary file
+        tmp_path = Path(str(file_path) + '.%i.%i.tmp' % (os.getpid(), threading.get_ident()))
+        with open(tmp_path, 'wb') as file:
+            pickle.dump(self, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, file_path)
+
+    @staticmethod
+    def load(file_path):
+        """
+        Parameters
+        ----------
+        file_path : str or ``pathlib.Path``
+
+        Returns
+        -------
+        colour_index : ``CigaleColourIndex``
+        """
+        with open(file_path, 'rb') as file:
+            return pickle.load(file)
+
+    @staticmethod
+    def get_index_file_path(table_file_path):
+        """
+        Function to get the file name of an index stored alongside a saved model table
+        Parameters
+        ----------
+        table_file_path : str or ``pathlib.Path``
+
+        Returns
+        -------
+        file_path : ``pathlib.Path``
+        """
+        table_file_path = Path(table_file_path)
+        return table_file_path.with_name(table_file_path.stem + '.colour_index.pkl')
+
+    @staticmethod
+    def load_or_build(model_table, table_file_path, band_list=None, colour_list=None):
+        """
+        Function to load the index stored alongside a model table or to build and store it
+        Parameters
+        ----------
+        model_table : ``astropy.table.Table``
+        table_file_path : str or ``pathlib.Path``
+        band_list : list
+            if colour_list is None the colours are built from consecutive bands of this list
+        colour_list : list
+
+        Returns
+        -------
+        colour_index : ``CigaleColourIndex``
+        """
+        index_file_path = CigaleColourIndex.get_index_file_path(table_file_path=table_file_path)
+        if colour_list is None:
+            if (band_list is None) or (len(band_list) < 2):
+                raise KeyError('Either a colour_list or a band_list of at least two bands must be given')
+            colour_list = list(zip(band_list[:-1], band_list[1:]))
+        if os.path.isfile(index_file_path):
+            # the table may have been replaced after the index was written
+            if os.path.getmtime(index_file_path) >= os.path.getmtime(table_file_path):
+                colour_index = CigaleColourIndex.load(file_path=index_file_path)
+                if (colour_index.colour_list == [tuple(colour) for colour in colour_list]) and \
+                        (colour_index.n_models == len(model_table)):
+                    return colour_index
+        colour_index = CigaleColourIndex(model_table=model_table, colour_list=colour_list)
+        colour_index.save(file_path=index_file_path)
+        return colour_index
@@ -0,0 +1,176 @@
+"""
+In-memory model of pcigale ini files to change many parameters at once
+"""
+import re
+
+import numpy as np
+
+
+class CigaleIniFile:
+    """
+    Parsed pcigale.ini file.
+    All parameter lines are indexed by their section and key, so that a full configuration can be applied in one
+    pass and the file is written only once.
+    """
+    section_pattern = re.compile(r'^(\s*)(\[+)\s*([^\]]+?)\s*(\]+)\s*$')
+    param_pattern = re.compile(r'^(\s*)([^#\s=\[][^=]*?)\s*=(.*)$')
+
+    def __init__(self, file_name='pcigale.ini'):
+        """
+        Parameters
+        ----------
+        file_name : str or ``pathlib.Path``
+        """
+        self.file_name = file_name
+        with open(file_name, 'r', encoding='utf-8') as file:
+            self.lines = file.readlines()
+        # dictionary of (section, key) to the list of line indices of this key.
+        # A section is a tuple of the nested section names, e.g. ('sed_modules_params', 'bc03')
+        self.param_index = {}
+        # dictionary of key to all the sections it appears in
+        self.key_index = {}
+        self.parse()
+
+    def parse(self):
+        """
+        Function to build the index of all parameter lines
+        """
+        self.param_index = {}
+        self.key_index = {}
+        section = ()
+        for line_index, line in enumerate(self.lines):
+            section_match = self.section_pattern.match(line)
+            if section_match is not None:
+                depth = len(section_match.group(2))
+                section = section[:depth - 1] + (section_match.group(3),)
+                continue
+            param_match = self.param_pattern.match(line)
+            if param_match is None:
+                continue
+            key = param_match.group(2)
+            self.param_index.setdefault((section, key), []).append(line_index)
+            if section not in self.key_index.setdefault(key, []):
+                self.key_index[key].append(section)
+
+    @staticmethod
+    def format_value(value):
+        """
+        Function to convert a parameter value into the pcigale ini string representation
+        Parameters
+        ----------
+        value : str, bool, int, float or list
+
+        Returns
+        -------
+        value_str : str
+        """
+        if isinstance(value, (str, bool, int, float, np.generic)):
+            return str(value)
+        elif isinstance(value, (list, tuple, np.ndarray)):
+            return ', '.join([str(obj) for obj in value])
+        else:
+            raise KeyError('The given parameters mus be of type str, bool, int, float or a list of these types')
+
+    def find_section(self, key, section=None):
+        """
+        Function to find the section of a key.
+        If no section is given, the key must be unique on the lowest nesting level it appears on.
+        Parameters
+        ----------
+        key : str
+        section : tuple or str
+
+        Returns
+        -------
+        section : tuple
+        """
+        if isinstance(section, str):
+            section = (section,)
+        if key not in self.key_index:
+            raise KeyError('The parameter <<%s>> is not in the file %s' % (key, self.file_name))
+        if section is None:
+            min_depth = min(len(key_section) for key_section in self.key_index[key])
+            section_list = [key_section for key_section in self.key_index[key] if len(key_section) == min_depth]
+            if len(section_list) > 1:
+                raise KeyError('The parameter <<%s>> appears in more than one section: %s. Please specify the section'
+                               % (key, section_list))
+            section = section_list[0]
+        elif (section, key) not in self.param_index:
+            raise KeyError('The parameter <<%s>> is not in the section %s of the file %s'
+                           % (key, section, self.file_name))
+        if len(self.param_index[(section, key)]) > 1:
+            raise KeyError('There is apparently more than one line beginning with <<%s>> in the section %s'
+                           % (key, section))
+        return section
+
+    def get_param(self, key, section=None):
+        """
+        Parameters
+        ----------
+        key : str
+        section : tuple or str
+
+        Returns
+        -------
+        value_str : str
+        """
+        section = self.find_section(key=key, section=section)
+        line_index = self.param_index[(section, key)][0]
+        return self.param_pattern.match(self.lines[line_index]).group(3).strip()
+
+    def set_param(self, key, value, section=None):
+        """
+        Parameters
+        ----------
+        key : str
+        value : str, bool, int, float or list
+        section : tuple or str
+        """
+        section = self.find_section(key=key, section=section)
+        line_index = self.param_index[(section, key)][0]
+        indent = self.param_pattern.match(self.lines[line_index]).group(1)
+        self.lines[line_index] = indent + key + ' = ' + self.format_value(value=value) + '\n'
+
+    def set_params(self, param_dict, section=None):
+        """
+        Parameters
+        ----------
+        param_dict : dict
+        section : tuple or str
+        """
+        for key in param_dict.keys():
+            self.set_param(key=key, value=param_dict[key], section=section)
+
+    def apply_sim_config(self, sed_module_conf_dict=None, analysis_params=None):
+        """
+        Function to apply the configuration of all sed modules and the analysis in one pass
+        Parameters
+        ----------
+        sed_module_conf_dict : dict
+            parameters of each module are only searched in the section of this module
+        analysis_params : dict
+            parameters are searched in the analysis_params section first. Depending on the pcigale version some of
+            them (e.g. bands) are top level parameters
+        """
+        if sed_module_conf_dict is not None:
+            for module_str in sed_module_conf_dict.keys():
+                self.set_params(param_dict=sed_module_conf_dict[module_str],
+                                section=('sed_modules_params', module_str))
+        if analysis_params is not None:
+            for key in analysis_params.keys():
+                if (('analysis_params',), key) in self.param_index:
+                    self.set_param(key=key, value=analysis_params[key], section=('analysis_params',))
+                else:
+                    self.set_param(key=key, value=analysis_params[key])
+
+    def write(self, file_name=None):
+        """
+        Parameters
+        ----------
+        file_name : str or ``pathlib.Path``
+            if None the file is overwritten
+        """
+        if file_name is None:
+            file_name = self.file_name
+        with open(file_name, 'w', encoding='utf-8') as file:
+            file.writelines(self.lines)
@@ -0,0 +1,189 @@
+"""
+Functions to read CIGALE model block output
+"""
+import os
+import re
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import astropy.units as u
+from astropy.io import fits
+from astropy.table import Table
+
+
+class CigaleModelIO:
+    """
+    collection of functions to read pcigale model blocks into tables
+    """
+    @staticmethod
+    def find_model_block_files(out_path='out'):
+        """
+        Function to find all model block files which were written by pcigale sorted by their block number
+        Parameters
+        ----------
+        out_path : str or ``pathlib.Path``
+
+        Returns
+        -------
+        block_file_list : list
+        """
+        block_file_list = []
+        for file_path in Path(out_path).glob('models-block-*.fits'):
+            block_number = re.search(r'models-block-(\d+)\.fits$', file_path.name)
+            if block_number is not None:
+                block_file_list.append((int(block_number.group(1)), file_path))
+        if not block_file_list:
+            raise FileNotFoundError('No pcigale model blocks found in ' + str(out_path))
+        return [file_path for _, file_path in sorted(block_file_list)]
+
+    @staticmethod
+    def get_column_names(file_name):
+        """
+        Parameters
+        ----------
+        file_name : str or ``pathlib.Path``
+
+        Returns
+        -------
+        column_name_list : list
+        """
+        with fits.open(file_name, memmap=True) as hdu_list:
+            return list(hdu_list[1].columns.names)
+
+    @staticmethod
+    def get_column_description(file_name, column_list):
+        """
+        Function to get the number of rows, the data types and units of a list of columns without reading the data
+        Parameters
+        ----------
+        file_name : str or ``pathlib.Path``
+        column_list : list
+
+        Returns
+        -------
+        n_rows : int
+        dtype_dict : dict
+        unit_dict : dict
+        """
+        with fits.open(file_name, memmap=True) as hdu_list:
+            columns = hdu_list[1].columns
+            missing_columns = [col for col in column_list if col not in columns.names]
+            if missing_columns:
+                raise KeyError('The columns %s are not in the model file %s' % (missing_columns, file_name))
+            n_rows = hdu_list[1].header['NAXIS2']
+            dtype_dict = {col: columns[col].dtype.newbyteorder('=') for col in column_list}
+            unit_dict = {col: columns[col].unit for col in column_list}
+        return n_rows, dtype_dict, unit_dict
+
+    @staticmethod
+    def read_model_table(file_name, column_list=None, memmap=True):
+        """
+        Function to read only selected columns of a model table.
+        With memmap the binary table is memory mapped and the columns are views into the file as long as their data
+        type allows it, so that data is only loaded from disk when it is accessed. Without memmap every column is a
+        contiguous copy.
+        Parameters
+        ----------
+        file_name : str or ``pathlib.Path``
+        column_list : list
+            if None all columns are read
+        memmap : bool
+
+        Returns
+        -------
+        model_table : ``astropy.table.Table``
+        """
+        with fits.open(file_name, memmap=memmap) as hdu_list:
+            data = hdu_list[1].data
+            columns = hdu_list[1].columns
+            if column_list is None:
+                column_list = columns.names
+            missing_columns = [col for col in column_list if col not in columns.names]
+            if missing_columns:
+                raise KeyError('The columns %s are not in the model file %s' % (missing_columns, file_name))
+            if memmap:
+                # the memory map stays valid after closing the file as long as the column arrays are referenced
+                column_dict = {col: data.field(col) for col in column_list}
+            else:
+                # contiguous copies, so that the columns do not keep the whole record buffer alive
+                column_dict = {col: np.array(data.field(col)) for col in column_list}
+            unit_dict = {col: columns[col].unit for col in column_list}
+            del data
+
+        model_table = Table(column_dict, names=column_list, copy=False)
+        for col in column_list:
+            if unit_dict[col]:
+                model_table[col].unit = u.Unit(unit_dict[col], parse_strict='silent')
+        return model_table
+
+    @staticmethod
+    def read_columns_into_buffer(file_name, column_list, buffer_dict, offset):
+        """
+        Function to read a list of columns from one model block into preallocated arrays
+        Parameters
+        ----------
+        file_name : str or ``pathlib.Path``
+        column_list : list
+        buffer_dict : dict
+            arrays for each column the data is written to
+        offset : int
+            first row of the buffers to write to
+        """
+        with fits.open(file_name, memmap=True) as hdu_list:
+            data = hdu_list[1].data
+            n_rows = len(data)
+            for col in column_list:
+                buffer_dict[col][offset:offset + n_rows] = data[col]
+            del data
+
+    @staticmethod
+    def read_model_blocks(block_file_list, column_list, n_threads=None):
+        """
+        Function to read and concatenate a list of columns from many model blocks into one table.
+        The blocks are read in parallel into a single preallocated buffer per column.
+        Parameters
+        ----------
+        block_file_list : list
+        column_list : list
+        n_threads : int
+            number of threads used for reading. If None it is limited by the number of blocks and cpus
+
+        Returns
+        -------
+        model_table : ``astropy.table.Table``
+        """
+        # find the size and data types of all blocks before reading any data
+        n_rows_list = []
+        dtype_dict, unit_dict = None, None
+        for file_name in block_file_list:
+            n_rows, block_dtype_dict, block_unit_dict = CigaleModelIO.get_column_description(file_name=file_name,
+                                                                                            column_list=column_list)
+            n_rows_list.append(n_rows)
+            if dtype_dict is None:
+                dtype_dict, unit_dict = block_dtype_dict, block_unit_dict
+            else:
+                dtype_dict = {col: np.promote_types(dtype_dict[col], block_dtype_dict[col]) for col in column_list}
+        offset_list = np.concatenate([[0], np.cumsum(n_rows_list)[:-1]]).astype(int)
+
+        buffer_dict = {col: np.empty(sum(n_rows_list), dtype=dtype_dict[col]) for col in column_list}
+
+        if n_threads is None:
+            n_threads = min(len(block_file_list), os.cpu_count() or 1)
+        if n_threads > 1:
+            with ThreadPoolExecutor(max_workers=n_threads) as executor:
+                futures = [executor.submit(CigaleModelIO.read_columns_into_buffer, file_name, column_list,
+                                           buffer_dict, offset)
+                           for file_name, offset in zip(block_file_list, offset_list)]
+                for future in futures:
+                    future.result()
+        else:
+            for file_name, offset in zip(block_file_list, offset_list):
+                CigaleModelIO.read_columns_into_buffer(file_name=file_name, column_list=column_list,
+                                                       buffer_dict=buffer_dict, offset=offset)
+
+        model_table = Table(buffer_dict, names=column_list, copy=False)
+        for col in column_list:
+            if unit_dict[col]:
+                model_table[col].unit = u.Unit(unit_dict[col], parse_strict='silent')
+        return model_table
@@ -0,0 +1,223 @@
+"""
+Partitioned columnar store for CIGALE model grids
+"""
+import os
+import json
+import shutil
+from pathlib import Path
+
+import numpy as np
+import astropy.units as u
+from astropy.table import Table
+
+
+class CigaleModelStore:
+    """
+    Model grid stored as one memory-mappable .npy file per column and chunk.
+    The rows are partitioned by the values of chosen parameter columns and every chunk keeps the minimum and maximum
+    of all columns in the manifest, so that queries only open the chunks and columns they need.
+    """
+    manifest_file_name = 'store.json'
+
+    def __init__(self, store_path):
+        """
+        Parameters
+        ----------
+        store_path : str or ``pathlib.Path``
+        """
+        self.store_path = Path(store_path)
+        with open(self.store_path / self.manifest_file_name, 'r', encoding='utf-8') as file:
+            self.manifest = json.load(file)
+
+    @property
+    def column_list(self):
+        """
+        list of all column names of the store
+        """
+        return [column['name'] for column in self.manifest['column_list']]
+
+    @staticmethod
+    def get_column_file_name(column_index):
+        # column names like param.EW(Halpha) are not used as file names
+        return 'col_%04i.npy' % column_index
+
+    @staticmethod
+    def write(model_table, store_path, partition_column_list=None, max_rows_per_chunk=1000000):
+        """
+        Function to write a model table into a partitioned store. An existing store is replaced in one step.
+        Parameters
+        ----------
+        model_table : ``astropy.table.Table``
+        store_path : str or ``pathlib.Path``
+        partition_column_list : list
+            parameter columns whose values define the partitions, e.g. ['attenuation.E_BV', 'stellar.metallicity']
+        max_rows_per_chunk : int
+            partitions with more rows are split into several chunks
+
+        Returns
+        -------
+        model_store : ``CigaleModelStore``
+        """
+        store_path = Path(store_path)
+        if partition_column_list is None:
+            partition_column_list = []
+        tmp_store_path = store_path.with_name(store_path.name + '.%i.tmp' % os.getpid())
+        if os.path.isdir(tmp_store_path):
+            shutil.rmtree(tmp_store_path)
+        os.makedirs(tmp_store_path)
+
+        column_list = model_table.colnames
+        array_dict = {col: np.asarray(model_table[col]) for col in column_list}
+        if partition_column_list:
+            partition_keys = np.stack([array_dict[col] for col in partition_column_list], axis=1)
+            _, partition_index = np.unique(partition_keys, axis=0, return_inverse=True)
+            partition_index = partition_index.ravel()
+        else:
+            partition_index = np.zeros(len(model_table), dtype=int)
+        # stable sort keeps the original row order inside each partition
+        order = np.argsort(partition_index, kind='stable')
+        boundaries = np.flatnonzero(np.diff(partition_index[order])) + 1
+        row_group_list = np.split(order, boundaries) if len(order) else []
+
+        chunk_list = []
+        for row_group in row_group_list:
+            for start in range(0, len(row_group), max_rows_per_chunk):
+                rows = row_group[start:start + max_rows_per_chunk]
+                chunk_name = 'chunk_%05i' % len(chunk_list)
+                os.makedirs(tmp_store_path / chunk_name)
+                stats = {}
+                for column_index, col in enumerate(column_list):
+                    values = array_dict[col][rows]
+                    np.save(tmp_store_path / chunk_name / CigaleModelStore.get_column_file_name(column_index), values)
+                    if np.issubdtype(values.dtype, np.number) and len(values):
+                        stats[col] = [float(np.nanmin(values)), float(np.nanmax(values))]
+                chunk_list.append({'name': chunk_name, 'n_rows': int(len(rows)), 'stats': stats,
+                                   'partition': {col: stats.get(col, [None])[0] for col in partition_column_list}})
+
+        manifest = {
+            'column_list': [{'name': col, 'dtype': array_dict[col].dtype.str,
+                             'unit': None if model_table[col].unit is None else str(model_table[col].unit)}
+                            for col in column_list],
+            'partition_column_list': list(partition_column_list),
+            'n_rows': int(len(model_table)),
+            'chunk_list': chunk_list,
+        }
+        with open(tmp_store_path / CigaleModelStore.manifest_file_name, 'w', encoding='utf-8') as file:
+            json.dump(manifest, file, indent=1)
+
+        if os.path.isdir(store_path):
+            old_store_path = store_path.with_name(store_path.name + '.%i.old' % os.getpid())
+            os.replace(store_path, old_store_path)
+            os.replace(tmp_store_path, store_path)
+            shutil.rmtree(old_store_path, ignore_errors=True)
+        else:
+            os.replace(tmp_store_path, store_path)
+        return CigaleModelStore(store_path=store_path)
+
+    @staticmethod
+    def chunk_may_match(chunk, where):
+        """
+        Function to decide from the chunk statistics whether a chunk can contain matching rows
+        Parameters
+        ----------
+        chunk : dict
+        where : dict
+
+        Returns
+        -------
+        may_match : bool
+        """
+        for col, condition in where.items():
+            if col not in chunk['stats']:
+                continue
+            col_min, col_max = chunk['stats'][col]
+            if isinstance(condition, tuple):
+                low, high = condition
+                if ((low is not None) and (col_max < low)) or ((high is not None) and (col_min > high)):
+                    return False
+            else:
+                if not np.any([np.isclose(value, np.clip(value, col_min, col_max)) for value in
+                               np.atleast_1d(condition)]):
+                    return False
+        return True
+
+    @staticmethod
+    def compute_mask(values, condition):
+        """
+        Parameters
+        ----------
+        values : ``np.ndarray``
+        condition : tuple, float or list
+
+        Returns
+        -------
+        mask : ``np.ndarray``
+        """
+        if isinstance(condition, tuple):
+            low, high = condition
+            mask = np.ones(len(values), dtype=bool)
+            if low is not None:
+                mask &= values >= low
+            if high is not None:
+                mask &= values <= high
+            return mask
+        condition = np.atleast_1d(condition)
+        if np.issubdtype(values.dtype, np.number):
+            return np.any(np.isclose(values[:, None], condition[None, :].astype(float), rtol=1e-9, atol=0), axis=1)
+        return np.isin(values, condition)
+
+    def query(self, column_list=None, where=None, memmap=True):
+        """
+        Function to read the rows matching a set of conditions. Only chunks whose statistics can match are opened
+        and only the requested and condition columns are read.
+        Parameters
+        ----------
+        column_list : list
+            if None all columns are returned
+        where : dict
+            dictionary of column to a condition. A tuple (low, high) selects low <= value <= high, where None is an
+            open bound. A single value or a list selects these values, e.g.
+            {'sfh.age': (None, 10), 'attenuation.E_BV': 0.3}
+        memmap : bool
+            memory map the column files instead of reading them
+
+        Returns
+        -------
+        model_table : ``astropy.table.Table``
+        """
+        if column_list is None:
+            column_list = self.column_list
+        if where is None:
+            where = {}
+        missing_column_list = [col for col in list(column_list) + list(where.keys()) if col not in self.column_list]
+        if missing_column_list:
+            raise KeyError('The columns %s are not in the store %s' % (missing_column_list, self.store_path))
+        column_index = {col: index for index, col in enumerate(self.column_list)}
+
+        part_dict = {col: [] for col in column_list}
+        for chunk in self.manifest['chunk_list']:
+            if not self.chunk_may_match(chunk=chunk, where=where):
+                continue
+            chunk_path = self.store_path / chunk['name']
+            mask = np.ones(chunk['n_rows'], dtype=bool)
+            for col, condition in where.items():
+                values = np.load(chunk_path / self.get_column_file_name(column_index[col]),
+                                 mmap_mode='r' if memmap else None)
+                mask &= self.compute_mask(values=values, condition=condition)
+            if not np.any(mask):
+                continue
+            for col in column_list:
+                values = np.load(chunk_path / self.get_column_file_name(column_index[col]),
+                                 mmap_mode='r' if memmap else None)
+                part_dict[col].append(values[mask])
+
+        model_table = Table()
+        for col in column_list:
+            column_info = self.manifest['column_list'][column_index[col]]
+            if part_dict[col]:
+                model_table[col] = np.concatenate(part_dict[col])
+            else:
+                model_table[col] = np.zeros(0, dtype=np.dtype(column_info['dtype']))
+            if column_info['unit'] is not None:
+                model_table[col].unit = u.Unit(column_info['unit'], parse_strict='silent')
+        return model_table
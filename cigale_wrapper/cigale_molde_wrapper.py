@@ -2,16 +2,23 @@
 Cigale model wrapper main script
 """
 import os
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 from pathlib import Path
-import matplotlib.pyplot as plt
-import astropy.units as u
-from astropy.io import fits
-import astropy.constants as const
 
-from astropy.table import Table
+from astropy.table import Table, vstack
 from cigale_wrapper import cigale_helper
-from phangs_data_access import helper_func
+from cigale_wrapper import cigale_backend
+from cigale_wrapper import cigale_cache
+from cigale_wrapper import cigale_model_io
+from cigale_wrapper import cigale_grid
+from cigale_wrapper import cigale_model_store
+from cigale_wrapper import cigale_compact
+from cigale_wrapper import cigale_sed
+from cigale_wrapper import cigale_profile
 
 
 class CigaleModelWrapper:
@@ -27,9 +34,12 @@ class CigaleModelWrapper:
 
     @staticmethod
     def run_sim_cigale_model(sed_module_conf_dict, n_cores=1, output_band_dict=None, save_sed=False,
-                             delete_old_models=True):
+                             delete_old_models=True, run_path=None, scratch_path=None, backend='subprocess',
+                             recorder=None, n_workers=None):
         """
-        Function to simulate CIGALE models
+        Function to simulate CIGALE models.
+        Each run lives in its own directory holding its own pcigale.ini and output, so that several simulations can
+        run at the same time.
         Parameters
         ----------
         sed_module_conf_dict : dict
@@ -37,8 +47,32 @@ class CigaleModelWrapper:
         output_band_dict : dict
         save_sed : bool
         delete_old_models : bool
+        run_path : str
+            directory to run pcigale in. If None a new unique directory is created inside scratch_path
+        scratch_path : str
+            parent directory of the run directories. If None the system temporary directory is used
+        backend : str
+            'subprocess' runs the pcigale command line tool, 'in_process' and 'worker' use the pcigale python API in
+            this process or in a warm worker process. See ``cigale_backend.CigaleBackend``
+        recorder : ``cigale_profile.CigaleStageRecorder``
+            if given the time and memory of the pcigale stages are recorded
+        n_workers : int
+            size of the warm worker pool of the worker backend, e.g. the number of threads running simulations at once
 
+        Return
+        ------
+        run_path : ``pathlib.Path``
         """
+        # relative paths must not depend on the working directory of in-process runs of other threads
+        scratch_path = cigale_backend.CigaleBackend.resolve_path(scratch_path)
+        if run_path is None:
+            if (scratch_path is not None) and (not os.path.isdir(scratch_path)):
+                os.makedirs(scratch_path, exist_ok=True)
+            run_path = Path(tempfile.mkdtemp(prefix='cigale_run_', dir=scratch_path))
+        else:
+            run_path = cigale_backend.CigaleBackend.resolve_path(run_path)
+            if not os.path.isdir(run_path):
+                os.makedirs(run_path, exist_ok=True)
         # get all the sed modules
         sed_module_list = list(sed_module_conf_dict.keys())
         cigale_init_params = {
@@ -46,33 +80,29 @@ class CigaleModelWrapper:
             'analysis_method': 'savefluxes',
             'cores': n_cores,
         }
-        # initiate pcigale
-        os.system('pcigale init')
-        # set initial parameters
-        cigale_helper.CigaleHelper.replace_params_in_file(param_dict=cigale_init_params)
-        # configurate pcigale
-        os.system('pcigale genconf')
-        # set module configurations
-        for module_str in sed_module_conf_dict.keys():
-            print(module_str)
-            cigale_helper.CigaleHelper.replace_params_in_file(param_dict=sed_module_conf_dict[module_str])
-
         output_band_list_str = cigale_helper.CigaleHelper.create_output_band_list_str(output_band_dict=output_band_dict)
         analysis_params = {'bands': output_band_list_str, 'save_sed': save_sed}
-        cigale_helper.CigaleHelper.replace_params_in_file(param_dict=analysis_params)
-
         # run pcigale
-        os.system('pcigale run')
-        # delete old models
+        cigale_backend.CigaleBackend.run_pcigale(run_path=run_path, cigale_init_params=cigale_init_params,
+                                                 sed_module_conf_dict=sed_module_conf_dict,
+                                                 analysis_params=analysis_params, backend=backend,
+                                                 recorder=recorder, n_workers=n_workers)
+        # delete old models which pcigale moved out of the way inside this run directory
         if delete_old_models:
-            os.system('rm -rf *_out')
+            for old_output_path in run_path.glob('*_out'):
+                shutil.rmtree(old_output_path, ignore_errors=True)
+
+        return run_path
 
     @staticmethod
     def sim_cigale_model_params(sed_module_conf_dict, sed_param_list, output_band_dict, n_cores=1,
                                 data_output_path='', file_name=None, save_output=True,
-                                delete_old_models=True):
+                                delete_old_models=True, scratch_path=None, delete_run_dir=True,
+                                backend='subprocess', store_path=None, partition_column_list=None,
+                                sed_array_file=None, recorder=None, n_workers=None):
         """
-        Function to simulate CIGALE models for a specific set of parameters and access the output
+        Function to simulate CIGALE models for a specific set of parameters and access the output.
+        This function can be called from several threads or processes at once.
         Parameters
         ----------
         sed_module_conf_dict : dict
@@ -83,52 +113,151 @@ class CigaleModelWrapper:
         file_name : str
         save_output : bool
         delete_old_models : bool
+        scratch_path : str
+        delete_run_dir : bool
+            remove the run directory after the output is loaded
+        backend : str
+        store_path : str
+            if given the models are also written to a partitioned columnar store, see
+            ``cigale_model_store.CigaleModelStore``
+        partition_column_list : list
+            parameter columns used to partition the store
+        sed_array_file : str
+            if given the model spectra are saved and gathered into this memory-mappable .npy file, so that new
+            bands can be added later with ``cigale_sed.CigaleSedTools`` without re-simulating
+        recorder : ``cigale_profile.CigaleStageRecorder``
+            if given the time and memory of all stages are recorded
+        n_workers : int
+            size of the warm worker pool of the worker backend
 
         Return
         ------
         model_table : ``astropy.table.Table``
         """
-        # simulate_data
-        CigaleModelWrapper.run_sim_cigale_model(sed_module_conf_dict=sed_module_conf_dict, n_cores=n_cores,
-                                                output_band_dict=output_band_dict, delete_old_models=delete_old_models)
-        # load cigale output
-        model_table = CigaleModelWrapper.load_cigale_model_params(sed_param_list=sed_param_list,
-                                                                  output_band_dict=output_band_dict)
+        get_stage = cigale_profile.CigaleStageRecorder.get_stage
+        scratch_path = cigale_backend.CigaleBackend.resolve_path(scratch_path)
+        data_output_path = cigale_backend.CigaleBackend.resolve_path(data_output_path)
+        store_path = cigale_backend.CigaleBackend.resolve_path(store_path)
+        sed_array_file = cigale_backend.CigaleBackend.resolve_path(sed_array_file)
+        if (scratch_path is not None) and (not os.path.isdir(scratch_path)):
+            os.makedirs(scratch_path, exist_ok=True)
+        run_path = Path(tempfile.mkdtemp(prefix='cigale_run_', dir=scratch_path))
+        try:
+            # simulate_data
+            CigaleModelWrapper.run_sim_cigale_model(sed_module_conf_dict=sed_module_conf_dict, n_cores=n_cores,
+                                                    output_band_dict=output_band_dict,
+                                                    delete_old_models=delete_old_models, run_path=run_path,
+                                                    save_sed=sed_array_file is not None, backend=backend,
+                                                    recorder=recorder, n_workers=n_workers)
+            # load cigale output
+            model_table = CigaleModelWrapper.load_cigale_model_params(
+                sed_param_list=sed_param_list, output_band_dict=output_band_dict, out_path=run_path / 'out',
+                recorder=recorder)
+            if sed_array_file is not None:
+                with get_stage(recorder=recorder, stage_name='sed_array', output_path=sed_array_file) as stage_info:
+                    cigale_sed.CigaleSedTools.build_sed_array(sed_array_file=sed_array_file, out_path=run_path / 'out')
+                    stage_info['n_models'] = len(model_table)
+        finally:
+            if delete_run_dir:
+                shutil.rmtree(run_path, ignore_errors=True)
         # save table if wanted
         if save_output & (file_name is not None):
-            file_path = helper_func.FileTools.verify_suffix(file_name=Path(data_output_path) / file_name, suffix='fits')
-            if not os.path.isdir(Path(data_output_path)):
-                os.makedirs(Path(data_output_path))
-            model_table.write(file_path, overwrite=True)
+            CigaleModelWrapper.save_model_table(model_table=model_table, data_output_path=data_output_path,
+                                                file_name=file_name, recorder=recorder)
+        if store_path is not None:
+            with get_stage(recorder=recorder, stage_name='saving_store', n_models=len(model_table),
+                           output_path=store_path):
+                cigale_model_store.CigaleModelStore.write(model_table=model_table, store_path=store_path,
+                                                          partition_column_list=partition_column_list)
 
         return model_table
 
     @staticmethod
-    def load_cigale_model_params(sed_param_list, output_band_dict, model_block_file_name='out/models-block-0.fits'):
+    def save_model_table(model_table, data_output_path, file_name, recorder=None):
+        """
+        Function to save a model table as fits file. The table is written to a temporary file first so that
+        concurrent readers never see a half written table.
+        Parameters
+        ----------
+        model_table : ``astropy.table.Table``
+        data_output_path : str
+        file_name : str
+        recorder : ``cigale_profile.CigaleStageRecorder``
+
+        Return
+        ------
+        file_path : ``pathlib.Path``
+        """
+        data_output_path = cigale_backend.CigaleBackend.resolve_path(data_output_path)
+        file_path = Path(cigale_helper.CigaleHelper.verify_suffix(file_name=data_output_path / file_name,
+                                                                  suffix='fits'))
+        if not os.path.isdir(data_output_path):
+            os.makedirs(data_output_path, exist_ok=True)
+        with cigale_profile.CigaleStageRecorder.get_stage(recorder=recorder, stage_name='saving',
+                                                          n_models=len(model_table), output_path=file_path):
+            tmp_file_path = file_path.with_suffix('.%i.%i.tmp.fits' % (os.getpid(), threading.get_ident()))
+            model_table.write(tmp_file_path, overwrite=True)
+            os.replace(tmp_file_path, file_path)
+        return file_path
+
+    @staticmethod
+    def load_cigale_model_params(sed_param_list, output_band_dict, model_block_file_name=None, out_path='out',
+                                 n_threads=None, memmap=False, compact=False, recorder=None):
         """
-        load cigale model blocks output and return only needed columns
+        load cigale model blocks output and return only needed columns.
+        All model blocks found in out_path are read in parallel and concatenated.
+        With memmap a single model block is memory mapped and only the needed columns are built from it.
+        With compact, low-cardinality parameter columns are dictionary encoded and fluxes stored as float32.
         Parameters
         ----------
         sed_param_list : list
         output_band_dict : dict
         model_block_file_name : str
+            if given only this model block is read
+        out_path : str
+        n_threads : int
+        memmap : bool
+        compact : bool
+        recorder : ``cigale_profile.CigaleStageRecorder``
+            if given the loading is recorded as stage 'loading' with the in-memory size of the table as output_bytes
 
         Return
         ------
-        model_table : ``astropy.table.Table``
+        model_table : ``astropy.table.Table`` or ``cigale_compact.CompactModelTable``
         """
         # get model table with all columns which are wanted
-        model_table = Table.read(model_block_file_name)
-        param_list = cigale_helper.CigaleHelper.create_output_band_list_str(output_band_dict=output_band_dict)
-        param_list += sed_param_list
-        return model_table[param_list]
+        band_list = cigale_helper.CigaleHelper.create_output_band_list_str(output_band_dict=output_band_dict)
+        param_list = band_list + list(sed_param_list)
+        if model_block_file_name is None:
+            block_file_list = cigale_model_io.CigaleModelIO.find_model_block_files(
+                out_path=cigale_backend.CigaleBackend.resolve_path(out_path))
+        else:
+            block_file_list = [cigale_backend.CigaleBackend.resolve_path(model_block_file_name)]
+        with cigale_profile.CigaleStageRecorder.get_stage(recorder=recorder, stage_name='loading') as stage_info:
+            if memmap and (len(block_file_list) == 1):
+                model_table = cigale_model_io.CigaleModelIO.read_model_table(file_name=block_file_list[0],
+                                                                             column_list=param_list, memmap=True)
+            else:
+                model_table = cigale_model_io.CigaleModelIO.read_model_blocks(block_file_list=block_file_list,
+                                                                              column_list=param_list,
+                                                                              n_threads=n_threads)
+            stage_info['n_models'] = len(model_table)
+            stage_info['output_bytes'] = sum(np.asarray(model_table[col]).nbytes for col in param_list)
+            if compact:
+                model_table = cigale_compact.CompactModelTable(model_table=model_table, band_list=band_list)
+                stage_info['output_bytes'] = sum(model_table.get_compact_bytes(col) for col in param_list)
+        return model_table
 
     @staticmethod
     def quick_access_sim_cigale_model_params(sed_module_conf_dict, sed_param_list, output_band_dict, n_cores=1,
                                              data_output_path='', file_name=None, save_output=True,
-                                             delete_old_models=True, re_sim=False):
+                                             delete_old_models=True, re_sim=False, cache_path=None,
+                                             cache_size_budget=None, memmap=False, incremental=False):
         """
         Function to quickly access CIGALE model simulation based on a given file name.
+        If a cache_path is given, the models are looked up by a hash of the full configuration instead.
+        With incremental, a saved table is extended by the parameter combinations which are missing, see
+        extend_sim_cigale_model_params.
         Parameters
         ----------
         sed_module_conf_dict : dict
@@ -140,12 +269,48 @@ class CigaleModelWrapper:
         save_output : bool
         delete_old_models : bool
         re_sim : bool
+        cache_path : str
+        cache_size_budget : int
+            disk size budget of the cache in bytes
+        memmap : bool
+            memory map already simulated tables and only build the needed columns
+        incremental : bool
 
         Return
         ------
         model_table : ``astropy.table.Table``
         """
-        file_path = helper_func.FileTools.verify_suffix(file_name=Path(data_output_path) / file_name, suffix='fits')
+        data_output_path = cigale_backend.CigaleBackend.resolve_path(data_output_path)
+        if cache_path is not None:
+            cache_path = cigale_backend.CigaleBackend.resolve_path(cache_path)
+            cache = cigale_cache.CigaleModelCache(cache_path=cache_path, max_size_bytes=cache_size_budget)
+            config_hash = cigale_cache.CigaleModelCache.compute_config_hash(
+                sed_module_conf_dict=sed_module_conf_dict, output_band_dict=output_band_dict,
+                sed_param_list=sed_param_list)
+            if not re_sim:
+                model_table = cache.get(config_hash=config_hash, memmap=memmap)
+                if model_table is not None:
+                    return model_table
+            model_table = CigaleModelWrapper.sim_cigale_model_params(sed_module_conf_dict=sed_module_conf_dict,
+                                                                     sed_param_list=sed_param_list,
+                                                                     output_band_dict=output_band_dict,
+                                                                     n_cores=n_cores,
+                                                                     data_output_path=data_output_path,
+                                                                     file_name=file_name, save_output=save_output,
+                                                                     delete_old_models=delete_old_models)
+            cache.put(config_hash=config_hash, model_table=model_table)
+            return model_table
+
+        file_path = cigale_helper.CigaleHelper.verify_suffix(file_name=data_output_path / file_name,
+                                                             suffix='fits')
+        if incremental and os.path.isfile(file_path):
+            return CigaleModelWrapper.extend_sim_cigale_model_params(sed_module_conf_dict=sed_module_conf_dict,
+                                                                     sed_param_list=sed_param_list,
+                                                                     output_band_dict=output_band_dict,
+                                                                     n_cores=n_cores,
+                                                                     data_output_path=data_output_path,
+                                                                     file_name=file_name,
+                                                                     delete_old_models=delete_old_models)
         if (not os.path.isfile(file_path)) | re_sim:
             return CigaleModelWrapper.sim_cigale_model_params(sed_module_conf_dict=sed_module_conf_dict,
                                                               sed_param_list=sed_param_list,
@@ -154,51 +319,242 @@ class CigaleModelWrapper:
                                                               save_output=save_output,
                                                               delete_old_models=delete_old_models)
         else:
-            return Table.read(file_path)
+            param_list = cigale_helper.CigaleHelper.create_output_band_list_str(output_band_dict=output_band_dict)
+            param_list += sed_param_list
+            return cigale_model_io.CigaleModelIO.read_model_table(file_name=file_path, column_list=param_list,
+                                                                  memmap=memmap)
 
-    # !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
-    # !!!!!!! TO DO: add option to fit data points with CIGALE !!!!!!!
-    # !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
-    def create_cigale_flux_file(self, file_path, band_list, aperture_dict_list, snr=3, name_list=None,
-                                redshift_list=None, dist_list=None):
+    @staticmethod
+    def extend_sim_cigale_model_params(sed_module_conf_dict, sed_param_list, output_band_dict, n_cores=1,
+                                       data_output_path='', file_name=None, delete_old_models=True,
+                                       param_column_dict=None, scratch_path=None, backend='subprocess'):
+        """
+        Function to extend a saved model table by only simulating the parameter combinations which are not in it yet.
+        The merged table replaces the saved file atomically. Concurrent extensions of the same file are executed one
+        after another, so that no new models are lost. If the saved table is not a regular grid of its parameter
+        columns or misses a requested column, the full grid is simulated again.
+        Parameters
+        ----------
+        sed_module_conf_dict : dict
+        sed_param_list : list
+            must contain the parameter columns of all axes with more than one value
+        output_band_dict : dict
+        n_cores : int
+        data_output_path : str
+        file_name : str
+        delete_old_models : bool
+        param_column_dict : dict
+            dictionary of 'module.parameter' to output column, see ``cigale_grid.CigaleGridTools``
+        scratch_path : str
+        backend : str
 
-        if isinstance(aperture_dict_list, dict):
-            aperture_dict_list = [aperture_dict_list]
+        Return
+        ------
+        model_table : ``astropy.table.Table``
+            models of the requested configuration
+        """
+        data_output_path = cigale_backend.CigaleBackend.resolve_path(data_output_path)
+        file_path = Path(cigale_helper.CigaleHelper.verify_suffix(file_name=data_output_path / file_name,
+                                                                  suffix='fits'))
+        sim_kwargs = dict(sed_param_list=sed_param_list, output_band_dict=output_band_dict, n_cores=n_cores,
+                          delete_old_models=delete_old_models, scratch_path=scratch_path, backend=backend)
+        param_list = cigale_helper.CigaleHelper.create_output_band_list_str(output_band_dict=output_band_dict)
+        param_list += sed_param_list
+        if not os.path.isdir(data_output_path):
+            os.makedirs(data_output_path, exist_ok=True)
+        # the lock is held from reading the saved table until the merged table replaced it
+        with cigale_helper.CigaleHelper.lock_file(lock_file_name=str(file_path) + '.lock'):
+            if (not os.path.isfile(file_path)) or \
+                    (not set(param_list) <= set(cigale_model_io.CigaleModelIO.get_column_names(file_name=file_path))):
+                return CigaleModelWrapper.sim_cigale_model_params(sed_module_conf_dict=sed_module_conf_dict,
+                                                                  data_output_path=data_output_path,
+                                                                  file_name=file_name, save_output=True,
+                                                                  **sim_kwargs)
+            stored_table = cigale_model_io.CigaleModelIO.read_model_table(file_name=file_path,
+                                                                          column_list=param_list, memmap=False)
+            sub_grid_conf_list = cigale_grid.CigaleGridTools.find_missing_sub_grids(
+                sed_module_conf_dict=sed_module_conf_dict, model_table=stored_table,
+                param_column_dict=param_column_dict)
+            if sub_grid_conf_list is None:
+                return CigaleModelWrapper.sim_cigale_model_params(sed_module_conf_dict=sed_module_conf_dict,
+                                                                  data_output_path=data_output_path,
+                                                                  file_name=file_name, save_output=True,
+                                                                  **sim_kwargs)
+            if sub_grid_conf_list:
+                new_table_list = [CigaleModelWrapper.sim_cigale_model_params(sed_module_conf_dict=sub_grid_conf,
+                                                                             save_output=False, **sim_kwargs)
+                                  for sub_grid_conf in sub_grid_conf_list]
+                stored_table = vstack([stored_table] + new_table_list, join_type='exact')
+                # write to a temporary file first so that the saved grid is replaced in one step
+                tmp_file_path = file_path.with_suffix('.%i.%i.tmp.fits' % (os.getpid(), threading.get_ident()))
+                stored_table.write(tmp_file_path, overwrite=True)
+                os.replace(tmp_file_path, file_path)
 
+        mask = cigale_grid.CigaleGridTools.select_grid_models(sed_module_conf_dict=sed_module_conf_dict,
+                                                               model_table=stored_table,
+                                                               param_column_dict=param_column_dict)
+        return stored_table[mask]
+
+    # fitting mode: fit observed fluxes with CIGALE
+    @staticmethod
+    def create_cigale_flux_file(file_path, band_list, flux, flux_err, name_list=None, redshift_list=None,
+                                dist_list=None):
+        """
+        Function to create a pcigale input catalogue. The whole file is built column wise and written at once.
+        Parameters
+        ----------
+        file_path : str or ``pathlib.Path``
+        band_list : list
+            cigale band names, e.g. created with ``cigale_helper.CigaleHelper.create_output_band_list_str``
+        flux : array-like
+            fluxes in mJy of shape (n_objects, n_bands)
+        flux_err : array-like
+            flux uncertainties in mJy of shape (n_objects, n_bands)
+        name_list : array-like
+            if None the objects are numbered
+        redshift_list : array-like
+            if None all redshifts are 0
+        dist_list : array-like
+            distances in Mpc. If None the distance column is not written and pcigale computes it from the redshift
+        """
+        flux = np.atleast_2d(np.asarray(flux, dtype=float))
+        flux_err = np.atleast_2d(np.asarray(flux_err, dtype=float))
+        n_objects = flux.shape[0]
+        if (flux.shape != flux_err.shape) or (flux.shape[1] != len(band_list)):
+            raise KeyError('flux and flux_err must be of shape (n_objects, n_bands) with n_bands = len(band_list)')
         if name_list is None:
-            name_list = np.arange(start=0,  stop=len(aperture_dict_list)+1)
+            name_list = np.arange(n_objects)
         if redshift_list is None:
-            redshift_list = [0.0] * len(aperture_dict_list)
-        if dist_list is None:
-            dist_list = [self.dist_dict[self.target_name]['dist']] * len(aperture_dict_list)
+            redshift_list = np.zeros(n_objects)
 
-        name_list = np.array(name_list, dtype=str)
-        redshift_list = np.array(redshift_list)
-        dist_list = np.array(dist_list)
+        header = '# id redshift'
+        row_str = np.char.add(np.asarray(name_list).astype(str), ' ')
+        row_str = np.char.add(row_str, np.char.mod('%.6f', np.asarray(redshift_list, dtype=float)))
+        if dist_list is not None:
+            header += ' distance'
+            row_str = np.char.add(np.char.add(row_str, ' '),
+                                  np.char.mod('%.6f', np.asarray(dist_list, dtype=float)))
+        for band_index, band_name in enumerate(band_list):
+            header += ' ' + band_name + ' ' + band_name + '_err'
+            row_str = np.char.add(np.char.add(row_str, ' '), np.char.mod('%.15e', flux[:, band_index]))
+            row_str = np.char.add(np.char.add(row_str, ' '), np.char.mod('%.15e', flux_err[:, band_index]))
 
+        with open(file_path, 'w', encoding='utf-8') as flux_file:
+            flux_file.write(header + '\n' + '\n'.join(row_str.tolist()) + '\n')
 
-        # create flux file
-        flux_file = open(file_path, "w")
-        # add header for all variables
-        band_name_list = self.compute_cigale_band_name_list(band_list=band_list)
-        flux_file.writelines("# id             redshift  distance   ")
-        for band_name in band_name_list:
-            flux_file.writelines(band_name + "   ")
-            flux_file.writelines(band_name + "_err" + "   ")
-        flux_file.writelines(" \n")
-
-        # fill flux file
-        for name, redshift, dist, aperture_dict in zip(name_list, redshift_list, dist_list, aperture_dict_list):
-            flux_file.writelines(" %s   %f   %f  " % (name, redshift, dist))
-            flux_list, flux_err_list = self.compute_cigale_flux_list(band_list=band_list, aperture_dict=aperture_dict,
-                                                                     snr=snr)
-            for flux, flux_err in zip(flux_list, flux_err_list):
-                flux_file.writelines("%.15f   " % flux)
-                flux_file.writelines("%.15f   " % flux_err)
-            flux_file.writelines(" \n")
-
-        flux_file.close()
+    @staticmethod
+    def run_fit_cigale_shard(sed_module_conf_dict, band_list, flux, flux_err, name_list, redshift_list, dist_list,
+                             n_cores=1, analysis_params=None, scratch_path=None, backend='subprocess',
+                             n_workers=None):
+        """
+        Function to fit one catalogue shard with the pcigale pdf_analysis in its own run directory
+        Parameters
+        ----------
+        sed_module_conf_dict : dict
+        band_list : list
+        flux : ``np.ndarray``
+        flux_err : ``np.ndarray``
+        name_list : ``np.ndarray``
+        redshift_list : ``np.ndarray``
+        dist_list : ``np.ndarray``
+        n_cores : int
+        analysis_params : dict
+        scratch_path : str
+        backend : str
+        n_workers : int
+            size of the warm worker pool of the worker backend
 
+        Return
+        ------
+        result_table : ``astropy.table.Table``
+            rows are in the order of name_list
+        """
+        scratch_path = cigale_backend.CigaleBackend.resolve_path(scratch_path)
+        run_path = Path(tempfile.mkdtemp(prefix='cigale_fit_', dir=scratch_path))
+        try:
+            CigaleModelWrapper.create_cigale_flux_file(file_path=run_path / 'observations.txt', band_list=band_list,
+                                                       flux=flux, flux_err=flux_err, name_list=name_list,
+                                                       redshift_list=redshift_list, dist_list=dist_list)
+            cigale_init_params = {
+                'data_file': 'observations.txt',
+                'sed_modules': list(sed_module_conf_dict.keys()),
+                'analysis_method': 'pdf_analysis',
+                'cores': n_cores,
+            }
+            cigale_backend.CigaleBackend.run_pcigale(run_path=run_path, cigale_init_params=cigale_init_params,
+                                                     sed_module_conf_dict=sed_module_conf_dict,
+                                                     analysis_params=analysis_params, backend=backend,
+                                                     n_workers=n_workers)
+            result_table = Table.read(run_path / 'out' / 'results.fits')
+        finally:
+            shutil.rmtree(run_path, ignore_errors=True)
+        # bring the results in the order of the input catalogue
+        row_index = {str(name): index for index, name in enumerate(np.asarray(result_table['id']).astype(str))}
+        return result_table[[row_index[str(name)] for name in name_list]]
 
+    @staticmethod
+    def fit_cigale_data(sed_module_conf_dict, band_list, flux, flux_err, name_list=None, redshift_list=None,
+                        dist_list=None, n_cores=1, n_shards=1, n_parallel_shards=None, analysis_params=None,
+                        scratch_path=None, backend='subprocess'):
+        """
+        Function to fit a catalogue of observed fluxes with CIGALE.
+        Large catalogues are split into shards which are fitted in parallel and merged back in the input order.
+        Parameters
+        ----------
+        sed_module_conf_dict : dict
+        band_list : list
+        flux : array-like
+            fluxes in mJy of shape (n_objects, n_bands)
+        flux_err : array-like
+        name_list : array-like
+            object ids, must be unique
+        redshift_list : array-like
+        dist_list : array-like
+            distances in Mpc
+        n_cores : int
+            pcigale cores of each shard
+        n_shards : int
+        n_parallel_shards : int
+            number of shards fitted at the same time. If None all shards run at once
+        analysis_params : dict
+            parameters of the pdf_analysis section, e.g. {'variables': [...], 'save_best_sed': False}
+        scratch_path : str
+        backend : str
 
+        Return
+        ------
+        result_table : ``astropy.table.Table``
+        """
+        flux = np.atleast_2d(np.asarray(flux, dtype=float))
+        flux_err = np.atleast_2d(np.asarray(flux_err, dtype=float))
+        n_objects = flux.shape[0]
+        name_list = np.arange(n_objects) if name_list is None else np.asarray(name_list)
+        if len(np.unique(name_list.astype(str))) != n_objects:
+            raise KeyError('The object names must be unique')
+        redshift_list = np.zeros(n_objects) if redshift_list is None else np.asarray(redshift_list, dtype=float)
+        if dist_list is not None:
+            dist_list = np.asarray(dist_list, dtype=float)
+        scratch_path = cigale_backend.CigaleBackend.resolve_path(scratch_path)
+        if (scratch_path is not None) and (not os.path.isdir(scratch_path)):
+            os.makedirs(scratch_path, exist_ok=True)
 
+        shard_index_list = [index for index in np.array_split(np.arange(n_objects), max(1, n_shards)) if len(index)]
+        if n_parallel_shards is None:
+            n_parallel_shards = len(shard_index_list)
+        n_parallel_shards = max(1, min(n_parallel_shards, len(shard_index_list)))
+        shard_kwargs_list = [dict(sed_module_conf_dict=sed_module_conf_dict, band_list=band_list,
+                                  flux=flux[index], flux_err=flux_err[index], name_list=name_list[index],
+                                  redshift_list=redshift_list[index],
+                                  dist_list=None if dist_list is None else dist_list[index],
+                                  n_cores=n_cores, analysis_params=analysis_params, scratch_path=scratch_path,
+                                  backend=backend, n_workers=n_parallel_shards)
+                             for index in shard_index_list]
+        # pcigale runs in its own processes, so threads are enough to keep all shards going. The worker backend
+        # needs one warm worker per shard running at the same time
+        with ThreadPoolExecutor(max_workers=n_parallel_shards) as executor:
+            futures = [executor.submit(CigaleModelWrapper.run_fit_cigale_shard, **shard_kwargs)
+                       for shard_kwargs in shard_kwargs_list]
+            result_table_list = [future.result() for future in futures]
+        if len(result_table_list) == 1:
+            return result_table_list[0]
+        return vstack(result_table_list, join_type='exact')
@@ -0,0 +1,292 @@
+"""
+Vectorized Monte Carlo generator of synthetic cluster populations on a CIGALE model grid
+"""
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from astropy.table import Table
+
+from cigale_wrapper import cigale_helper
+from cigale_wrapper import cigale_emulator
+
+
+# generator and chunk parameters of a worker process, sent once per worker by the pool initializer
+_worker_generator = None
+_worker_chunk_kwargs = None
+
+
+class CigalePopulationGenerator:
+    """
+    Generator of mock catalogues drawn from distributions of the stellar mass, the distance and the grid parameters
+    like age and extinction. Each draw is mapped to the nearest grid model or to fluxes interpolated between the
+    grid models and rescaled to its mass and distance.
+    The objects are generated in chunks. Chunk i always uses the random stream SeedSequence(seed, spawn_key=(i,)),
+    so that a catalogue is reproducible for the same seed and chunk size, independent of the process the chunk is
+    generated in.
+    """
+    def __init__(self, model_table, band_list, axis_list, mode='nearest', log_axis_list=('sfh.age',)):
+        """
+        Parameters
+        ----------
+        model_table : ``astropy.table.Table``
+            must contain every combination of the axis values exactly once and the columns stellar.m_star and
+            universe.luminosity_distance
+        band_list : list
+        axis_list : list
+            parameter columns spanning the grid, e.g. ['sfh.age', 'attenuation.E_BV']
+        mode : str
+            'nearest' to use the closest grid model or 'interpolate' to interpolate the fluxes between the models
+            with ``cigale_emulator.CigaleGridEmulator``
+        log_axis_list : list or tuple
+            axes on which the distance to the grid values is measured in log10
+        """
+        if mode not in ['nearest', 'interpolate']:
+            raise KeyError('mode must be nearest or interpolate')
+        self.band_list = list(band_list)
+        self.axis_list = list(axis_list)
+        self.mode = mode
+        self.log_axis_list = [axis for axis in log_axis_list if axis in self.axis_list]
+        # model fluxes of one solar mass at one meter, which only need to be scaled by mass / distance ** 2
+        flux_norm = cigale_helper.CigaleHelper.compute_sim_model_flux_norm(model_table=model_table,
+                                                                            band_list=self.band_list)
+        self.axis_values = {axis: np.unique(np.asarray(model_table[axis], dtype=float)) for axis in self.axis_list}
+        grid_shape = tuple(len(self.axis_values[axis]) for axis in self.axis_list)
+        if np.prod(grid_shape) != len(model_table):
+            raise KeyError('The model table with %i rows is not a regular grid of shape %s'
+                           % (len(model_table), grid_shape))
+        grid_index = tuple(np.searchsorted(self.axis_values[axis], np.asarray(model_table[axis], dtype=float))
+                           for axis in self.axis_list)
+        flat_index = np.ravel_multi_index(grid_index, grid_shape)
+        if len(np.unique(flat_index)) != len(model_table):
+            raise KeyError('The model table contains parameter combinations more than once')
+        # row of the model table for each grid cell
+        self.grid_model_index = np.empty(len(model_table), dtype=int)
+        self.grid_model_index[flat_index] = np.arange(len(model_table))
+        self.grid_shape = grid_shape
+        self.flux_norm = flux_norm
+
+        self.emulator = None
+        if mode == 'interpolate':
+            norm_table = Table({axis: np.asarray(model_table[axis], dtype=float) for axis in self.axis_list})
+            for band_index, band in enumerate(self.band_list):
+                norm_table['norm.' + band] = flux_norm[:, band_index]
+            self.emulator = cigale_emulator.CigaleGridEmulator(model_table=norm_table, axis_list=self.axis_list,
+                                                               output_list=['norm.' + band for band in self.band_list],
+                                                               log_axis_list=self.log_axis_list)
+
+    @staticmethod
+    def sample_power_law(rng, size, alpha=-2.0, low=1e3, high=1e7):
+        """
+        Function to draw from a power law dN/dx ~ x**alpha between low and high, e.g. a cluster mass function.
+        Use it with ``functools.partial`` to keep the distribution picklable for several processes.
+        Parameters
+        ----------
+        rng : ``np.random.Generator``
+        size : int
+        alpha : float
+        low : float
+        high : float
+
+        Returns
+        -------
+        values : ``np.ndarray``
+        """
+        uniform = rng.uniform(size=size)
+        if np.isclose(alpha, -1):
+            return low * (high / low) ** uniform
+        exponent = alpha + 1
+        return (low ** exponent + uniform * (high ** exponent - low ** exponent)) ** (1 / exponent)
+
+    def get_nearest_model_index(self, param_dict):
+        """
+        Function to find the closest grid model of each draw. Draws outside the grid get the model at the edge.
+        Draws on logarithmic axes must be positive.
+        Parameters
+        ----------
+        param_dict : dict
+            array of drawn values for each axis
+
+        Returns
+        -------
+        model_index : ``np.ndarray``
+        """
+        grid_index = []
+        for axis in self.axis_list:
+            axis_values = self.axis_values[axis]
+            values = np.asarray(param_dict[axis], dtype=float)
+            if axis in self.log_axis_list:
+                if np.any(~(values > 0)):
+                    raise ValueError('The draws of the logarithmic axis %s must be positive' % axis)
+                axis_values = np.log10(axis_values)
+                values = np.log10(values)
+            # the nearest grid value is found by comparing with the midpoints between the grid values
+            grid_index.append(np.searchsorted((axis_values[1:] + axis_values[:-1]) / 2, values))
+        return self.grid_model_index[np.ravel_multi_index(tuple(grid_index), self.grid_shape)]
+
+    def get_chunk_size(self, max_memory_bytes=2**28):
+        """
+        Parameters
+        ----------
+        max_memory_bytes : int
+
+        Returns
+        -------
+        chunk_size : int
+        """
+        # fluxes, errors and noisy fluxes of every band, the drawn parameters and the draws of the noise
+        n_values_per_object = 4 * len(self.band_list) + len(self.axis_list) + 4
+        return max(1, int(max_memory_bytes // (8 * n_values_per_object)))
+
+    def generate_chunk(self, chunk_index, chunk_size, n_objects, mass_distribution, dist_distribution,
+                       param_distribution_dict, seed=None, rel_flux_err=None, flux_err_floor=None):
+        """
+        Function to generate the objects of one chunk
+        Parameters
+        ----------
+        chunk_index : int
+        chunk_size : int
+        n_objects : int
+            total number of objects of the catalogue
+        mass_distribution : callable
+            called as mass_distribution(rng, size) and returns stellar masses in M_sun
+        dist_distribution : callable
+            called as dist_distribution(rng, size) and returns distances in Mpc
+        param_distribution_dict : dict
+            callable of the same form for each axis. Axes with a single grid value can be omitted
+        seed : int
+        rel_flux_err : float or dict
+            relative flux uncertainty, for all bands or as dictionary per band. If this or flux_err_floor is given
+            gaussian noise is added
+        flux_err_floor : float or dict
+            minimal flux uncertainty in the flux unit of the models
+
+        Returns
+        -------
+        population_table : ``astropy.table.Table``
+        """
+        rng = np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(chunk_index,)))
+        size = max(0, min(chunk_size, n_objects - chunk_index * chunk_size))
+        mstar = np.asarray(mass_distribution(rng, size), dtype=float)
+        dist = np.asarray(dist_distribution(rng, size), dtype=float)
+        param_dict = {}
+        for axis in self.axis_list:
+            if axis in param_distribution_dict:
+                param_dict[axis] = np.asarray(param_distribution_dict[axis](rng, size), dtype=float)
+            elif len(self.axis_values[axis]) == 1:
+                param_dict[axis] = np.full(size, self.axis_values[axis][0])
+            else:
+                raise KeyError('No distribution is given for the axis %s' % axis)
+
+        population_table = Table()
+        population_table['stellar.m_star'] = mstar
+        population_table['distance'] = dist
+        for axis in self.axis_list:
+            population_table[axis] = param_dict[axis]
+
+        target_factor = mstar / (dist * cigale_helper.mpc_to_m) ** 2
+        if self.mode == 'nearest':
+            model_index = self.get_nearest_model_index(param_dict=param_dict)
+            population_table['model_index'] = model_index
+            flux = self.flux_norm[model_index] * target_factor[:, None]
+        else:
+            norm_dict = self.emulator.predict(param_dict={axis: param_dict[axis]
+                                                          for axis in self.emulator.interp_axis_list})
+            flux = np.stack([norm_dict['norm.' + band] for band in self.band_list], axis=1) * target_factor[:, None]
+
+        add_noise = (rel_flux_err is not None) or (flux_err_floor is not None)
+        for band_index, band in enumerate(self.band_list):
+            population_table[band] = flux[:, band_index]
+            if add_noise:
+                band_rel_err = rel_flux_err.get(band, 0) if isinstance(rel_flux_err, dict) else (rel_flux_err or 0)
+                band_err_floor = flux_err_floor.get(band, 0) if isinstance(flux_err_floor, dict) \
+                    else (flux_err_floor or 0)
+                flux_err = np.sqrt((band_rel_err * flux[:, band_index]) ** 2 + band_err_floor ** 2)
+                population_table[band + 'err'] = flux_err
+                population_table['obs.' + band] = flux[:, band_index] + rng.normal(size=size) * flux_err
+        return population_table
+
+    @staticmethod
+    def _init_worker(generator, chunk_kwargs):
+        global _worker_generator, _worker_chunk_kwargs
+        _worker_generator = generator
+        _worker_chunk_kwargs = chunk_kwargs
+
+    @staticmethod
+    def _generate_chunk_in_worker(chunk_index):
+        return _worker_generator.generate_chunk(chunk_index=chunk_index, **_worker_chunk_kwargs)
+
+    def iter_population(self, n_objects, mass_distribution, dist_distribution, param_distribution_dict, seed=None,
+                        rel_flux_err=None, flux_err_floor=None, chunk_size=None, max_memory_bytes=2**28):
+        """
+        Function to iterate over the chunks of a catalogue, so that the memory usage stays bounded
+        Parameters
+        ----------
+        n_objects : int
+        mass_distribution : callable
+        dist_distribution : callable
+        param_distribution_dict : dict
+        seed : int
+        rel_flux_err : float or dict
+        flux_err_floor : float or dict
+        chunk_size : int
+            if None it is computed from max_memory_bytes
+        max_memory_bytes : int
+
+        Yields
+        ------
+        population_table : ``astropy.table.Table``
+        """
+        if chunk_size is None:
+            chunk_size = self.get_chunk_size(max_memory_bytes=max_memory_bytes)
+        for chunk_index in range(int(np.ceil(n_objects / chunk_size))):
+            yield self.generate_chunk(chunk_index=chunk_index, chunk_size=chunk_size, n_objects=n_objects,
+                                      mass_distribution=mass_distribution, dist_distribution=dist_distribution,
+                                      param_distribution_dict=param_distribution_dict, seed=seed,
+                                      rel_flux_err=rel_flux_err, flux_err_floor=flux_err_floor)
+
+    def generate(self, n_objects, mass_distribution, dist_distribution, param_distribution_dict, seed=None,
+                 rel_flux_err=None, flux_err_floor=None, chunk_size=None, max_memory_bytes=2**28, n_processes=1):
+        """
+        Function to generate a full catalogue
+        Parameters
+        ----------
+        n_objects : int
+        mass_distribution : callable
+        dist_distribution : callable
+        param_distribution_dict : dict
+        seed : int
+            with the same seed and chunk size the catalogue is the same for any number of processes
+        rel_flux_err : float or dict
+        flux_err_floor : float or dict
+        chunk_size : int
+        max_memory_bytes : int
+            memory budget of one chunk
+        n_processes : int
+            number of processes generating chunks. The distributions must be picklable, e.g. module level functions
+            or ``functools.partial`` objects
+
+        Returns
+        -------
+        population_table : ``astropy.table.Table``
+        """
+        if chunk_size is None:
+            chunk_size = self.get_chunk_size(max_memory_bytes=max_memory_bytes)
+        n_chunks = int(np.ceil(n_objects / chunk_size))
+        chunk_kwargs = dict(chunk_size=chunk_size, n_objects=n_objects, mass_distribution=mass_distribution,
+                            dist_distribution=dist_distribution, param_distribution_dict=param_distribution_dict,
+                            seed=seed, rel_flux_err=rel_flux_err, flux_err_floor=flux_err_floor)
+        if (n_processes > 1) and (n_chunks > 1):
+            # the generator with its model grid is sent once to every worker and not with every chunk
+            with ProcessPoolExecutor(max_workers=min(n_processes, n_chunks),
+                                     initializer=CigalePopulationGenerator._init_worker,
+                                     initargs=(self, chunk_kwargs)) as executor:
+                future_list = [executor.submit(CigalePopulationGenerator._generate_chunk_in_worker, chunk_index)
+                               for chunk_index in range(n_chunks)]
+                chunk_table_list = [future.result() for future in future_list]
+        else:
+            chunk_table_list = [self.generate_chunk(chunk_index=chunk_index, **chunk_kwargs)
+                                for chunk_index in range(max(1, n_chunks))]
+        population_table = Table()
+        for col in chunk_table_list[0].colnames:
+            population_table[col] = np.concatenate([np.asarray(chunk_table[col]) for chunk_table in chunk_table_list])
+        return population_table
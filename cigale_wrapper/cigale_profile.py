@@ -0,0 +1,373 @@
+"""
+Stage-level timing and memory instrumentation of the simulation pipeline
+"""
+import os
+import sys
+import json
+import time
+import threading
+import subprocess
+import contextlib
+from pathlib import Path
+
+
+class RssSampler:
+    """
+    Thread which samples the resident memory of this process, or of another process and all its descendants, to
+    find its peak during a stage
+    """
+    def __init__(self, interval=0.05, pid=None):
+        """
+        Parameters
+        ----------
+        interval : float
+            time between two samples in seconds
+        pid : int
+            if given the summed memory of this process and of all its descendants is sampled, e.g. of a pcigale
+            subprocess with its worker processes. If None this process is sampled
+        """
+        self.interval = interval
+        self.pid = pid
+        self.start_rss_bytes = self.get_current_rss_bytes() if pid is None else self.get_tree_rss_bytes(pid=pid)
+        self.peak_rss_bytes = self.start_rss_bytes
+        self._stop_event = threading.Event()
+        self._thread = None
+        if self.start_rss_bytes is not None:
+            self._thread = threading.Thread(target=self._sample, daemon=True)
+            self._thread.start()
+
+    @staticmethod
+    def get_current_rss_bytes():
+        """
+        Returns
+        -------
+        rss_bytes : int or None
+            current resident memory of this process. None on systems without /proc
+        """
+        try:
+            with open('/proc/self/statm', 'r', encoding='utf-8') as file:
+                return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except (OSError, ValueError, IndexError, AttributeError):
+            return None
+
+    @staticmethod
+    def get_tree_rss_bytes(pid):
+        """
+        Parameters
+        ----------
+        pid : int
+
+        Returns
+        -------
+        rss_bytes : int or None
+            summed resident memory of the process and all its descendants. None on systems without /proc and 0 if
+            the process has already finished
+        """
+        if not os.path.isdir('/proc'):
+            return None
+        child_dict = {}
+        for proc_path in Path('/proc').iterdir():
+            if not proc_path.name.isdigit():
+                continue
+            try:
+                with open(proc_path / 'stat', 'r', encoding='utf-8') as file:
+                    # the process name in brackets may contain spaces, the parent pid is the second field after it
+                    parent_pid = int(file.read().rsplit(')', 1)[1].split()[1])
+            except (OSError, ValueError, IndexError):
+                continue
+            child_dict.setdefault(parent_pid, []).append(int(proc_path.name))
+        rss_bytes = 0
+        pid_list = [pid]
+        while pid_list:
+            current_pid = pid_list.pop()
+            pid_list += child_dict.get(current_pid, [])
+            try:
+                with open('/proc/%i/statm' % current_pid, 'r', encoding='utf-8') as file:
+                    rss_bytes += int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+            except (OSError, ValueError, IndexError):
+                continue
+        return rss_bytes
+
+    def get_sample(self):
+        """
+        Returns
+        -------
+        rss_bytes : int
+            current resident memory of the sampled process
+        """
+        if self.pid is None:
+            return self.get_current_rss_bytes() or 0
+        return self.get_tree_rss_bytes(pid=self.pid) or 0
+
+    def _sample(self):
+        while not self._stop_event.wait(self.interval):
+            self.peak_rss_bytes = max(self.peak_rss_bytes, self.get_sample())
+
+    def stop(self):
+        """
+        Returns
+        -------
+        peak_rss_bytes : int or None
+            peak resident memory since the sampler was started
+        """
+        if self._thread is None:
+            return None
+        self._stop_event.set()
+        self._thread.join()
+        self.peak_rss_bytes = max(self.peak_rss_bytes, self.get_sample())
+        return self.peak_rss_bytes
+
+
+class CigaleStageRecorder:
+    """
+    Recorder for the wall time, cpu time, peak memory, number of models and output size of pipeline stages like
+    pcigale init, genconf, ini editing, run, loading and saving.
+    Every finished stage is kept in self.record_list and, if a log file is given, appended to it as one json line.
+    Optionally each stage is profiled with cProfile.
+    The peak memory of a stage is sampled in a thread, as the maximum resident memory of the operating system only
+    covers the whole lifetime of a process.
+    """
+    def __init__(self, log_file=None, profile_path=None, run_info=None, rss_sample_interval=0.05):
+        """
+        Parameters
+        ----------
+        log_file : str or ``pathlib.Path``
+            json lines file the records are appended to
+        profile_path : str or ``pathlib.Path``
+            if given every stage is profiled with cProfile and the statistics are written to
+            <profile_path>/<stage>_<n>.prof. Stages running while another stage is profiled, e.g. nested stages or
+            stages of other threads, are not profiled.
+        run_info : dict
+            additional information stored with every record, e.g. the name of the grid configuration
+        rss_sample_interval : float
+            time between two memory samples of a stage in seconds. If None the memory is not sampled
+        """
+        self.log_file = None if log_file is None else Path(log_file)
+        self.profile_path = None if profile_path is None else Path(profile_path)
+        self.run_info = {} if run_info is None else dict(run_info)
+        self.rss_sample_interval = rss_sample_interval
+        self.record_list = []
+        self._lock = threading.Lock()
+        self._profiling = False
+
+    @staticmethod
+    def get_resource_usage():
+        """
+        Function to get the cpu time and the maximum resident memory over the lifetime of this process and of its
+        largest finished child process
+
+        Returns
+        -------
+        usage_dict : dict
+            cpu_time and children_cpu_time in seconds, process_max_rss_bytes and children_max_rss_bytes.
+            The memory is None on systems without the resource module
+        """
+        process_times = os.times()
+        usage_dict = {'cpu_time': process_times.user + process_times.system,
+                      'children_cpu_time': process_times.children_user + process_times.children_system,
+                      'process_max_rss_bytes': None, 'children_max_rss_bytes': None}
+        try:
+            import resource
+        except ImportError:
+            return usage_dict
+        # ru_maxrss is given in bytes on macOS and in kilobytes elsewhere
+        rss_factor = 1 if sys.platform == 'darwin' else 1024
+        usage_dict['process_max_rss_bytes'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * rss_factor
+        usage_dict['children_max_rss_bytes'] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * rss_factor
+        return usage_dict
+
+    @staticmethod
+    def get_path_bytes(path):
+        """
+        Parameters
+        ----------
+        path : str or ``pathlib.Path``
+            file or directory
+
+        Returns
+        -------
+        n_bytes : int
+        """
+        path = Path(path)
+        if path.is_file():
+            return path.stat().st_size
+        if path.is_dir():
+            return sum(file_path.stat().st_size for file_path in path.rglob('*') if file_path.is_file())
+        return 0
+
+    @contextlib.contextmanager
+    def stage(self, stage_name, n_models=None, output_path=None):
+        """
+        Context manager to record one stage. The yielded dictionary can be updated inside the stage with n_models,
+        output_bytes or any other value which is known only at the end.
+        The record holds the resident memory of this process at the start and its sampled peak during the stage as
+        start_rss_bytes and peak_rss_bytes, as well as the lifetime maxima process_max_rss_bytes and
+        children_max_rss_bytes of the operating system. Stages running a subprocess through run_subprocess also
+        hold the sampled peak of the subprocess and its descendants as subprocess_peak_rss_bytes.
+        Parameters
+        ----------
+        stage_name : str
+        n_models : int
+        output_path : str or ``pathlib.Path``
+            file or directory whose size is recorded as output_bytes at the end of the stage
+
+        Yields
+        ------
+        stage_info : dict
+        """
+        stage_info = {'n_models': n_models}
+        profiler = None
+        if self.profile_path is not None:
+            with self._lock:
+                if not self._profiling:
+                    import cProfile
+                    profiler = cProfile.Profile()
+                    self._profiling = True
+        rss_sampler = None if self.rss_sample_interval is None else RssSampler(interval=self.rss_sample_interval)
+        start_usage = self.get_resource_usage()
+        start_time = time.time()
+        start_counter = time.perf_counter()
+        if profiler is not None:
+            profiler.enable()
+        status = 'ok'
+        try:
+            yield stage_info
+        except BaseException:
+            status = 'failed'
+            raise
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            wall_time = time.perf_counter() - start_counter
+            peak_rss_bytes = None if rss_sampler is None else rss_sampler.stop()
+            end_usage = self.get_resource_usage()
+            record = dict(self.run_info)
+            record.update({
+                'stage': stage_name,
+                'status': status,
+                'start_time': start_time,
+                'wall_time': wall_time,
+                'cpu_time': end_usage['cpu_time'] - start_usage['cpu_time'],
+                'children_cpu_time': end_usage['children_cpu_time'] - start_usage['children_cpu_time'],
+                'start_rss_bytes': None if rss_sampler is None else rss_sampler.start_rss_bytes,
+                'peak_rss_bytes': peak_rss_bytes,
+                'process_max_rss_bytes': end_usage['process_max_rss_bytes'],
+                'children_max_rss_bytes': end_usage['children_max_rss_bytes'],
+                'output_bytes': None,
+            })
+            if output_path is not None:
+                record['output_bytes'] = self.get_path_bytes(output_path)
+            record.update(stage_info)
+            if (record['n_models'] is not None) and (wall_time > 0):
+                record['models_per_second'] = record['n_models'] / wall_time
+            self.add_record(record=record, profiler=profiler)
+
+    def add_record(self, record, profiler=None):
+        """
+        Parameters
+        ----------
+        record : dict
+        profiler : ``cProfile.Profile``
+        """
+        with self._lock:
+            if profiler is not None:
+                os.makedirs(self.profile_path, exist_ok=True)
+                record['profile_file'] = str(self.profile_path / ('%s_%i.prof' % (record['stage'],
+                                                                                  len(self.record_list))))
+                profiler.dump_stats(record['profile_file'])
+                self._profiling = False
+            self.record_list.append(record)
+            if self.log_file is not None:
+                if not os.path.isdir(self.log_file.parent):
+                    os.makedirs(self.log_file.parent, exist_ok=True)
+                with open(self.log_file, 'a', encoding='utf-8') as file:
+                    file.write(json.dumps(record, default=str) + '\n')
+
+    @staticmethod
+    def run_subprocess(command_list, cwd, stage_info, recorder=None):
+        """
+        Function to run a command as a subprocess, sampling the peak memory of the subprocess and its descendants
+        into stage_info. A failing command raises a ``subprocess.CalledProcessError``
+        Parameters
+        ----------
+        command_list : list
+        cwd : str or ``pathlib.Path``
+        stage_info : dict
+            yielded by the stage the subprocess runs in
+        recorder : ``CigaleStageRecorder`` or None
+            if None or without a memory sampling interval the memory is not sampled
+        """
+        process = subprocess.Popen(command_list, cwd=cwd)
+        rss_sampler = None
+        if (recorder is not None) and (recorder.rss_sample_interval is not None):
+            rss_sampler = RssSampler(interval=recorder.rss_sample_interval, pid=process.pid)
+        try:
+            return_code = process.wait()
+        except BaseException:
+            process.kill()
+            process.wait()
+            raise
+        finally:
+            if rss_sampler is not None:
+                stage_info['subprocess_peak_rss_bytes'] = rss_sampler.stop()
+        if return_code != 0:
+            raise subprocess.CalledProcessError(return_code, command_list)
+
+    @staticmethod
+    def get_stage(recorder, stage_name, n_models=None, output_path=None):
+        """
+        Function to get the stage context manager of a recorder which may be None
+        Parameters
+        ----------
+        recorder : ``CigaleStageRecorder`` or None
+        stage_name : str
+        n_models : int
+        output_path : str or ``pathlib.Path``
+
+        Returns
+        -------
+        stage : context manager
+        """
+        if recorder is None:
+            return contextlib.nullcontext({})
+        return recorder.stage(stage_name=stage_name, n_models=n_models, output_path=output_path)
+
+    def to_table(self):
+        """
+        Returns
+        -------
+        record_table : ``astropy.table.Table``
+        """
+        return self.records_to_table(record_list=self.record_list)
+
+    @staticmethod
+    def records_to_table(record_list):
+        """
+        Parameters
+        ----------
+        record_list : list
+
+        Returns
+        -------
+        record_table : ``astropy.table.Table``
+        """
+        from astropy.table import Table
+        key_list = list(dict.fromkeys([key for record in record_list for key in record.keys()]))
+        return Table(rows=[[record.get(key) for key in key_list] for record in record_list], names=key_list) \
+            if record_list else Table()
+
+    @staticmethod
+    def read_log(log_file):
+        """
+        Function to read a json lines log into a table, e.g. to compare stages across grid configurations
+        Parameters
+        ----------
+        log_file : str or ``pathlib.Path``
+
+        Returns
+        -------
+        record_table : ``astropy.table.Table``
+        """
+        with open(log_file, 'r', encoding='utf-8') as file:
+            record_list = [json.loads(line) for line in file if line.strip()]
+        return CigaleStageRecorder.records_to_table(record_list=record_list)
@@ -0,0 +1,429 @@
+"""
+SQLite job queue on a shared filesystem to simulate the chunks of a grid on several nodes
+
+usage:
+    python -m cigale_wrapper.cigale_queue enqueue --queue-path /shared/grid_queue --config grid.json
+    python -m cigale_wrapper.cigale_queue work --queue-path /shared/grid_queue --n-cores 4
+    python -m cigale_wrapper.cigale_queue status --queue-path /shared/grid_queue
+    python -m cigale_wrapper.cigale_queue merge --queue-path /shared/grid_queue --output grid.fits
+
+The config file is a json dictionary with sed_module_conf_dict, sed_param_list, output_band_dict and either
+split_axes or memory_budget_bytes, see ``cigale_grid.CigaleGridTools.split_grid`` and
+``cigale_grid.CigaleGridPlanner.plan_grid``.
+"""
+import os
+import json
+import time
+import socket
+import sqlite3
+import argparse
+import functools
+import contextlib
+import threading
+from pathlib import Path
+
+from cigale_wrapper import cigale_cache
+from cigale_wrapper import cigale_grid
+from cigale_wrapper import cigale_helper
+from cigale_wrapper import cigale_model_io
+
+
+class CigaleJobQueue:
+    """
+    Queue of grid chunks stored in an SQLite database inside a directory on a filesystem shared by all nodes.
+    Workers claim a chunk in an exclusive transaction, send heartbeats while simulating it and mark it as done after
+    its model table is written next to the database. Claims without a heartbeat for longer than stale_time are
+    given back to the queue, e.g. after a node crashed, until a job has been tried max_attempts times. A worker whose
+    claim was given back discards its output.
+    SQLite relies on the file locks of the filesystem, which must therefore support POSIX locks across nodes.
+    The clocks of the nodes should be synchronised to well below stale_time.
+    """
+    database_file_name = 'queue.sqlite'
+
+    def __init__(self, queue_path):
+        """
+        Parameters
+        ----------
+        queue_path : str or ``pathlib.Path``
+        """
+        self.queue_path = Path(queue_path)
+        if not os.path.isfile(self.queue_path / self.database_file_name):
+            raise FileNotFoundError('There is no job queue in ' + str(self.queue_path))
+        with self.connect() as connection:
+            meta_dict = dict(connection.execute('SELECT key, value FROM meta').fetchall())
+        self.grid_hash = meta_dict['grid_hash']
+        self.sed_param_list = json.loads(meta_dict['sed_param_list'])
+        self.output_band_dict = json.loads(meta_dict['output_band_dict'])
+
+    def connect(self):
+        """
+        Returns
+        -------
+        connection : ``contextlib.closing``
+            of a ``sqlite3.Connection`` in autocommit mode, transactions are opened explicitly
+        """
+        return CigaleJobQueue.connect_database(database_path=self.queue_path / self.database_file_name)
+
+    @staticmethod
+    def connect_database(database_path):
+        """
+        Parameters
+        ----------
+        database_path : str or ``pathlib.Path``
+
+        Returns
+        -------
+        connection : ``contextlib.closing``
+        """
+        return contextlib.closing(sqlite3.connect(str(database_path), timeout=600, isolation_level=None))
+
+    @staticmethod
+    def create(queue_path, sed_module_conf_dict, sed_param_list, output_band_dict, split_axes=None,
+               memory_budget_bytes=None):
+        """
+        Function to create a queue and to enqueue all chunks of a grid. Creating the queue of the same grid again
+        does not add the chunks a second time.
+        Parameters
+        ----------
+        queue_path : str or ``pathlib.Path``
+        sed_module_conf_dict : dict
+        sed_param_list : list
+        output_band_dict : dict
+        split_axes : list or dict
+            see ``cigale_grid.CigaleGridTools.split_grid``
+        memory_budget_bytes : int
+            if split_axes is None the grid is split to fit into this memory budget per chunk, see
+            ``cigale_grid.CigaleGridPlanner.plan_grid``
+
+        Returns
+        -------
+        job_queue : ``CigaleJobQueue``
+        """
+        if split_axes is None:
+            if memory_budget_bytes is None:
+                raise KeyError('Either split_axes or memory_budget_bytes must be given')
+            split_axes = cigale_grid.CigaleGridPlanner.plan_grid(
+                sed_module_conf_dict=sed_module_conf_dict, output_band_dict=output_band_dict,
+                sed_param_list=sed_param_list, memory_budget_bytes=memory_budget_bytes)['split_axes']
+        chunk_conf_list = cigale_grid.CigaleGridTools.split_grid(sed_module_conf_dict=sed_module_conf_dict,
+                                                                 split_axes=split_axes)
+        grid_hash = cigale_cache.CigaleModelCache.compute_config_hash(
+            sed_module_conf_dict={'grid': sed_module_conf_dict, 'split_axes': split_axes},
+            output_band_dict=output_band_dict, sed_param_list=list(sed_param_list))
+        json_default = cigale_cache.CigaleModelCache._json_default
+
+        queue_path = Path(queue_path)
+        os.makedirs(queue_path, exist_ok=True)
+        with CigaleJobQueue.connect_database(database_path=queue_path / CigaleJobQueue.database_file_name) \
+                as connection:
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                connection.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+                connection.execute('CREATE TABLE IF NOT EXISTS jobs (job_id INTEGER PRIMARY KEY, conf TEXT, '
+                                   'status TEXT, worker TEXT, claim_time REAL, heartbeat_time REAL, '
+                                   'finish_time REAL, n_attempts INTEGER, n_models INTEGER, error TEXT)')
+                connection.execute('CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status)')
+                row = connection.execute("SELECT value FROM meta WHERE key = 'grid_hash'").fetchone()
+                if row is None:
+                    connection.executemany('INSERT INTO meta VALUES (?, ?)', [
+                        ('grid_hash', grid_hash), ('sed_param_list', json.dumps(list(sed_param_list))),
+                        ('output_band_dict', json.dumps(output_band_dict, default=json_default))])
+                    connection.executemany(
+                        "INSERT INTO jobs (job_id, conf, status, n_attempts) VALUES (?, ?, 'pending', 0)",
+                        [(job_id, json.dumps(chunk_conf, default=json_default))
+                         for job_id, chunk_conf in enumerate(chunk_conf_list)])
+                elif row[0] != grid_hash:
+                    raise ValueError('The queue %s belongs to a different grid configuration' % queue_path)
+                connection.execute('COMMIT')
+            except BaseException:
+                connection.execute('ROLLBACK')
+                raise
+        return CigaleJobQueue(queue_path=queue_path)
+
+    def get_job_file_path(self, job_id):
+        """
+        Parameters
+        ----------
+        job_id : int
+
+        Returns
+        -------
+        file_path : ``pathlib.Path``
+        """
+        return self.queue_path / ('chunk_%05i.fits' % job_id)
+
+    def requeue_stale(self, stale_time=600, max_attempts=3):
+        """
+        Function to give running jobs without a heartbeat for longer than stale_time back to the queue or to mark
+        them as failed after max_attempts, in the same way as failed jobs
+        Parameters
+        ----------
+        stale_time : float
+            seconds
+        max_attempts : int
+
+        Returns
+        -------
+        n_stale : int
+            number of requeued and failed jobs
+        """
+        with self.connect() as connection:
+            cursor = connection.execute("UPDATE jobs SET status = CASE WHEN n_attempts < ? THEN 'pending' "
+                                        "ELSE 'failed' END, worker = NULL, error = 'stale claim' "
+                                        "WHERE status = 'running' AND heartbeat_time < ?",
+                                        (max_attempts, time.time() - stale_time))
+            return cursor.rowcount
+
+    def claim(self, worker_id):
+        """
+        Function to claim the next pending job
+        Parameters
+        ----------
+        worker_id : str
+
+        Returns
+        -------
+        job : tuple
+            (job_id, chunk_conf) or None if no job is pending
+        """
+        with self.connect() as connection:
+            # the write lock is taken before reading, so that no two workers claim the same job
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                row = connection.execute("SELECT job_id, conf FROM jobs WHERE status = 'pending' "
+                                         "ORDER BY job_id LIMIT 1").fetchone()
+                if row is not None:
+                    now = time.time()
+                    connection.execute("UPDATE jobs SET status = 'running', worker = ?, claim_time = ?, "
+                                       "heartbeat_time = ?, n_attempts = n_attempts + 1 WHERE job_id = ?",
+                                       (worker_id, now, now, row[0]))
+                connection.execute('COMMIT')
+            except BaseException:
+                connection.execute('ROLLBACK')
+                raise
+        if row is None:
+            return None
+        return row[0], json.loads(row[1])
+
+    def heartbeat(self, job_id, worker_id):
+        """
+        Parameters
+        ----------
+        job_id : int
+        worker_id : str
+
+        Returns
+        -------
+        has_claim : bool
+            False if the job was requeued and is no longer claimed by this worker
+        """
+        with self.connect() as connection:
+            cursor = connection.execute("UPDATE jobs SET heartbeat_time = ? WHERE job_id = ? AND worker = ? "
+                                        "AND status = 'running'", (time.time(), job_id, worker_id))
+            return cursor.rowcount == 1
+
+    def complete(self, job_id, worker_id, n_models):
+        """
+        Parameters
+        ----------
+        job_id : int
+        worker_id : str
+        n_models : int
+
+        Returns
+        -------
+        has_claim : bool
+        """
+        with self.connect() as connection:
+            cursor = connection.execute("UPDATE jobs SET status = 'done', finish_time = ?, n_models = ?, error = NULL "
+                                        "WHERE job_id = ? AND worker = ? AND status = 'running'",
+                                        (time.time(), n_models, job_id, worker_id))
+            return cursor.rowcount == 1
+
+    def fail(self, job_id, worker_id, error, max_attempts=3):
+        """
+        Function to give a failed job back to the queue or to mark it as failed after max_attempts
+        Parameters
+        ----------
+        job_id : int
+        worker_id : str
+        error : str
+        max_attempts : int
+        """
+        with self.connect() as connection:
+            connection.execute("UPDATE jobs SET status = CASE WHEN n_attempts < ? THEN 'pending' ELSE 'failed' END, "
+                               "worker = NULL, error = ? WHERE job_id = ? AND worker = ? AND status = 'running'",
+                               (max_attempts, error, job_id, worker_id))
+
+    def get_status(self):
+        """
+        Returns
+        -------
+        status_dict : dict
+            number of jobs for each status
+        """
+        with self.connect() as connection:
+            status_dict = {'pending': 0, 'running': 0, 'done': 0, 'failed': 0}
+            status_dict.update(dict(connection.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status')
+                                    .fetchall()))
+        return status_dict
+
+    def send_heartbeats(self, job_id, worker_id, interval, stop_event):
+        """
+        Function to send heartbeats until stop_event is set. Runs in a thread next to the simulation
+        Parameters
+        ----------
+        job_id : int
+        worker_id : str
+        interval : float
+        stop_event : ``threading.Event``
+        """
+        while not stop_event.wait(interval):
+            try:
+                self.heartbeat(job_id=job_id, worker_id=worker_id)
+            except sqlite3.OperationalError:
+                # a busy database is retried with the next heartbeat
+                continue
+
+    def work(self, worker_id=None, n_cores=1, scratch_path=None, backend='subprocess', heartbeat_interval=30,
+             stale_time=600, max_attempts=3, max_jobs=None, wait_for_running=True, poll_interval=30):
+        """
+        Function to claim and simulate jobs until the queue is empty
+        Parameters
+        ----------
+        worker_id : str
+            if None it is <host name>:<process id>
+        n_cores : int
+            pcigale cores of each job
+        scratch_path : str
+            directory for the pcigale run directories, ideally a local disk of the node
+        backend : str
+        heartbeat_interval : float
+            seconds
+        stale_time : float
+            claims without a heartbeat for this many seconds are requeued. Must be much larger than
+            heartbeat_interval
+        max_attempts : int
+        max_jobs : int
+            stop after this number of jobs
+        wait_for_running : bool
+            if no job is pending, wait for the running jobs of other workers in case they become stale
+        poll_interval : float
+            seconds between checks while waiting
+
+        Returns
+        -------
+        finished_job_list : list
+        """
+        if worker_id is None:
+            worker_id = '%s:%i' % (socket.gethostname(), os.getpid())
+        finished_job_list = []
+        while (max_jobs is None) or (len(finished_job_list) < max_jobs):
+            self.requeue_stale(stale_time=stale_time, max_attempts=max_attempts)
+            job = self.claim(worker_id=worker_id)
+            if job is None:
+                if wait_for_running and (self.get_status()['running'] > 0):
+                    time.sleep(poll_interval)
+                    continue
+                break
+            job_id, chunk_conf = job
+            stop_event = threading.Event()
+            heartbeat_thread = threading.Thread(target=self.send_heartbeats,
+                                                args=(job_id, worker_id, heartbeat_interval, stop_event),
+                                                daemon=True)
+            heartbeat_thread.start()
+            try:
+                # the output only replaces the chunk file while this worker still holds the claim
+                n_models = cigale_grid.CigaleGridScheduler.run_chunk(
+                    chunk_conf=chunk_conf, sed_param_list=self.sed_param_list,
+                    output_band_dict=self.output_band_dict, file_path=self.get_job_file_path(job_id=job_id),
+                    n_cores=n_cores, scratch_path=scratch_path, backend=backend,
+                    has_claim=functools.partial(self.heartbeat, job_id=job_id, worker_id=worker_id))
+            except Exception as error:
+                stop_event.set()
+                heartbeat_thread.join()
+                self.fail(job_id=job_id, worker_id=worker_id, error=repr(error), max_attempts=max_attempts)
+                continue
+            stop_event.set()
+            heartbeat_thread.join()
+            if n_models is None:
+                # the job was requeued and is simulated by another worker
+                continue
+            if self.complete(job_id=job_id, worker_id=worker_id, n_models=n_models):
+                finished_job_list.append(job_id)
+        return finished_job_list
+
+    def merge(self, n_threads=None):
+        """
+        Function to merge the outputs of all jobs into one model table
+        Parameters
+        ----------
+        n_threads : int
+
+        Returns
+        -------
+        model_table : ``astropy.table.Table``
+        """
+        with self.connect() as connection:
+            row_list = connection.execute('SELECT job_id, status FROM jobs ORDER BY job_id').fetchall()
+        missing_job_list = [job_id for job_id, status in row_list if status != 'done']
+        if missing_job_list:
+            raise RuntimeError('The jobs %s are not finished yet' % missing_job_list)
+        column_list = cigale_helper.CigaleHelper.create_output_band_list_str(output_band_dict=self.output_band_dict)
+        column_list += self.sed_param_list
+        return cigale_model_io.CigaleModelIO.read_model_blocks(
+            block_file_list=[self.get_job_file_path(job_id=job_id) for job_id, _ in row_list],
+            column_list=column_list, n_threads=n_threads)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    enqueue_parser = subparsers.add_parser('enqueue', help='create a queue with all chunks of a grid')
+    enqueue_parser.add_argument('--queue-path', required=True)
+    enqueue_parser.add_argument('--config', required=True, help='json file with the grid configuration')
+    work_parser = subparsers.add_parser('work', help='simulate jobs until the queue is empty')
+    work_parser.add_argument('--queue-path', required=True)
+    work_parser.add_argument('--worker-id', default=None)
+    work_parser.add_argument('--n-cores', type=int, default=1)
+    work_parser.add_argument('--scratch-path', default=None)
+    work_parser.add_argument('--backend', default='subprocess')
+    work_parser.add_argument('--heartbeat-interval', type=float, default=30)
+    work_parser.add_argument('--stale-time', type=float, default=600)
+    work_parser.add_argument('--max-attempts', type=int, default=3)
+    work_parser.add_argument('--max-jobs', type=int, default=None)
+    work_parser.add_argument('--no-wait', action='store_true', help='stop as soon as no job is pending')
+    status_parser = subparsers.add_parser('status', help='print the number of jobs for each status')
+    status_parser.add_argument('--queue-path', required=True)
+    merge_parser = subparsers.add_parser('merge', help='merge the outputs of all jobs into one fits file')
+    merge_parser.add_argument('--queue-path', required=True)
+    merge_parser.add_argument('--output', required=True)
+    args = parser.parse_args()
+
+    if args.command == 'enqueue':
+        with open(args.config, 'r', encoding='utf-8') as file:
+            config = json.load(file)
+        job_queue = CigaleJobQueue.create(queue_path=args.queue_path,
+                                          sed_module_conf_dict=config['sed_module_conf_dict'],
+                                          sed_param_list=config['sed_param_list'],
+                                          output_band_dict=config['output_band_dict'],
+                                          split_axes=config.get('split_axes'),
+                                          memory_budget_bytes=config.get('memory_budget_bytes'))
+        print(json.dumps(job_queue.get_status()))
+    elif args.command == 'work':
+        job_queue = CigaleJobQueue(queue_path=args.queue_path)
+        finished_job_list = job_queue.work(worker_id=args.worker_id, n_cores=args.n_cores,
+                                           scratch_path=args.scratch_path, backend=args.backend,
+                                           heartbeat_interval=args.heartbeat_interval, stale_time=args.stale_time,
+                                           max_attempts=args.max_attempts, max_jobs=args.max_jobs,
+                                           wait_for_running=not args.no_wait)
+        print('finished %i jobs' % len(finished_job_list))
+    elif args.command == 'status':
+        print(json.dumps(CigaleJobQueue(queue_path=args.queue_path).get_status()))
+    elif args.command == 'merge':
+        model_table = CigaleJobQueue(queue_path=args.queue_path).merge()
+        model_table.write(args.output, overwrite=True)
+
+
+if __name__ == '__main__':
+    main()
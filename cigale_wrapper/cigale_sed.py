@@ -0,0 +1,251 @@
+"""
+Access to saved CIGALE model spectra and synthetic photometry for new filters
+"""
+import os
+import re
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from astropy.io import fits
+
+
+class CigaleSedTools:
+    """
+    collection of functions to gather the spectra pcigale saves with save_sed into one memory-mapped
+    (models x wavelength) array and to integrate filter transmission curves over all models
+    """
+    @staticmethod
+    def find_sed_files(out_path='out', sed_file_pattern='*_best_model.fits', id_pattern=r'^(\d+)_'):
+        """
+        Function to find the saved spectra sorted by their model id
+        Parameters
+        ----------
+        out_path : str or ``pathlib.Path``
+        sed_file_pattern : str
+        id_pattern : str
+            regular expression whose first group is the model id in the file name
+
+        Returns
+        -------
+        model_id : ``np.ndarray``
+        sed_file_list : list
+        """
+        id_file_list = []
+        for file_path in Path(out_path).glob(sed_file_pattern):
+            id_match = re.search(id_pattern, file_path.name)
+            if id_match is not None:
+                id_file_list.append((int(id_match.group(1)), file_path))
+        if not id_file_list:
+            raise FileNotFoundError('No saved spectra found in ' + str(out_path))
+        id_file_list = sorted(id_file_list)
+        return np.array([model_id for model_id, _ in id_file_list]), [file_path for _, file_path in id_file_list]
+
+    @staticmethod
+    def read_sed(file_name, flux_column='Fnu', wavelength_column='wavelength'):
+        """
+        Parameters
+        ----------
+        file_name : str or ``pathlib.Path``
+        flux_column : str
+        wavelength_column : str
+
+        Returns
+        -------
+        wavelength : ``np.ndarray``
+        flux : ``np.ndarray``
+        """
+        with fits.open(file_name, memmap=True) as hdu_list:
+            data = hdu_list[1].data
+            wavelength = np.array(data[wavelength_column], dtype=float)
+            flux = np.array(data[flux_column], dtype=float)
+            del data
+        return wavelength, flux
+
+    @staticmethod
+    def build_sed_array(sed_array_file, out_path='out', flux_column='Fnu', wavelength_column='wavelength',
+                        sed_file_pattern='*_best_model.fits', id_pattern=r'^(\d+)_', dtype=np.float32,
+                        n_threads=None):
+        """
+        Function to gather all saved spectra into one memory-mapped .npy file of shape (n_models, n_wavelength).
+        The wavelength grid and the model ids are stored next to it.
+        Parameters
+        ----------
+        sed_array_file : str or ``pathlib.Path``
+        out_path : str or ``pathlib.Path``
+        flux_column : str
+            pcigale writes Fnu in mJy
+        wavelength_column : str
+            pcigale writes the wavelength in nm
+        sed_file_pattern : str
+        id_pattern : str
+        dtype : type
+        n_threads : int
+
+        Returns
+        -------
+        wavelength : ``np.ndarray``
+        sed_array : ``np.memmap``
+        model_id : ``np.ndarray``
+        """
+        model_id, sed_file_list = CigaleSedTools.find_sed_files(out_path=out_path, sed_file_pattern=sed_file_pattern,
+                                                                id_pattern=id_pattern)
+        wavelength, _ = CigaleSedTools.read_sed(file_name=sed_file_list[0], flux_column=flux_column,
+                                                wavelength_column=wavelength_column)
+        sed_array_file = Path(sed_array_file)
+        sed_array = np.lib.format.open_memmap(sed_array_file, mode='w+', dtype=dtype,
+                                              shape=(len(sed_file_list), len(wavelength)))
+
+        def read_into_row(row_index):
+            sed_wavelength, flux = CigaleSedTools.read_sed(file_name=sed_file_list[row_index],
+                                                           flux_column=flux_column,
+                                                           wavelength_column=wavelength_column)
+            if (len(sed_wavelength) != len(wavelength)) or np.any(sed_wavelength != wavelength):
+                flux = np.interp(wavelength, sed_wavelength, flux, left=0, right=0)
+            sed_array[row_index] = flux
+
+        if n_threads is None:
+            n_threads = min(32, os.cpu_count() or 1)
+        with ThreadPoolExecutor(max_workers=max(1, n_threads)) as executor:
+            list(executor.map(read_into_row, range(len(sed_file_list))))
+        sed_array.flush()
+        np.save(CigaleSedTools.get_side_file_name(sed_array_file=sed_array_file, name='wavelength'), wavelength)
+        np.save(CigaleSedTools.get_side_file_name(sed_array_file=sed_array_file, name='model_id'), model_id)
+        return wavelength, sed_array, model_id
+
+    @staticmethod
+    def get_side_file_name(sed_array_file, name):
+        """
+        Parameters
+        ----------
+        sed_array_file : str or ``pathlib.Path``
+        name : str
+
+        Returns
+        -------
+        file_name : ``pathlib.Path``
+        """
+        sed_array_file = Path(sed_array_file)
+        return sed_array_file.with_name(sed_array_file.stem + '.' + name + '.npy')
+
+    @staticmethod
+    def open_sed_array(sed_array_file):
+        """
+        Function to memory map a spectra array written by build_sed_array
+        Parameters
+        ----------
+        sed_array_file : str or ``pathlib.Path``
+
+        Returns
+        -------
+        wavelength : ``np.ndarray``
+        sed_array : ``np.memmap``
+        model_id : ``np.ndarray``
+        """
+        wavelength = np.load(CigaleSedTools.get_side_file_name(sed_array_file=sed_array_file, name='wavelength'))
+        model_id = np.load(CigaleSedTools.get_side_file_name(sed_array_file=sed_array_file, name='model_id'))
+        return wavelength, np.load(sed_array_file, mmap_mode='r'), model_id
+
+    @staticmethod
+    def read_filter_file(file_name):
+        """
+        Function to read a filter transmission curve from a text file with the columns wavelength in nm and
+        transmission
+        Parameters
+        ----------
+        file_name : str or ``pathlib.Path``
+
+        Returns
+        -------
+        filter_wavelength : ``np.ndarray``
+        filter_transmission : ``np.ndarray``
+        """
+        filter_data = np.loadtxt(file_name, comments='#', usecols=(0, 1))
+        return filter_data[:, 0], filter_data[:, 1]
+
+    @staticmethod
+    def compute_filter_weights(wavelength, filter_dict):
+        """
+        Function to compute the integration weights of photon counting filters on the wavelength grid of the
+        spectra, so that the band flux density is sed_array @ weights.
+        <F_nu> = int F_nu T / lambda dlambda / int T / lambda dlambda
+        Parameters
+        ----------
+        wavelength : ``np.ndarray``
+        filter_dict : dict
+            dictionary of band name to (filter_wavelength, filter_transmission) with the wavelength in the unit of
+            the spectra
+
+        Returns
+        -------
+        weights : ``np.ndarray``
+            (n_wavelength, n_bands)
+        """
+        # trapezoidal integration weights of the wavelength grid
+        d_wavelength = np.zeros(len(wavelength))
+        d_wavelength[1:] += np.diff(wavelength) / 2
+        d_wavelength[:-1] += np.diff(wavelength) / 2
+        weights = np.zeros((len(wavelength), len(filter_dict)))
+        for band_index, band in enumerate(filter_dict.keys()):
+            filter_wavelength, filter_transmission = filter_dict[band]
+            transmission = np.interp(wavelength, filter_wavelength, filter_transmission, left=0, right=0)
+            band_weights = transmission / wavelength * d_wavelength
+            if np.sum(band_weights) <= 0:
+                raise KeyError('The filter %s does not overlap with the wavelength range of the spectra' % band)
+            weights[:, band_index] = band_weights / np.sum(band_weights)
+        return weights
+
+    @staticmethod
+    def compute_band_flux(wavelength, sed_array, filter_dict, chunk_size=10000):
+        """
+        Function to compute synthetic photometry of all models in chunks
+        Parameters
+        ----------
+        wavelength : ``np.ndarray``
+        sed_array : ``np.ndarray``
+            (n_models, n_wavelength), e.g. the memory-mapped output of build_sed_array
+        filter_dict : dict
+            dictionary of band name to (filter_wavelength, filter_transmission)
+        chunk_size : int
+            number of models integrated at once
+
+        Returns
+        -------
+        band_flux_dict : dict
+            array of band fluxes in the unit of the spectra for each band
+        """
+        weights = CigaleSedTools.compute_filter_weights(wavelength=wavelength, filter_dict=filter_dict)
+        # only the wavelength range covered by any filter is read from the spectra
+        used = np.where(np.any(weights > 0, axis=1))[0]
+        wave_slice = slice(used[0], used[-1] + 1)
+        band_flux = np.empty((sed_array.shape[0], len(filter_dict)))
+        for start in range(0, sed_array.shape[0], chunk_size):
+            band_flux[start:start + chunk_size] = (np.asarray(sed_array[start:start + chunk_size, wave_slice],
+                                                              dtype=float) @ weights[wave_slice])
+        return {band: band_flux[:, band_index] for band_index, band in enumerate(filter_dict.keys())}
+
+    @staticmethod
+    def append_band_columns(model_table, band_flux_dict, model_id=None, unit='mJy'):
+        """
+        Function to add synthetic band fluxes as new columns of a model table
+        Parameters
+        ----------
+        model_table : ``astropy.table.Table``
+        band_flux_dict : dict
+        model_id : ``np.ndarray``
+            model ids of the band fluxes. If given and the table has an id column, the rows are matched by id,
+            otherwise the rows are assumed to be in model id order
+        unit : str
+        """
+        if (model_id is not None) and ('id' in model_table.colnames):
+            row_index = np.searchsorted(model_id, np.asarray(model_table['id']))
+            if np.any(row_index >= len(model_id)) or np.any(model_id[np.minimum(row_index, len(model_id) - 1)] !=
+                                                            np.asarray(model_table['id'])):
+                raise KeyError('Not all models of the table have a saved spectrum')
+        else:
+            if len(model_table) != len(next(iter(band_flux_dict.values()))):
+                raise KeyError('The number of spectra does not match the number of models')
+            row_index = slice(None)
+        for band in band_flux_dict.keys():
+            model_table[band] = band_flux_dict[band][row_index]
+            model_table[band].unit = unit
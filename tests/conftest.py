@@ -0,0 +1,58 @@
+"""
+Shared helpers of the tests, which replace pcigale by model tables built from the grid configuration
+"""
+import os
+import sys
+import time
+import sqlite3
+import itertools
+from pathlib import Path
+
+from astropy.table import Table
+
+# the package is used from the repository root without installation
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+sed_param_list = ['sfh.age', 'attenuation.E_BV']
+
+
+def make_model_table(conf):
+    """
+    Function to build the model table of a configuration with the modules sfh2exp and dustext, holding one row per
+    parameter combination
+    """
+    row_list = list(itertools.product(conf['sfh2exp']['age'], conf['dustext']['E_BV']))
+    return Table(rows=row_list, names=sed_param_list, dtype=[float, float])
+
+
+def log_call(log_path, entry):
+    with open(Path(log_path) / 'calls.log', 'a', encoding='utf-8') as file:
+        file.write(entry + '\n')
+
+
+def read_calls(log_path):
+    with open(Path(log_path) / 'calls.log', 'r', encoding='utf-8') as file:
+        return file.read().splitlines()
+
+
+def make_stub_simulation(log_path, steal_claim_database=None):
+    """
+    Function to create a replacement of ``CigaleModelWrapper.sim_cigale_model_params``. Every call is logged with
+    the simulated ages and the table is saved like the original if save_output is set. With steal_claim_database
+    all running jobs of this queue database are given to another worker during the simulation
+    """
+    def sim_cigale_model_params(sed_module_conf_dict, sed_param_list, output_band_dict, data_output_path='',
+                                file_name=None, save_output=True, **kwargs):
+        from cigale_wrapper import cigale_molde_wrapper
+        time.sleep(0.05)
+        log_call(log_path=log_path, entry='%i %s' % (os.getpid(), sed_module_conf_dict['sfh2exp']['age']))
+        if steal_claim_database is not None:
+            with sqlite3.connect(str(steal_claim_database)) as connection:
+                connection.execute("UPDATE jobs SET worker = 'other' WHERE status = 'running'")
+        model_table = make_model_table(conf=sed_module_conf_dict)
+        if save_output and (file_name is not None):
+            cigale_molde_wrapper.CigaleModelWrapper.save_model_table(model_table=model_table,
+                                                                     data_output_path=data_output_path,
+                                                                     file_name=file_name)
+        return model_table
+    return staticmethod(sim_cigale_model_params)
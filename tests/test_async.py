@@ -0,0 +1,53 @@
+"""
+Tests of the asyncio interface with a stubbed pcigale simulation
+"""
+import time
+import asyncio
+
+import pytest
+
+from cigale_wrapper import cigale_async
+from cigale_wrapper import cigale_molde_wrapper
+
+CigaleAsync = cigale_async.CigaleAsync
+
+
+async def stub_run_sim_cigale_model(sed_module_conf_dict, run_path, n_cores=1, output_band_dict=None,
+                                    save_sed=False, progress_callback=None):
+    (run_path / 'out').mkdir()
+
+
+def test_cancelled_loading_keeps_run_directory(tmp_path, monkeypatch):
+    event_list = []
+
+    def stub_load(sed_param_list, output_band_dict, out_path):
+        event_list.append('load started')
+        time.sleep(0.3)
+        event_list.append('run directory exists' if out_path.is_dir() else 'run directory removed')
+
+    monkeypatch.setattr(CigaleAsync, 'run_sim_cigale_model', staticmethod(stub_run_sim_cigale_model))
+    monkeypatch.setattr(cigale_molde_wrapper.CigaleModelWrapper, 'load_cigale_model_params', staticmethod(stub_load))
+
+    async def cancel_while_loading():
+        task = asyncio.ensure_future(CigaleAsync.sim_cigale_model_params(
+            sed_module_conf_dict={}, sed_param_list=[], output_band_dict=None, scratch_path=tmp_path))
+        while not event_list:
+            await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(cancel_while_loading())
+    assert event_list == ['load started', 'run directory exists']
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_relative_scratch_path(tmp_path, monkeypatch):
+    monkeypatch.setattr(CigaleAsync, 'run_sim_cigale_model', staticmethod(stub_run_sim_cigale_model))
+    monkeypatch.setattr(cigale_molde_wrapper.CigaleModelWrapper, 'load_cigale_model_params',
+                        staticmethod(lambda sed_param_list, output_band_dict, out_path: out_path))
+    monkeypatch.chdir(tmp_path)
+    out_path = asyncio.run(CigaleAsync.sim_cigale_model_params(
+        sed_module_conf_dict={}, sed_param_list=[], output_band_dict=None, scratch_path='scratch'))
+    assert out_path.is_absolute()
+    assert out_path.parent.parent == tmp_path / 'scratch'
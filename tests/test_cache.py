@@ -0,0 +1,91 @@
+"""
+Tests of the content addressed model cache
+"""
+import os
+import multiprocessing
+
+import numpy as np
+from astropy.table import Table
+
+from cigale_wrapper import cigale_cache
+
+
+def make_table(n_rows=100, value=0.):
+    return Table({'sfh.age': np.full(n_rows, value)})
+
+
+def put_and_get(cache_path, worker_index, max_size_bytes):
+    cache = cigale_cache.CigaleModelCache(cache_path=cache_path, max_size_bytes=max_size_bytes)
+    for entry_index in range(8):
+        config_hash = 'hash_%i_%i' % (worker_index, entry_index)
+        cache.put(config_hash=config_hash, model_table=make_table(value=worker_index), pcigale_version='test')
+        model_table = cache.get(config_hash=config_hash)
+        # a table evicted by another worker in the meantime is a miss
+        assert (model_table is None) or np.all(model_table['sfh.age'] == worker_index)
+
+
+def test_hit_and_miss(tmp_path):
+    cache = cigale_cache.CigaleModelCache(cache_path=tmp_path)
+    conf = {'sfh2exp': {'age': [1, 2]}}
+    config_hash = cigale_cache.CigaleModelCache.compute_config_hash(
+        sed_module_conf_dict=conf, output_band_dict=None, sed_param_list=['sfh.age'], pcigale_version='test')
+    assert config_hash == cigale_cache.CigaleModelCache.compute_config_hash(
+        sed_module_conf_dict={'sfh2exp': {'age': np.array([1, 2])}}, output_band_dict=None,
+        sed_param_list=['sfh.age'], pcigale_version='test')
+    assert config_hash != cigale_cache.CigaleModelCache.compute_config_hash(
+        sed_module_conf_dict=conf, output_band_dict=None, sed_param_list=['sfh.age'], pcigale_version='other')
+    assert cache.get(config_hash=config_hash) is None
+    cache.put(config_hash=config_hash, model_table=make_table(value=5.), pcigale_version='test')
+    assert np.all(cache.get(config_hash=config_hash)['sfh.age'] == 5.)
+    # an entry removed from disk is a miss
+    os.remove(cache.get_file_path(config_hash=config_hash))
+    assert cache.get(config_hash=config_hash) is None
+
+
+def test_lru_eviction_under_byte_budget(tmp_path):
+    make_table().write(tmp_path / 'size.fits')
+    entry_bytes = os.path.getsize(tmp_path / 'size.fits')
+    cache = cigale_cache.CigaleModelCache(cache_path=tmp_path / 'cache', max_size_bytes=int(2.5 * entry_bytes))
+    for config_hash in ['a', 'b']:
+        cache.put(config_hash=config_hash, model_table=make_table(), pcigale_version='test')
+    (cache.cache_path / 'a.colour_index.pkl').write_bytes(b'index')
+    # a is used more recently than b, so b is evicted first
+    assert cache.get(config_hash='a') is not None
+    cache.put(config_hash='c', model_table=make_table(), pcigale_version='test')
+    assert sorted(cache.load_manifest().keys()) == ['a', 'c']
+    assert not os.path.isfile(cache.get_file_path(config_hash='b'))
+    cache.put(config_hash='d', model_table=make_table(), pcigale_version='test')
+    assert sorted(cache.load_manifest().keys()) == ['c', 'd']
+    # the files stored alongside an entry are removed with it
+    assert not os.path.isfile(cache.cache_path / 'a.colour_index.pkl')
+
+
+def test_eviction_keeps_temporary_files(tmp_path):
+    cache = cigale_cache.CigaleModelCache(cache_path=tmp_path)
+    cache.put(config_hash='a', model_table=make_table(), pcigale_version='test')
+    tmp_file_path = tmp_path / 'a.123.456.tmp.fits'
+    tmp_file_path.write_bytes(b'table of a concurrent put')
+    cache.remove_entry_files(config_hash='a')
+    assert not os.path.isfile(cache.get_file_path(config_hash='a'))
+    assert os.path.isfile(tmp_file_path)
+
+
+def test_concurrent_put_and_evict(tmp_path):
+    process_list = [multiprocessing.Process(target=put_and_get, args=(str(tmp_path), worker_index, None))
+                    for worker_index in range(4)]
+    process_list += [multiprocessing.Process(target=put_and_get, args=(str(tmp_path / 'small'), worker_index, 20000))
+                     for worker_index in range(4)]
+    for process in process_list:
+        process.start()
+    for process in process_list:
+        process.join(timeout=60)
+        assert process.exitcode == 0
+
+    # without budget no entry is lost
+    assert len(cigale_cache.CigaleModelCache(cache_path=tmp_path).load_manifest()) == 32
+    small_cache = cigale_cache.CigaleModelCache(cache_path=tmp_path / 'small', max_size_bytes=20000)
+    manifest = small_cache.load_manifest()
+    assert 0 < sum(entry['size'] for entry in manifest.values()) <= 20000
+    # every table on disk is listed in the manifest and no temporary file is left
+    assert sorted(file_path.stem for file_path in small_cache.cache_path.glob('*.fits')) == sorted(manifest.keys())
+    assert not list(small_cache.cache_path.glob('*.tmp*'))
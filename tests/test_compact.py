@@ -0,0 +1,34 @@
+"""
+Tests of the compact model table
+"""
+import numpy as np
+from astropy.table import Table
+
+from cigale_wrapper import cigale_compact
+
+
+def make_model_table(n_models):
+    rng = np.random.default_rng(1)
+    return Table({'sfh.age': np.tile([1., 5., 10., 100.], n_models // 4),
+                  'attenuation.E_BV': np.repeat(np.linspace(0, 1, n_models // 4), 4),
+                  'hst.wfc3.F555W': rng.lognormal(size=n_models)})
+
+
+def test_small_grid_is_never_larger():
+    model_table = make_model_table(n_models=48)
+    compact_table = cigale_compact.CompactModelTable(model_table=model_table, band_list=['hst.wfc3.F555W'])
+    assert compact_table.encoding['hst.wfc3.F555W'] != 'dictionary'
+    assert compact_table.encoding['sfh.age'] == 'dictionary'
+    for col in model_table.colnames:
+        assert compact_table.get_compact_bytes(col) <= compact_table.original_bytes[col]
+    report_table = compact_table.memory_report()
+    assert report_table['ratio'][-1] > 1
+
+
+def test_columns_are_decoded():
+    model_table = make_model_table(n_models=400)
+    compact_table = cigale_compact.CompactModelTable(model_table=model_table, band_list=['hst.wfc3.F555W'])
+    decoded_table = compact_table.to_table()
+    assert np.array_equal(decoded_table['sfh.age'], model_table['sfh.age'])
+    assert np.array_equal(decoded_table['attenuation.E_BV'], model_table['attenuation.E_BV'])
+    assert np.allclose(decoded_table['hst.wfc3.F555W'], model_table['hst.wfc3.F555W'], rtol=1e-6, atol=0)
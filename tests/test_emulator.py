@@ -0,0 +1,21 @@
+"""
+Tests of the grid emulator
+"""
+import numpy as np
+from astropy.table import Table
+
+from cigale_wrapper import cigale_emulator
+
+
+def test_single_valued_axis_is_checked():
+    age = np.array([1., 10., 100.])
+    model_table = Table({'sfh.age': age, 'attenuation.E_BV': np.zeros(3), 'flux': 2 * age})
+    emulator = cigale_emulator.CigaleGridEmulator(model_table=model_table, axis_list=['sfh.age', 'attenuation.E_BV'],
+                                                  output_list=['flux'])
+    assert emulator.interp_axis_list == ['sfh.age']
+
+    output_dict = emulator.predict(param_dict={'sfh.age': [10., 10., 100.], 'attenuation.E_BV': [0., 0.1, 0.]})
+    assert np.allclose(output_dict['flux'][[0, 2]], [20., 200.])
+    assert np.isnan(output_dict['flux'][1])
+    # the single valued axis can be omitted
+    assert np.allclose(emulator.predict(param_dict={'sfh.age': [10., 100.]})['flux'], [20., 200.])
@@ -0,0 +1,113 @@
+"""
+Tests of the grid tools and of the chunk scheduler with a stubbed chunk simulation
+"""
+import os
+import itertools
+from pathlib import Path
+
+import pytest
+
+from cigale_wrapper import cigale_grid
+from conftest import make_model_table, log_call, read_calls, sed_param_list
+
+
+sed_module_conf_dict = {'sfh2exp': {'age': [1, 2, 3, 4]}, 'dustext': {'E_BV': [0.0, 0.1]}}
+
+
+class StubScheduler(cigale_grid.CigaleGridScheduler):
+    """
+    Scheduler whose chunks write a model table of their parameters instead of running pcigale.
+    A chunk fails while the file fail_<chunk> exists in the work directory.
+    """
+    @staticmethod
+    def run_chunk(chunk_conf, sed_param_list, output_band_dict, file_path, n_cores, scratch_path, backend):
+        file_path = Path(file_path)
+        log_call(log_path=file_path.parent, entry=file_path.stem)
+        if os.path.isfile(file_path.parent / ('fail_' + file_path.stem)):
+            raise ValueError('stub failure of ' + file_path.stem)
+        model_table = make_model_table(conf=chunk_conf)
+        model_table.write(file_path, overwrite=True)
+        return len(model_table)
+
+
+def test_failing_chunk_keeps_finished_chunks_and_resumes(tmp_path):
+    scheduler = StubScheduler(sed_module_conf_dict=sed_module_conf_dict, sed_param_list=sed_param_list,
+                              output_band_dict=None, work_path=tmp_path, split_axes=['sfh2exp.age'],
+                              n_cores_total=2)
+    assert len(scheduler.chunk_conf_list) == 4
+    (tmp_path / 'fail_chunk_00002').touch()
+
+    with pytest.raises(RuntimeError, match=r'\[2\]') as error_info:
+        scheduler.run()
+    assert isinstance(error_info.value.__cause__, ValueError)
+    assert sorted(scheduler.load_checkpoint()) == [0, 1, 3]
+    with pytest.raises(RuntimeError):
+        scheduler.merge()
+
+    # a restarted job only runs the failed chunk
+    os.remove(tmp_path / 'fail_chunk_00002')
+    restarted_scheduler = StubScheduler(sed_module_conf_dict=sed_module_conf_dict, sed_param_list=sed_param_list,
+                                        output_band_dict=None, work_path=tmp_path, split_axes=['sfh2exp.age'],
+                                        n_cores_total=2)
+    assert sorted(restarted_scheduler.run()) == [0, 1, 2, 3]
+    call_list = read_calls(log_path=tmp_path)
+    assert call_list.count('chunk_00002') == 2
+    assert all(call_list.count('chunk_%05i' % chunk_index) == 1 for chunk_index in [0, 1, 3])
+
+    model_table = restarted_scheduler.merge()
+    assert len(model_table) == 8
+    expected_table = make_model_table(conf=sed_module_conf_dict)
+    assert sorted(zip(model_table['sfh.age'], model_table['attenuation.E_BV'])) == \
+        sorted(zip(expected_table['sfh.age'], expected_table['attenuation.E_BV']))
+
+
+def test_work_path_of_other_grid_is_rejected(tmp_path):
+    StubScheduler(sed_module_conf_dict=sed_module_conf_dict, sed_param_list=sed_param_list, output_band_dict=None,
+                  work_path=tmp_path, split_axes=['sfh2exp.age'])
+    other_conf_dict = {'sfh2exp': {'age': [1, 2]}, 'dustext': {'E_BV': [0.0, 0.1]}}
+    with pytest.raises(ValueError):
+        StubScheduler(sed_module_conf_dict=other_conf_dict, sed_param_list=sed_param_list, output_band_dict=None,
+                      work_path=tmp_path, split_axes=['sfh2exp.age'])
+
+
+def test_find_missing_sub_grids_covers_union_once():
+    stored_conf = {'sfh2exp': {'age': [1, 2]}, 'dustext': {'E_BV': [0.0, 0.1]}}
+    requested_conf = {'sfh2exp': {'age': [2, 3]}, 'dustext': {'E_BV': [0.0, 0.1, 0.2]}}
+    sub_grid_conf_list = cigale_grid.CigaleGridTools.find_missing_sub_grids(
+        sed_module_conf_dict=requested_conf, model_table=make_model_table(conf=stored_conf))
+    assert len(sub_grid_conf_list) == 2
+    # the configured types are kept, e.g. integer ages
+    assert all(isinstance(age, int) for conf in sub_grid_conf_list for age in conf['sfh2exp']['age'])
+
+    point_list = list(itertools.product(stored_conf['sfh2exp']['age'], stored_conf['dustext']['E_BV']))
+    for conf in sub_grid_conf_list:
+        point_list += list(itertools.product(conf['sfh2exp']['age'], conf['dustext']['E_BV']))
+    union_point_list = list(itertools.product([1, 2, 3], [0.0, 0.1, 0.2]))
+    assert len(point_list) == len(union_point_list)
+    assert sorted(point_list) == sorted(union_point_list)
+
+
+def test_find_missing_sub_grids_of_stored_grid():
+    model_table = make_model_table(conf=sed_module_conf_dict)
+    requested_conf = {'sfh2exp': {'age': [1, 3]}, 'dustext': {'E_BV': [0.1]}}
+    assert cigale_grid.CigaleGridTools.find_missing_sub_grids(sed_module_conf_dict=requested_conf,
+                                                              model_table=model_table) == []
+
+
+def test_find_missing_sub_grids_of_irregular_table():
+    model_table = make_model_table(conf=sed_module_conf_dict)
+    model_table.remove_row(0)
+    assert cigale_grid.CigaleGridTools.find_missing_sub_grids(sed_module_conf_dict=sed_module_conf_dict,
+                                                              model_table=model_table) is None
+
+
+def test_find_missing_sub_grids_needs_parameter_columns():
+    model_table = make_model_table(conf=sed_module_conf_dict)
+    requested_conf = dict(sed_module_conf_dict, nebular={'logU': [-3.0, -2.0]})
+    with pytest.raises(KeyError):
+        cigale_grid.CigaleGridTools.find_missing_sub_grids(sed_module_conf_dict=requested_conf,
+                                                           model_table=model_table)
+    # a single value without column is assumed to be the simulated one
+    requested_conf = dict(sed_module_conf_dict, nebular={'logU': -2.0})
+    assert cigale_grid.CigaleGridTools.find_missing_sub_grids(sed_module_conf_dict=requested_conf,
+                                                              model_table=model_table) == []
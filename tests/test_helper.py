@@ -0,0 +1,49 @@
+"""
+Tests of the flux rescaling helpers
+"""
+import numpy as np
+import astropy.units as u
+from astropy.table import Table
+
+from cigale_wrapper import cigale_helper
+
+CigaleHelper = cigale_helper.CigaleHelper
+
+band_list = ['hst.wfc3.F555W', 'jwst.nircam.F200W']
+
+
+def make_model_table(n_models=20, seed=0):
+    rng = np.random.default_rng(seed)
+    return Table({'hst.wfc3.F555W': rng.uniform(1e-3, 1, n_models),
+                  'jwst.nircam.F200W': rng.uniform(1e-3, 1, n_models),
+                  'universe.luminosity_distance': rng.uniform(1e20, 1e23, n_models),
+                  'stellar.m_star': rng.uniform(0.1, 10, n_models)})
+
+
+def test_batch_rescale_equals_scalar_rescale():
+    model_table = make_model_table()
+    mstar_scale = np.array([1e3, 5e4, 2e6])
+    dist_scale = np.array([0.01, 3.5, 17.])
+    flux = CigaleHelper.compute_sim_band_flux_rescaled_batch(model_table=model_table, mstar_scale=mstar_scale,
+                                                             dist_scale=dist_scale, band_list=band_list)
+    assert flux.shape == (len(model_table), len(band_list), len(mstar_scale))
+    for band_index, band in enumerate(band_list):
+        for target_index in range(len(mstar_scale)):
+            scalar_flux = CigaleHelper.compute_sim_band_flux_rescaled(model_table=model_table,
+                                                                      mstar_scale=mstar_scale[target_index],
+                                                                      dist_scale=dist_scale[target_index], band=band)
+            assert np.allclose(flux[:, band_index, target_index],
+                               scalar_flux.to_value(u.dimensionless_unscaled), rtol=1e-12, atol=0)
+
+
+def test_batch_rescale_broadcasts_and_chunks():
+    model_table = make_model_table()
+    mstar_scale = np.geomspace(1e3, 1e6, 7)
+    flux = CigaleHelper.compute_sim_band_flux_rescaled_batch(model_table=model_table, mstar_scale=mstar_scale,
+                                                             dist_scale=10., band_list=band_list)
+    assert flux.shape == (len(model_table), len(band_list), len(mstar_scale))
+    chunk_list = list(CigaleHelper.iter_sim_band_flux_rescaled_batch(model_table=model_table, mstar_scale=mstar_scale,
+                                                                     dist_scale=10., band_list=band_list,
+                                                                     chunk_size=3))
+    assert [target_slice for target_slice, _ in chunk_list] == [slice(0, 3), slice(3, 6), slice(6, 7)]
+    assert np.array_equal(np.concatenate([chunk_flux for _, chunk_flux in chunk_list], axis=2), flux)
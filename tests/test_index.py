@@ -0,0 +1,46 @@
+"""
+Tests of the colour index
+"""
+import numpy as np
+import pytest
+from astropy.table import Table
+
+from cigale_wrapper import cigale_index
+
+CigaleColourIndex = cigale_index.CigaleColourIndex
+
+band_list = ['band_1', 'band_2', 'band_3']
+
+
+def make_model_table(n_models=50, seed=0):
+    rng = np.random.default_rng(seed)
+    return Table({band: rng.uniform(1, 10, n_models) for band in band_list})
+
+
+def test_objects_without_valid_colours_are_masked():
+    model_table = make_model_table()
+    colour_index = CigaleColourIndex(model_table=model_table, band_list=band_list)
+    obs_flux = np.stack([np.asarray(model_table[band]) for band in band_list], axis=1)[[3, 7]]
+    obs_flux[1, 0] = 0
+    for obs_flux_err in [None, 0.1 * obs_flux + 0.01]:
+        distance, model_index = colour_index.query(obs_flux=obs_flux, obs_flux_err=obs_flux_err)
+        assert list(model_index.mask[:, 0]) == [False, True]
+        assert list(distance.mask[:, 0]) == [False, True]
+        assert list(model_index.compressed()) == [3]
+        assert model_index.filled()[1, 0] == -1
+        assert distance.filled()[1, 0] == np.inf
+
+
+def test_load_or_build(tmp_path):
+    model_table = make_model_table()
+    table_file_path = tmp_path / 'grid.fits'
+    model_table.write(table_file_path)
+    with pytest.raises(KeyError):
+        CigaleColourIndex.load_or_build(model_table=model_table, table_file_path=table_file_path)
+    colour_index = CigaleColourIndex.load_or_build(model_table=model_table, table_file_path=table_file_path,
+                                                   band_list=band_list)
+    assert CigaleColourIndex.get_index_file_path(table_file_path=table_file_path).is_file()
+    loaded_index = CigaleColourIndex.load_or_build(model_table=model_table, table_file_path=table_file_path,
+                                                   band_list=band_list)
+    assert loaded_index.colour_list == colour_index.colour_list
+    assert sorted(path.name for path in tmp_path.iterdir()) == ['grid.colour_index.pkl', 'grid.fits']
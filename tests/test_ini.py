@@ -0,0 +1,212 @@
+"""
+Tests of the pcigale.ini editor
+"""
+import pytest
+
+from cigale_wrapper import cigale_ini
+from cigale_wrapper import cigale_helper
+
+CigaleIniFile = cigale_ini.CigaleIniFile
+
+# pcigale.ini as written by pcigale genconf, shortened
+genconf_ini_str = """# File containing the input data. The columns are 'id' (name of the
+# object), 'redshift' (if 0 the distance is assumed to be 10 pc), 'distance'
+data_file =
+
+# Optional file containing the list of physical parameters.
+parameters_file =
+
+# Available modules to compute the models. The order must be kept.
+sed_modules = sfh2exp, bc03, nebular, dustext, redshifting
+
+# Method used for statistical analysis. Available methods: pdf_analysis,
+# savefluxes.
+analysis_method = savefluxes
+
+# Number of CPU cores available. This computer has 8 cores.
+cores = 1
+
+# Bands to consider. To consider uncertainties too, the name of the band
+# must be indicated with the _err suffix.
+bands = hst.wfc3.F555W, hst.wfc3.F814W
+
+# Properties to be considered.
+properties =
+
+# Relative error added in quadrature to the uncertainties of the fluxes
+additionalerror = 0.1
+
+# Configuration of the SED creation modules.
+[sed_modules_params]
+
+  [[sfh2exp]]
+    # e-folding time of the main stellar population model in Myr.
+    tau_main = 6000.0
+    # e-folding time of the late starburst population model in Myr.
+    tau_burst = 50.0
+    # Mass fraction of the late burst population.
+    f_burst = 0.0
+    # Age of the main stellar population in the galaxy in Myr.
+    age = 1000
+    # Age of the late burst in Myr.
+    burst_age = 20
+    # Value of SFR at t = 0 in M_sun/yr.
+    sfr_0 = 1.0
+    # Normalise the SFH to produce one solar mass.
+    normalise = True
+
+  [[bc03]]
+    # Initial mass function: 0 (Salpeter) or 1 (Chabrier).
+    imf = 0
+    # Metalicity. Possible values are: 0.0001, 0.0004, 0.004, 0.008, 0.02, 0.05.
+    metallicity = 0.02
+    # Age [Myr] of the separation between the young and the old star populations.
+    separation_age = 10
+
+  [[nebular]]
+    # Ionisation parameter. Possible values are: -4.0, -3.9, ..., -1.1, -1.0.
+    logU = -2.0
+    # Gas metallicity.
+    zgas = 0.02
+    # Fraction of Lyman continuum photons escaping the galaxy.
+    f_esc = 0.0
+    # Fraction of Lyman continuum photons absorbed by dust.
+    f_dust = 0.0
+    # Line width in km/s.
+    lines_width = 300.0
+    # Include nebular emission.
+    emission = True
+
+  [[dustext]]
+    # E(B-V), the colour excess.
+    E_BV = 0.3
+    # Ratio of total to selective extinction, A_V / E(B-V).
+    Rv = 3.1
+    # Extinction law to apply.
+    law = 0
+    # Filters for which the extinction will be computed and added to the SED
+    # information dictionary.
+    filters = B_B90 & V_B90 & FUV
+
+  [[redshifting]]
+    # Redshift of the objects. Leave empty to use the redshifts from the input
+    # file.
+    redshift = 0.0
+
+
+# Configuration of the statistical analysis method.
+[analysis_params]
+  # List of the physical properties to save. Leave empty to save all the
+  # physical properties (not recommended when there are many models).
+  variables =
+  # If True, save the generated spectrum for each model.
+  save_sed = False
+  # Number of blocks to compute the models. Having a number of blocks
+  # larger than 1 can be useful when computing a very large number of models
+  # or to split the result file into smaller files.
+  blocks = 1
+"""
+
+
+def legacy_replace_params_in_file(param_dict, file_name):
+    # the replace_params_in_file implementation before it delegated to CigaleIniFile. List values originally missed
+    # the line break, which is restored here to compare the remaining behaviour
+    with open(file_name, 'r', encoding='utf-8') as file:
+        lines = file.readlines()
+    for key in param_dict.keys():
+        line_index = [i for i in range(len(lines)) if lines[i].startswith(key)]
+        prefix = ''
+        if not line_index:
+            line_index = [i for i in range(len(lines)) if lines[i].startswith('  ' + key)]
+            prefix = '  '
+        if not line_index:
+            line_index = [i for i in range(len(lines)) if lines[i].startswith('    ' + key)]
+            prefix = '    '
+        if len(line_index) > 1:
+            raise KeyError('There is apparently more than one line beginning with <<', key, '>>')
+        if isinstance(param_dict[key], list):
+            new_line = prefix + key + ' = ' + ', '.join([str(obj) for obj in param_dict[key]]) + '\n'
+        else:
+            new_line = prefix + key + ' = ' + str(param_dict[key]) + '\n'
+        lines[line_index[0]] = new_line
+    with open(file_name, 'w', encoding='utf-8') as file:
+        file.writelines(lines)
+
+
+def write_genconf_ini(file_name):
+    with open(file_name, 'w', encoding='utf-8') as file:
+        file.write(genconf_ini_str)
+    return file_name
+
+
+def read_lines(file_name):
+    with open(file_name, 'r', encoding='utf-8') as file:
+        return file.readlines()
+
+
+# keys of all nesting levels which the old implementation already found unambiguously
+param_dict_list = [
+    {'cores': 4, 'analysis_method': 'pdf_analysis', 'sed_modules': ['sfh2exp', 'bc03', 'dustext']},
+    {'age': [1, 5, 10, 100], 'tau_main': 200.0, 'normalise': False},
+    {'E_BV': [0.0, 0.1, 0.5], 'logU': -3.0, 'imf': 1, 'redshift': 0.0},
+    {'save_sed': True, 'blocks': 8, 'variables': ['sfh.age', 'stellar.m_star']},
+]
+
+
+@pytest.mark.parametrize('param_dict', param_dict_list)
+def test_same_output_as_legacy_replace(tmp_path, param_dict):
+    legacy_file_name = write_genconf_ini(tmp_path / 'legacy.ini')
+    legacy_replace_params_in_file(param_dict=param_dict, file_name=legacy_file_name)
+    file_name = write_genconf_ini(tmp_path / 'pcigale.ini')
+    cigale_helper.CigaleHelper.replace_params_in_file(param_dict=param_dict, file_name=file_name)
+    assert read_lines(file_name) == read_lines(legacy_file_name)
+
+
+def test_sim_config_in_one_pass(tmp_path):
+    file_name = write_genconf_ini(tmp_path / 'pcigale.ini')
+    ini_file = CigaleIniFile(file_name=file_name)
+    ini_file.apply_sim_config(sed_module_conf_dict={'sfh2exp': {'age': [10, 100], 'tau_main': 500.0},
+                                                    'dustext': {'E_BV': [0.0, 0.2], 'filters': 'V_B90'}},
+                              analysis_params={'bands': ['jwst.nircam.F200W'], 'save_sed': True})
+    ini_file.write()
+
+    ini_file = CigaleIniFile(file_name=file_name)
+    assert ini_file.get_param(key='age', section=('sed_modules_params', 'sfh2exp')) == '10, 100'
+    assert ini_file.get_param(key='tau_main') == '500.0'
+    assert ini_file.get_param(key='E_BV') == '0.0, 0.2'
+    assert ini_file.get_param(key='filters', section=('sed_modules_params', 'dustext')) == 'V_B90'
+    # bands is a top level parameter in this pcigale version
+    assert ini_file.get_param(key='bands', section=()) == 'jwst.nircam.F200W'
+    assert ini_file.get_param(key='save_sed', section='analysis_params') == 'True'
+    # the indentation, comments and all other lines are kept
+    changed_line_list = [(new_line, old_line) for new_line, old_line in zip(read_lines(tmp_path / 'pcigale.ini'),
+                                                                            genconf_ini_str.splitlines(True))
+                         if old_line != new_line]
+    assert changed_line_list == [('bands = jwst.nircam.F200W\n', 'bands = hst.wfc3.F555W, hst.wfc3.F814W\n'),
+                                 ('    tau_main = 500.0\n', '    tau_main = 6000.0\n'),
+                                 ('    age = 10, 100\n', '    age = 1000\n'),
+                                 ('    E_BV = 0.0, 0.2\n', '    E_BV = 0.3\n'),
+                                 ('    filters = V_B90\n', '    filters = B_B90 & V_B90 & FUV\n'),
+                                 ('  save_sed = True\n', '  save_sed = False\n')]
+
+
+def test_keys_in_several_sections(tmp_path):
+    ini_str = genconf_ini_str.replace('  [[redshifting]]\n', '  [[restframe_parameters]]\n'
+                                                             '    filters = FUV\n\n  [[redshifting]]\n')
+    file_name = tmp_path / 'pcigale.ini'
+    with open(file_name, 'w', encoding='utf-8') as file:
+        file.write(ini_str)
+    ini_file = CigaleIniFile(file_name=file_name)
+    assert ini_file.key_index['filters'] == [('sed_modules_params', 'dustext'),
+                                             ('sed_modules_params', 'restframe_parameters')]
+    with pytest.raises(KeyError, match='more than one section'):
+        ini_file.set_param(key='filters', value='V_B90')
+    ini_file.set_params(param_dict={'filters': ['V_B90', 'FUV']}, section=('sed_modules_params',
+                                                                           'restframe_parameters'))
+    assert ini_file.get_param(key='filters', section=('sed_modules_params', 'restframe_parameters')) == 'V_B90, FUV'
+    assert ini_file.get_param(key='filters', section=('sed_modules_params', 'dustext')) == 'B_B90 & V_B90 & FUV'
+    # module parameters are only searched in the section of their module
+    with pytest.raises(KeyError, match='not in the section'):
+        ini_file.apply_sim_config(sed_module_conf_dict={'bc03': {'E_BV': 0.1}})
+    with pytest.raises(KeyError, match='not in the file'):
+        ini_file.set_param(key='unknown', value=1)
@@ -0,0 +1,78 @@
+"""
+Tests of the reading of pcigale model files
+"""
+import mmap
+
+import numpy as np
+import pytest
+from astropy.table import Table
+
+from cigale_wrapper import cigale_model_io
+
+CigaleModelIO = cigale_model_io.CigaleModelIO
+
+
+def write_block(out_path, block_number, n_rows, dtype=float):
+    first_id = 1000 * block_number
+    block_table = Table({'id': np.arange(first_id, first_id + n_rows),
+                         'hst.wfc3.F555W': np.linspace(1, 2, n_rows).astype(dtype),
+                         'sfh.age': np.full(n_rows, block_number, dtype=float)})
+    block_table['hst.wfc3.F555W'].unit = 'mJy'
+    block_table.write(out_path / ('models-block-%i.fits' % block_number))
+    return block_table
+
+
+def is_memory_mapped(array):
+    while array is not None:
+        if isinstance(array, (mmap.mmap, np.memmap)):
+            return True
+        array = getattr(array, 'base', None)
+    return False
+
+
+@pytest.mark.parametrize('n_threads', [1, 4])
+def test_blocks_are_read_in_block_order(tmp_path, n_threads):
+    # more than ten blocks, so that an alphabetical order would put block 10 before block 2
+    block_table_list = [write_block(out_path=tmp_path, block_number=block_number, n_rows=3 + block_number,
+                                    dtype=np.float32 if block_number % 2 else float)
+                        for block_number in range(12)]
+    (tmp_path / 'models-block-x.fits').touch()
+    block_file_list = CigaleModelIO.find_model_block_files(out_path=tmp_path)
+    assert [file_path.name for file_path in block_file_list] == ['models-block-%i.fits' % block_number
+                                                                 for block_number in range(12)]
+
+    model_table = CigaleModelIO.read_model_blocks(block_file_list=block_file_list,
+                                                  column_list=['id', 'hst.wfc3.F555W'], n_threads=n_threads)
+    assert model_table.colnames == ['id', 'hst.wfc3.F555W']
+    assert np.array_equal(model_table['id'], np.concatenate([block_table['id'] for block_table in block_table_list]))
+    # float32 and float64 blocks are promoted to a common type without losing values
+    assert model_table['hst.wfc3.F555W'].dtype == np.float64
+    assert np.array_equal(model_table['hst.wfc3.F555W'],
+                          np.concatenate([block_table['hst.wfc3.F555W'] for block_table in block_table_list]))
+    assert str(model_table['hst.wfc3.F555W'].unit) == 'mJy'
+
+
+def test_missing_blocks_and_columns(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        CigaleModelIO.find_model_block_files(out_path=tmp_path)
+    write_block(out_path=tmp_path, block_number=0, n_rows=3)
+    with pytest.raises(KeyError):
+        CigaleModelIO.read_model_blocks(block_file_list=CigaleModelIO.find_model_block_files(out_path=tmp_path),
+                                        column_list=['id', 'stellar.m_star'])
+
+
+def test_memmap_and_contiguous_columns(tmp_path):
+    block_table = write_block(out_path=tmp_path, block_number=0, n_rows=50)
+    file_name = tmp_path / 'models-block-0.fits'
+
+    mapped_table = CigaleModelIO.read_model_table(file_name=file_name, column_list=['sfh.age', 'id'], memmap=True)
+    assert mapped_table.colnames == ['sfh.age', 'id']
+    assert all(is_memory_mapped(mapped_table[col].data) for col in mapped_table.colnames)
+
+    copied_table = CigaleModelIO.read_model_table(file_name=file_name, column_list=['sfh.age', 'id'], memmap=False)
+    for col in copied_table.colnames:
+        assert not is_memory_mapped(copied_table[col].data)
+        assert copied_table[col].data.flags['C_CONTIGUOUS']
+        assert np.array_equal(copied_table[col], mapped_table[col])
+        assert np.array_equal(copied_table[col], block_table[col])
+    assert str(CigaleModelIO.read_model_table(file_name=file_name)['hst.wfc3.F555W'].unit) == 'mJy'
@@ -0,0 +1,46 @@
+"""
+Tests of the model wrapper with a stubbed pcigale simulation
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from astropy.table import Table
+
+from cigale_wrapper import cigale_molde_wrapper
+from conftest import make_stub_simulation, read_calls, sed_param_list
+
+CigaleModelWrapper = cigale_molde_wrapper.CigaleModelWrapper
+
+
+def get_conf(age_list):
+    return {'sfh2exp': {'age': age_list}, 'dustext': {'E_BV': [0.0, 0.1]}}
+
+
+def extend(tmp_path, age_list):
+    return CigaleModelWrapper.extend_sim_cigale_model_params(sed_module_conf_dict=get_conf(age_list=age_list),
+                                                             sed_param_list=sed_param_list, output_band_dict=None,
+                                                             data_output_path=tmp_path, file_name='grid')
+
+
+def test_concurrent_extensions_keep_all_models(tmp_path, monkeypatch):
+    monkeypatch.setattr(CigaleModelWrapper, 'sim_cigale_model_params', make_stub_simulation(log_path=tmp_path))
+    assert len(extend(tmp_path=tmp_path, age_list=[1, 2])) == 4
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        table_list = list(executor.map(lambda age_list: extend(tmp_path=tmp_path, age_list=age_list),
+                                       [[1, 2, 3], [1, 2, 4]]))
+    assert [len(model_table) for model_table in table_list] == [6, 6]
+    stored_table = Table.read(tmp_path / 'grid.fits')
+    assert sorted(np.unique(stored_table['sfh.age'])) == [1, 2, 3, 4]
+    assert len(stored_table) == 8
+    # only the missing ages were simulated
+    assert sorted(entry.split(' ', 1)[1] for entry in read_calls(log_path=tmp_path)) == ['[1, 2]', '[3]', '[4]']
+    assert not list(tmp_path.glob('*.tmp.fits'))
+
+
+def test_extension_of_table_without_requested_column(tmp_path, monkeypatch):
+    monkeypatch.setattr(CigaleModelWrapper, 'sim_cigale_model_params', make_stub_simulation(log_path=tmp_path))
+    Table({'sfh.age': [1., 2.]}).write(tmp_path / 'grid.fits')
+    model_table = extend(tmp_path=tmp_path, age_list=[1, 2])
+    assert len(model_table) == 4
+    assert len(read_calls(log_path=tmp_path)) == 1
+    assert Table.read(tmp_path / 'grid.fits').colnames == sed_param_list
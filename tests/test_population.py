@@ -0,0 +1,35 @@
+"""
+Tests of the synthetic population generator
+"""
+import numpy as np
+import pytest
+
+from cigale_wrapper import cigale_population
+from conftest import make_model_table
+
+
+def make_generator():
+    model_table = make_model_table(conf={'sfh2exp': {'age': [10, 100, 1000]}, 'dustext': {'E_BV': [0.0, 0.1]}})
+    model_table['stellar.m_star'] = np.ones(len(model_table))
+    model_table['universe.luminosity_distance'] = np.ones(len(model_table))
+    model_table['band_1'] = np.arange(1, len(model_table) + 1, dtype=float)
+    generator = cigale_population.CigalePopulationGenerator(model_table=model_table, band_list=['band_1'],
+                                                            axis_list=['sfh.age', 'attenuation.E_BV'])
+    return generator, model_table
+
+
+def test_nearest_model_on_log_axis():
+    generator, model_table = make_generator()
+    model_index = generator.get_nearest_model_index(param_dict={'sfh.age': np.array([20., 40., 5000.]),
+                                                                'attenuation.E_BV': np.array([0., 0.1, 0.2])})
+    # 40 is closer to 100 than to 10 in log10
+    assert list(model_table['sfh.age'][model_index]) == [10., 100., 1000.]
+    assert list(model_table['attenuation.E_BV'][model_index]) == [0., 0.1, 0.1]
+
+
+@pytest.mark.parametrize('age', [0., -10., np.nan])
+def test_non_positive_draws_on_log_axis_raise(age):
+    generator, _ = make_generator()
+    with pytest.raises(ValueError):
+        generator.get_nearest_model_index(param_dict={'sfh.age': np.array([100., age]),
+                                                      'attenuation.E_BV': np.array([0., 0.])})
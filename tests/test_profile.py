@@ -0,0 +1,49 @@
+"""
+Tests of the stage recorder
+"""
+import os
+import sys
+import time
+import subprocess
+
+import numpy as np
+import pytest
+
+from cigale_wrapper import cigale_profile
+
+
+@pytest.mark.skipif(not os.path.isfile('/proc/self/statm'), reason='needs /proc to sample the memory')
+def test_peak_rss_is_sampled_per_stage():
+    recorder = cigale_profile.CigaleStageRecorder(rss_sample_interval=0.01)
+    with recorder.stage(stage_name='large'):
+        array = np.ones(2 ** 25)
+        time.sleep(0.1)
+        del array
+    with recorder.stage(stage_name='small'):
+        time.sleep(0.1)
+    large_record, small_record = recorder.record_list
+    assert large_record['peak_rss_bytes'] - large_record['start_rss_bytes'] >= 2 ** 27
+    # the lifetime maximum of the first stage is not attributed to the second stage
+    assert small_record['peak_rss_bytes'] - small_record['start_rss_bytes'] < 2 ** 27
+    assert small_record['process_max_rss_bytes'] - small_record['start_rss_bytes'] >= 2 ** 27
+
+
+@pytest.mark.skipif(not os.path.isfile('/proc/self/statm'), reason='needs /proc to sample the memory')
+def test_subprocess_tree_rss_is_sampled(tmp_path):
+    recorder = cigale_profile.CigaleStageRecorder(rss_sample_interval=0.01)
+    # the memory is allocated by a grandchild, like by the worker processes of pcigale
+    allocate_str = 'import time; import numpy; array = numpy.ones(2 ** 25); time.sleep(0.3)'
+    command_list = [sys.executable, '-c', 'import sys, subprocess; subprocess.run([sys.executable, "-c", "%s"])'
+                    % allocate_str]
+    with recorder.stage(stage_name='run', n_models=10) as stage_info:
+        cigale_profile.CigaleStageRecorder.run_subprocess(command_list=command_list, cwd=tmp_path,
+                                                          stage_info=stage_info, recorder=recorder)
+    record = recorder.record_list[0]
+    assert record['subprocess_peak_rss_bytes'] >= 2 ** 28
+    assert record['peak_rss_bytes'] - record['start_rss_bytes'] < 2 ** 27
+    assert record['models_per_second'] > 0
+
+    with pytest.raises(subprocess.CalledProcessError):
+        with recorder.stage(stage_name='failing') as stage_info:
+            cigale_profile.CigaleStageRecorder.run_subprocess(command_list=[sys.executable, '-c', 'exit(3)'],
+                                                              cwd=tmp_path, stage_info=stage_info, recorder=recorder)
@@ -0,0 +1,91 @@
+"""
+Tests of the job queue with several worker processes and a stubbed pcigale simulation
+"""
+import os
+import time
+import multiprocessing
+
+import pytest
+
+from cigale_wrapper import cigale_queue
+from cigale_wrapper import cigale_molde_wrapper
+from conftest import make_model_table, make_stub_simulation, read_calls, sed_param_list
+
+
+sed_module_conf_dict = {'sfh2exp': {'age': [1, 2, 3, 4, 5, 6, 7, 8]}, 'dustext': {'E_BV': [0.0, 0.1]}}
+
+
+def run_worker(queue_path):
+    # the worker is a separate process, so the stub does not leak into other tests
+    cigale_molde_wrapper.CigaleModelWrapper.sim_cigale_model_params = make_stub_simulation(log_path=queue_path)
+    cigale_queue.CigaleJobQueue(queue_path=queue_path).work(heartbeat_interval=0.05, poll_interval=0.05)
+
+
+def create_queue(queue_path, conf_dict=sed_module_conf_dict):
+    return cigale_queue.CigaleJobQueue.create(queue_path=queue_path, sed_module_conf_dict=conf_dict,
+                                              sed_param_list=sed_param_list, output_band_dict=None,
+                                              split_axes=['sfh2exp.age'])
+
+
+def set_running(job_queue, job_id, worker_id, heartbeat_age, n_attempts):
+    with job_queue.connect() as connection:
+        connection.execute("UPDATE jobs SET status = 'running', worker = ?, heartbeat_time = ?, n_attempts = ? "
+                           "WHERE job_id = ?", (worker_id, time.time() - heartbeat_age, n_attempts, job_id))
+
+
+def test_workers_claim_each_job_once(tmp_path):
+    job_queue = create_queue(queue_path=tmp_path)
+    assert job_queue.get_status()['pending'] == 8
+    process_list = [multiprocessing.Process(target=run_worker, args=(str(tmp_path),)) for _ in range(4)]
+    for process in process_list:
+        process.start()
+    for process in process_list:
+        process.join(timeout=60)
+        assert process.exitcode == 0
+
+    assert job_queue.get_status() == {'pending': 0, 'running': 0, 'done': 8, 'failed': 0}
+    age_list = sorted(entry.split(' ', 1)[1] for entry in read_calls(log_path=tmp_path))
+    assert age_list == sorted('[%i]' % age for age in sed_module_conf_dict['sfh2exp']['age'])
+    assert not list(tmp_path.glob('*.tmp.fits'))
+
+    model_table = job_queue.merge()
+    expected_table = make_model_table(conf=sed_module_conf_dict)
+    assert sorted(zip(model_table['sfh.age'], model_table['attenuation.E_BV'])) == \
+        sorted(zip(expected_table['sfh.age'], expected_table['attenuation.E_BV']))
+
+
+def test_stale_claim_is_requeued(tmp_path, monkeypatch):
+    job_queue = create_queue(queue_path=tmp_path)
+    set_running(job_queue=job_queue, job_id=0, worker_id='crashed', heartbeat_age=100, n_attempts=1)
+    set_running(job_queue=job_queue, job_id=1, worker_id='busy', heartbeat_age=0, n_attempts=1)
+    with pytest.raises(RuntimeError):
+        job_queue.merge()
+
+    monkeypatch.setattr(cigale_molde_wrapper.CigaleModelWrapper, 'sim_cigale_model_params',
+                        make_stub_simulation(log_path=tmp_path))
+    finished_job_list = job_queue.work(worker_id='worker', stale_time=10, wait_for_running=False)
+    assert sorted(finished_job_list) == [0, 2, 3, 4, 5, 6, 7]
+    assert job_queue.get_status() == {'pending': 0, 'running': 1, 'done': 7, 'failed': 0}
+    with job_queue.connect() as connection:
+        assert connection.execute('SELECT n_attempts FROM jobs WHERE job_id = 0').fetchone()[0] == 2
+
+
+def test_stale_claim_fails_after_max_attempts(tmp_path):
+    job_queue = create_queue(queue_path=tmp_path)
+    set_running(job_queue=job_queue, job_id=0, worker_id='crashed', heartbeat_age=100, n_attempts=2)
+    set_running(job_queue=job_queue, job_id=1, worker_id='crashed', heartbeat_age=100, n_attempts=1)
+    assert job_queue.requeue_stale(stale_time=10, max_attempts=2) == 2
+    with job_queue.connect() as connection:
+        status_dict = dict(connection.execute('SELECT job_id, status FROM jobs WHERE job_id < 2').fetchall())
+    assert status_dict == {0: 'failed', 1: 'pending'}
+
+
+def test_lost_claim_discards_output(tmp_path, monkeypatch):
+    job_queue = create_queue(queue_path=tmp_path, conf_dict={'sfh2exp': {'age': [1]}, 'dustext': {'E_BV': [0.0]}})
+    monkeypatch.setattr(cigale_molde_wrapper.CigaleModelWrapper, 'sim_cigale_model_params',
+                        make_stub_simulation(log_path=tmp_path,
+                                             steal_claim_database=tmp_path / job_queue.database_file_name))
+    assert job_queue.work(worker_id='worker', wait_for_running=False) == []
+    assert not os.path.isfile(job_queue.get_job_file_path(job_id=0))
+    assert not list(tmp_path.glob('*.tmp.fits'))
+    assert job_queue.get_status()['running'] == 1